@@ -0,0 +1,164 @@
+import logging
+import math
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class InsufficientDisk(Exception):
+    """Raised when a download would leave less free disk space than required"""
+
+
+class TokenBuckets:
+    """Per-client token buckets refilled at rate tokens per second up to burst.
+
+    Buckets of the least recently seen clients are dropped beyond max_clients;
+    a dropped client simply starts again with a full bucket.
+    """
+
+    def __init__(self, rate=1.0, burst=10, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()  # client -> (tokens, last refill)
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    def take(self, client, cost=1):
+        """Take cost tokens from client's bucket; returns 0 if allowed, else seconds until it would be"""
+        cost = min(cost, self.burst)
+        with self._lock:
+            now = time.monotonic()
+            tokens, last = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= cost:
+                tokens -= cost
+                wait = 0.0
+                self.allowed += 1
+            else:
+                wait = (cost - tokens) / self.rate
+                self.limited += 1
+            self._buckets[client] = (tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def stats(self):
+        with self._lock:
+            return {'rate': self.rate, 'burst': self.burst, 'clients': len(self._buckets),
+                    'allowed': self.allowed, 'limited': self.limited}
+
+
+class DiskBudget:
+    """Admits downloads only while the disk holding path keeps min_free_bytes free.
+
+    Space is reserved for the expected size of every download in progress, so
+    downloads that start together cannot each count the same free space.
+    """
+
+    def __init__(self, path, min_free_bytes=1024 ** 3):
+        self.path = path
+        self.min_free_bytes = min_free_bytes
+        self._lock = threading.Lock()
+        self.reserved = 0
+        self.rejected = 0
+
+    def _has_room(self, size):
+        """Whether size more bytes fit; caller must hold the lock"""
+        return shutil.disk_usage(self.path).free - self.reserved - size >= self.min_free_bytes
+
+    def has_room(self, size=0):
+        with self._lock:
+            return self._has_room(size)
+
+    @contextmanager
+    def reserve(self, size):
+        """Hold size bytes for the duration of a download; raises InsufficientDisk if they are not free"""
+        size = size or 0
+        with self._lock:
+            if not self._has_room(size):
+                self.rejected += 1
+                raise InsufficientDisk(f"Not enough free disk space for a {size} byte download")
+            self.reserved += size
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.reserved -= size
+
+    def stats(self):
+        with self._lock:
+            return {'free_bytes': shutil.disk_usage(self.path).free, 'reserved_bytes': self.reserved,
+                    'min_free_bytes': self.min_free_bytes, 'rejected': self.rejected}
+
+
+class Rejection:
+    """Why a request was not admitted, and when the client should retry"""
+
+    def __init__(self, status, message, retry_after):
+        self.status = status
+        self.message = message
+        # Whole seconds, as the Retry-After header takes
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class Admission:
+    """Decides whether a download request may start work.
+
+    A request is turned away with 429 while its client's token bucket is
+    empty, and with 503 while max_pending jobs are already queued or running
+    or the disk is below its free space floor. queue is the JobQueue, whose
+    recent throughput estimates when there will be room again.
+    """
+
+    def __init__(self, queue, buckets, disk, max_pending=64):
+        self.queue = queue
+        self.buckets = buckets
+        self.disk = disk
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self.rejected = {'rate': 0, 'pending': 0, 'disk': 0}
+
+    def _reject(self, reason, status, message, retry_after):
+        with self._lock:
+            self.rejected[reason] += 1
+        logger.warning(f"Rejected request ({reason}), retry after {retry_after:.1f}s")
+        return Rejection(status, message, retry_after)
+
+    def check(self, client, cost=1, queued=True, jobs=1):
+        """Return a Rejection, or None to admit a request costing cost tokens.
+
+        jobs is how many jobs the request keeps queued or running at once; it
+        is admitted only if they all fit under max_pending. Requests that are
+        not queued as jobs (proxied streams) are only rate limited.
+        """
+        wait = self.buckets.take(client, cost) if cost else 0
+        if wait:
+            return self._reject('rate', 429, 'Too many requests', wait)
+        if not queued:
+            return None
+        pending = self.queue.pending()
+        if pending + jobs > self.max_pending:
+            # Room opens up once the workers get through the excess
+            return self._reject('pending', 503, 'Server is busy',
+                                self.queue.estimate_wait(pending + jobs - self.max_pending))
+        if not self.disk.has_room():
+            return self._reject('disk', 503, 'Not enough free disk space', self.queue.estimate_wait())
+        return None
+
+    def stats(self):
+        with self._lock:
+            rejected = dict(self.rejected)
+        return {
+            'max_pending': self.max_pending,
+            'pending': self.queue.pending(),
+            'estimated_wait_seconds': round(self.queue.estimate_wait(), 1),
+            'rejected': rejected,
+            'clients': self.buckets.stats(),
+            'disk': self.disk.stats()
+        }
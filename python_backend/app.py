@@ -1,12 +1,16 @@
-from flask import Flask, request, jsonify, send_file, Response
+from flask import Flask, request, jsonify, send_file, Response, g
 from flask_cors import CORS
 import os
+import hmac
+import threading
 import uuid
 import json
 import logging
 from urllib.parse import urlparse, parse_qs
 import shutil
+import math
 import time
+from collections import deque
 from pytube import YouTube, exceptions
 import requests
 from urllib.parse import urlparse, parse_qs
@@ -15,19 +19,59 @@ import random
 import time
 import json
 from urllib.error import HTTPError
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cache import TTLCache
+from manifest import (CipherCache, build_manifest, select_stream, select_adaptive_streams, download_stream,
+                      _digits)
+from download_cache import IDLE_CHUNKS_ENVIRON, DownloadCache
+from proxy import UpstreamError, open_upstream, relay, passthrough_headers
+from downloader import SegmentedDownloader
+from jobs import JobQueue, JobError
+from archive import stream_zip
+from playlists import collection_kind, open_collection, describe_collection, iter_entries, resolve_windowed
+from transcode import TranscodePool, TranscodeError, AUDIO_CONTAINERS, MULTI_INPUT, audio_args, mux_args
+from clips import ClipError, parse_time, read_index, keyframe_before, clip_source, clip_time_args
+from resilience import CircuitBreaker, Hedger
+from youtube_fallback import YouTubeFallback
+from http_pool import HttpPool
+from shared_cache import RespClient, tiered
+from thumbnails import (ThumbnailNotFound, VARIANT_WIDTHS, is_video_id, fetch_thumbnail, resize_args,
+                        content_etag)
+from admission import Admission, DiskBudget, InsufficientDisk, TokenBuckets
+from janitor import Janitor
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Registry, StageTimer, render_family, server_timing
+from tracing import KIND_SERVER, TRACEPARENT_HEADER, OtlpExporter, Tracer, install_log_record_factory
+from profiler import SamplingProfiler
+from warmup import Warmup
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
 # Configure logging
 logging.basicConfig(level=logging.INFO,
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+                    format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s')
 logger = logging.getLogger(__name__)
 
-# Create downloads directory if it doesn't exist
+# Every request gets a trace ID, continued from its traceparent header when it
+# has one, that is logged with each line and sent on outbound calls. Spans of
+# the request, its stages and its outbound calls are recorded for the
+# TRACE_SAMPLE_RATE fraction of traces, for traces the caller sampled and for
+# profiled requests; the last TRACE_BUFFER_SPANS are kept for
+# /api/admin/traces and, with OTEL_EXPORTER_OTLP_TRACES_ENDPOINT set (e.g.
+# http://collector:4318/v1/traces), sent to an OpenTelemetry collector
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0))
+TRACE_BUFFER_SPANS = int(os.environ.get('TRACE_BUFFER_SPANS', 2048))
+OTEL_EXPORTER_OTLP_TRACES_ENDPOINT = os.environ.get('OTEL_EXPORTER_OTLP_TRACES_ENDPOINT')
+OTEL_SERVICE_NAME = os.environ.get('OTEL_SERVICE_NAME', 'ytdl-backend')
+span_exporter = None
+if OTEL_EXPORTER_OTLP_TRACES_ENDPOINT:
+    span_exporter = OtlpExporter(OTEL_EXPORTER_OTLP_TRACES_ENDPOINT, OTEL_SERVICE_NAME)
+tracer = Tracer(sample_rate=TRACE_SAMPLE_RATE, max_spans=TRACE_BUFFER_SPANS, exporter=span_exporter)
+install_log_record_factory(tracer)
+
+# Holds the download cache, thumbnails and job database by default; created by create_app()
 DOWNLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'downloads')
-if not os.path.exists(DOWNLOAD_DIR):
-    os.makedirs(DOWNLOAD_DIR)
 
 # List of common user agents to rotate through
 USER_AGENTS = [
@@ -38,6 +82,193 @@ USER_AGENTS = [
     'Mozilla/5.0 (Macintosh; Intel Mac OS X 11_5_1) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.2 Safari/605.1.15'
 ]
 
+# All outbound HTTP (pytube, oEmbed, stream downloads and proxying) shares one
+# session with keep-alive connection pools for up to HTTP_POOL_HOSTS hosts,
+# keeping up to HTTP_POOL_CONNECTIONS connections each, and a User-Agent
+# picked from USER_AGENTS for requests that don't set their own
+HTTP_POOL_HOSTS = int(os.environ.get('HTTP_POOL_HOSTS', 32))
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 16))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 15))
+# Sends every outbound request to this base URL instead, e.g. the local
+# YouTube stand-in used by benchmark.py; never set in production
+UPSTREAM_OVERRIDE = os.environ.get('UPSTREAM_OVERRIDE')
+http_pool = HttpPool(USER_AGENTS, max_hosts=HTTP_POOL_HOSTS, connections_per_host=HTTP_POOL_CONNECTIONS,
+                     timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), upstream_override=UPSTREAM_OVERRIDE,
+                     tracer=tracer)
+http_pool.install_pytube()
+
+# With CACHE_BACKEND=redis, video metadata and manifests are shared between
+# nodes through the Redis-protocol server at REDIS_URL; each node keeps the
+# keys it uses in memory for up to CACHE_NEAR_TTL seconds in front of it
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+CACHE_NEAR_TTL = int(os.environ.get('CACHE_NEAR_TTL', 30))
+CACHE_KEY_PREFIX = os.environ.get('CACHE_KEY_PREFIX', 'ytdl:')
+if CACHE_BACKEND not in ('memory', 'redis'):
+    raise ValueError(f"Unknown CACHE_BACKEND {CACHE_BACKEND!r}")
+shared_cache_client = RespClient.from_url(REDIS_URL) if CACHE_BACKEND == 'redis' else None
+
+# Video metadata cache, keyed by video ID. oEmbed fallback data is incomplete
+# (no views/duration) so it is kept for a shorter time.
+METADATA_CACHE_SIZE = int(os.environ.get('METADATA_CACHE_SIZE', 2048))
+METADATA_CACHE_TTL = int(os.environ.get('METADATA_CACHE_TTL', 600))
+METADATA_FALLBACK_TTL = int(os.environ.get('METADATA_FALLBACK_TTL', 60))
+metadata_cache = tiered(TTLCache(max_entries=METADATA_CACHE_SIZE, ttl=METADATA_CACHE_TTL),
+                        shared_cache_client, f'{CACHE_KEY_PREFIX}metadata:', CACHE_NEAR_TTL)
+
+# Video info comes from pytube, hedged with YouTube's oEmbed API: if pytube has
+# not answered within the 95th percentile of its recent latency (at most
+# EXTRACTOR_HEDGE_DELAY seconds), oEmbed is raced against it. Once
+# PYTUBE_BREAKER_FAILURE_RATE of at least PYTUBE_BREAKER_MIN_CALLS calls in
+# PYTUBE_BREAKER_WINDOW seconds have failed, pytube is skipped for
+# PYTUBE_BREAKER_COOLDOWN seconds.
+EXTRACTOR_HEDGE_DELAY = float(os.environ.get('EXTRACTOR_HEDGE_DELAY', 4.0))
+EXTRACTOR_WORKERS = int(os.environ.get('EXTRACTOR_WORKERS', 32))
+PYTUBE_BREAKER_FAILURE_RATE = float(os.environ.get('PYTUBE_BREAKER_FAILURE_RATE', 0.5))
+PYTUBE_BREAKER_MIN_CALLS = int(os.environ.get('PYTUBE_BREAKER_MIN_CALLS', 10))
+PYTUBE_BREAKER_WINDOW = int(os.environ.get('PYTUBE_BREAKER_WINDOW', 60))
+PYTUBE_BREAKER_COOLDOWN = int(os.environ.get('PYTUBE_BREAKER_COOLDOWN', 30))
+extractor_executor = ThreadPoolExecutor(max_workers=EXTRACTOR_WORKERS, thread_name_prefix='extractor')
+info_hedger = Hedger(extractor_executor, max_delay=EXTRACTOR_HEDGE_DELAY)
+pytube_breaker = CircuitBreaker(failure_rate=PYTUBE_BREAKER_FAILURE_RATE, min_calls=PYTUBE_BREAKER_MIN_CALLS,
+                                window=PYTUBE_BREAKER_WINDOW, cooldown=PYTUBE_BREAKER_COOLDOWN)
+youtube_fallback = YouTubeFallback(session=http_pool.session)
+
+# Resolved stream manifests, keyed by video ID. Entries expire with the
+# signed stream URLs they contain, capped at MANIFEST_CACHE_MAX_TTL.
+MANIFEST_CACHE_SIZE = int(os.environ.get('MANIFEST_CACHE_SIZE', 1024))
+MANIFEST_CACHE_MAX_TTL = int(os.environ.get('MANIFEST_CACHE_MAX_TTL', 3 * 3600))
+manifest_cache = tiered(TTLCache(max_entries=MANIFEST_CACHE_SIZE, ttl=MANIFEST_CACHE_MAX_TTL),
+                        shared_cache_client, f'{CACHE_KEY_PREFIX}manifest:', CACHE_NEAR_TTL)
+
+# Finished downloads, shared between requests for the same video/stream/format
+DOWNLOAD_CACHE_DIR = os.environ.get('DOWNLOAD_CACHE_DIR', os.path.join(DOWNLOAD_DIR, 'cache'))
+DOWNLOAD_CACHE_MAX_BYTES = int(os.environ.get('DOWNLOAD_CACHE_MAX_BYTES', 10 * 1024 ** 3))
+DOWNLOAD_CACHE_POLICY = os.environ.get('DOWNLOAD_CACHE_POLICY', 'lru')
+PARTIAL_RETENTION = int(os.environ.get('PARTIAL_RETENTION', 3600))
+download_cache = DownloadCache(DOWNLOAD_CACHE_DIR, DOWNLOAD_CACHE_MAX_BYTES, DOWNLOAD_CACHE_POLICY,
+                               partial_retention=PARTIAL_RETENTION)
+
+# Streams are fetched as parallel byte-range segments that are retried with
+# backoff and resumed from the last completed segment
+DOWNLOAD_CONNECTIONS = int(os.environ.get('DOWNLOAD_CONNECTIONS', 4))
+DOWNLOAD_SEGMENT_SIZE = int(os.environ.get('DOWNLOAD_SEGMENT_SIZE', 8 * 1024 * 1024))
+DOWNLOAD_SEGMENT_RETRIES = int(os.environ.get('DOWNLOAD_SEGMENT_RETRIES', 3))
+DOWNLOAD_RETRY_BUDGET = int(os.environ.get('DOWNLOAD_RETRY_BUDGET', 12))
+segmented_downloader = SegmentedDownloader(connections=DOWNLOAD_CONNECTIONS,
+                                           segment_size=DOWNLOAD_SEGMENT_SIZE,
+                                           max_retries=DOWNLOAD_SEGMENT_RETRIES,
+                                           retry_budget=DOWNLOAD_RETRY_BUDGET,
+                                           session=http_pool.session)
+
+# POST /api/video/info/batch resolves up to INFO_BATCH_MAX_URLS links per
+# request on a pool shared by all batches, so concurrent batches cannot
+# multiply the load on YouTube
+INFO_BATCH_MAX_URLS = int(os.environ.get('INFO_BATCH_MAX_URLS', 300))
+INFO_BATCH_CONCURRENCY = int(os.environ.get('INFO_BATCH_CONCURRENCY', 8))
+info_batch_executor = ThreadPoolExecutor(max_workers=INFO_BATCH_CONCURRENCY, thread_name_prefix='info-batch')
+
+# Playlists and channels are paged through lazily. At most PLAYLIST_MAX_VIDEOS
+# entries are listed per request, and the downloads queued for one playlist
+# run at most PLAYLIST_JOB_CONCURRENCY at a time (a request may ask for fewer).
+PLAYLIST_MAX_VIDEOS = int(os.environ.get('PLAYLIST_MAX_VIDEOS', 1000))
+PLAYLIST_JOB_CONCURRENCY = int(os.environ.get('PLAYLIST_JOB_CONCURRENCY', 2))
+
+# POST /api/archive bundles up to ARCHIVE_MAX_ITEMS downloads into one ZIP
+# streamed on the fly; ARCHIVE_PREFETCH items are queued ahead of the one
+# being written so they download in parallel
+ARCHIVE_MAX_ITEMS = int(os.environ.get('ARCHIVE_MAX_ITEMS', 50))
+ARCHIVE_PREFETCH = int(os.environ.get('ARCHIVE_PREFETCH', 2))
+
+# Downloads run as jobs on a bounded worker pool; job state is kept in SQLite
+# so queued work survives restarts. Synchronous /api/video/download requests
+# have a client waiting, so they jump ahead of submitted jobs.
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOBS_DB = os.environ.get('JOBS_DB', os.path.join(DOWNLOAD_DIR, 'jobs.sqlite3'))
+JOB_RETENTION = int(os.environ.get('JOB_RETENTION', 86400))
+SYNC_JOB_PRIORITY = 10
+
+# How completed downloads are handed to the client: 'direct' streams them from
+# this process (zero-copy where the WSGI server's file_wrapper supports
+# sendfile), 'x-sendfile' and 'x-accel-redirect' delegate to a front proxy.
+# For nginx, X_ACCEL_PREFIX is an internal location aliased to DOWNLOAD_CACHE_DIR.
+SENDFILE_MODE = os.environ.get('SENDFILE_MODE', 'direct')
+X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX', '/protected-downloads')
+app.use_x_sendfile = SENDFILE_MODE == 'x-sendfile'
+
+# Thumbnails are proxied from YouTube and kept on disk, with resized variants,
+# up to THUMBNAIL_CACHE_MAX_BYTES; browsers may reuse them for THUMBNAIL_MAX_AGE seconds
+THUMBNAIL_CACHE_DIR = os.environ.get('THUMBNAIL_CACHE_DIR', os.path.join(DOWNLOAD_DIR, 'thumbnails'))
+THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get('THUMBNAIL_CACHE_MAX_BYTES', 256 * 1024 ** 2))
+THUMBNAIL_MAX_AGE = int(os.environ.get('THUMBNAIL_MAX_AGE', 86400))
+thumbnail_cache = DownloadCache(THUMBNAIL_CACHE_DIR, THUMBNAIL_CACHE_MAX_BYTES, 'lru')
+
+# Download requests are admitted while fewer than ADMISSION_MAX_PENDING jobs
+# are queued or running and the download cache's disk keeps MIN_FREE_DISK_BYTES
+# free after every download in progress; each client (by IP) may start
+# CLIENT_BURST requests at once, refilled at CLIENT_RATE per second
+ADMISSION_MAX_PENDING = int(os.environ.get('ADMISSION_MAX_PENDING', 64))
+CLIENT_RATE = float(os.environ.get('CLIENT_RATE', 0.5))
+CLIENT_BURST = int(os.environ.get('CLIENT_BURST', 10))
+MIN_FREE_DISK_BYTES = int(os.environ.get('MIN_FREE_DISK_BYTES', 1024 ** 3))
+client_buckets = TokenBuckets(rate=CLIENT_RATE, burst=CLIENT_BURST)
+disk_budget = DiskBudget(DOWNLOAD_CACHE_DIR, min_free_bytes=MIN_FREE_DISK_BYTES)
+
+# Every JANITOR_INTERVAL seconds, stale partial files in the caches are
+# removed. Until none are left, so are per-request temp dirs of the old
+# download layout in DOWNLOAD_DIR older than TEMP_DIR_MAX_AGE
+JANITOR_INTERVAL = int(os.environ.get('JANITOR_INTERVAL', 300))
+TEMP_DIR_MAX_AGE = int(os.environ.get('TEMP_DIR_MAX_AGE', 3600))
+janitor = Janitor(DOWNLOAD_DIR, interval=JANITOR_INTERVAL, max_age=TEMP_DIR_MAX_AGE,
+                  sweeps=[download_cache.sweep_partials, thumbnail_cache.sweep_partials])
+
+# Prometheus metrics served at /api/metrics. Requests are timed per endpoint
+# and the work behind them per stage: pytube setup ('init'), video info
+# ('info', 'oembed', 'video_info' overall), stream resolution ('streams'),
+# waiting in the job queue ('queue'), stream downloads ('download'), ffmpeg
+# ('ffmpeg') and sending the response body ('send').
+metrics = Registry()
+request_count = metrics.counter('ytdl_http_requests_total', 'HTTP requests by endpoint, method and status',
+                                ('endpoint', 'method', 'status'))
+request_seconds = metrics.histogram('ytdl_http_request_duration_seconds',
+                                    'Time from receiving a request to sending the last byte of its response',
+                                    ('endpoint',))
+stage_timer = StageTimer(metrics.histogram('ytdl_stage_duration_seconds', 'Time spent in each stage of the work',
+                                           ('stage',)), tracer=tracer)
+client_bytes = metrics.counter('ytdl_client_bytes_total', 'Response body bytes sent to clients', ('endpoint',))
+download_throughput = metrics.histogram('ytdl_download_throughput_bytes_per_second',
+                                        'Throughput achieved by each stream download', (),
+                                        buckets=tuple(2 ** n * 64 * 1024 for n in range(12)))
+video_info_sources = metrics.counter('ytdl_video_info_total',
+                                     'Video info lookups by the source that answered them', ('source',))
+
+# Admin endpoints (/api/admin/...) require "Authorization: Bearer <ADMIN_TOKEN>"
+# and are turned off while it is unset. A PROFILE_SAMPLE_RATE fraction of
+# requests (adjustable through /api/admin/profiling), and admin requests sent
+# with "X-Profile: 1", are profiled by sampling the stacks of the threads
+# working on them every PROFILE_INTERVAL seconds; the stacks of the last
+# PROFILE_MAX_TRACES profiled requests are kept for /api/admin/profile
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+PROFILE_MAX_TRACES = int(os.environ.get('PROFILE_MAX_TRACES', 100))
+profiler = SamplingProfiler(sample_rate=PROFILE_SAMPLE_RATE, interval=PROFILE_INTERVAL,
+                            max_traces=PROFILE_MAX_TRACES)
+
+# Audio conversion runs ffmpeg as a pipe filter; at most TRANSCODE_PROCESSES
+# (default: one per CPU core) run at once and further conversions wait
+TRANSCODE_PROCESSES = int(os.environ.get('TRANSCODE_PROCESSES', os.cpu_count() or 1))
+transcode_pool = TranscodePool(max_processes=TRANSCODE_PROCESSES)
+
+# accurate=1 clips are re-encoded from start to end, which takes CPU time in
+# proportion to their length; longer ones are refused (0 for no limit)
+CLIP_ACCURATE_MAX_SECONDS = float(os.environ.get('CLIP_ACCURATE_MAX_SECONDS', 300))
+
+# Parse each player's signature cipher once instead of once per video
+cipher_cache = CipherCache()
+cipher_cache.install()
+
 def extract_video_id(url):
     """Extract YouTube video ID from URL"""
     if 'youtu.be' in url:
@@ -73,50 +304,44 @@ def format_views(view_count):
     else:
         return str(count)
 
+def browser_headers():
+    """Request headers that look like a browser, with a random user agent"""
+    return {
+        'User-Agent': random.choice(USER_AGENTS),
+        'Accept-Language': 'en-US,en;q=0.9',
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+        'Referer': 'https://www.youtube.com/',
+        'Origin': 'https://www.youtube.com'
+    }
+
 def initialize_youtube(url):
     """Initialize YouTube with proper configuration to avoid 403 errors"""
     try:
-        # Configure YouTube with proper headers
-        yt = YouTube(url)
-        
-        # Set a random user agent
-        user_agent = random.choice(USER_AGENTS)
-        yt.headers = {
-            'User-Agent': user_agent,
-            'Accept-Language': 'en-US,en;q=0.9',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Referer': 'https://www.youtube.com/',
-            'Origin': 'https://www.youtube.com'
-        }
+        with stage_timer.stage('init'):
+            # Configure YouTube with proper headers
+            yt = YouTube(url)
+            
+            # Set a random user agent
+            yt.headers = browser_headers()
         
         return yt
     except Exception as e:
         logger.error(f"Error initializing YouTube: {str(e)}")
         raise
 
-def get_video_info_fallback(url):
-    """Alternative method to get video information when pytube fails"""
-    video_id = extract_video_id(url)
-    if not video_id:
-        raise ValueError("Could not extract video ID from URL")
-    
-    # Try using YouTube's oEmbed API (public and rarely blocked)
-    oembed_url = f"https://www.youtube.com/oembed?url=https://www.youtube.com/watch?v={video_id}&format=json"
-    response = requests.get(oembed_url)
-    response.raise_for_status()
-    
-    # Basic info from oEmbed
-    oembed_data = response.json()
-    
-    # Use a more direct approach to get direct video URLs (requires video ID)
-    # This is intentionally simplified to avoid triggering YouTube's protection mechanisms
+def fetch_oembed_info(video_id):
+    """Fetch basic video information from YouTube's oEmbed API"""
+    # YouTubeFallback keeps a session to YouTube open and times out stuck requests
+    with stage_timer.stage('oembed'):
+        oembed_data = youtube_fallback.get_basic_info(f"https://www.youtube.com/watch?v={video_id}")
     
     return {
         "id": video_id,
-        "title": oembed_data.get("title", "Unknown video"),
-        "author": oembed_data.get("author_name", "Unknown author"),
+        "title": oembed_data["title"],
+        "author": oembed_data["author"],
         "thumbnail": f"https://i.ytimg.com/vi/{video_id}/maxresdefault.jpg",
         "formats": [
+            {"value": "mp4-1080p", "label": "MP4 1080p", "size": "Variable", "quality": "1080p"},
             {"value": "mp4-720p", "label": "MP4 720p", "size": "Variable", "quality": "720p"},
             {"value": "mp4-360p", "label": "MP4 360p", "size": "Variable", "quality": "360p"},
             {"value": "mp3-128", "label": "MP3 Audio", "size": "Variable", "quality": "128"}
@@ -125,6 +350,756 @@ def get_video_info_fallback(url):
         "duration": "0:00"
     }
 
+def fetch_video_info(url):
+    """Get video information with pytube"""
+    yt = initialize_youtube(url)
+    
+    # Format response for our frontend
+    formats = [
+        {"value": "mp4-1080p", "label": "MP4 1080p", "size": "Variable", "quality": "1080p"},
+        {"value": "mp4-720p", "label": "MP4 720p", "size": "Variable", "quality": "720p"},
+        {"value": "mp4-360p", "label": "MP4 360p", "size": "Variable", "quality": "360p"},
+        {"value": "mp3-128", "label": "MP3 Audio", "size": "Variable", "quality": "128"}
+    ]
+    
+    # pytube fetches the watch page on the first attribute read
+    with stage_timer.stage('info'):
+        return {
+            "id": extract_video_id(url),
+            "title": yt.title,
+            "author": yt.author,
+            "thumbnail": yt.thumbnail_url,
+            "duration": format_duration(yt.length),
+            "views": format_views(yt.views),
+            "formats": formats
+        }
+
+def pytube_video_info(url):
+    """fetch_video_info(), with the outcome recorded by the pytube circuit breaker"""
+    try:
+        data = fetch_video_info(url)
+    except exceptions.VideoUnavailable:
+        # Private, removed or restricted video; pytube itself is working
+        pytube_breaker.record_success()
+        raise
+    except Exception as e:
+        pytube_breaker.record_failure()
+        if isinstance(e, (exceptions.PytubeError, HTTPError)):
+            logger.exception(f"Pytube error: {str(e)}")
+        else:
+            logger.exception("Error fetching video info")
+        raise
+    pytube_breaker.record_success()
+    return data
+
+def load_video_info(url):
+    """Resolve video information with pytube, hedged with oEmbed.
+    
+    oEmbed is started alongside pytube when pytube is slow or fails, and
+    used on its own while the pytube circuit breaker is open. Returns a
+    (cache entry, ttl) pair for metadata_cache.get_or_load().
+    """
+    video_id = extract_video_id(url)
+    
+    def oembed_video_info():
+        if not video_id:
+            raise ValueError("Could not extract video ID from URL")
+        return fetch_oembed_info(video_id)
+    
+    if not pytube_breaker.allow():
+        logger.info("Pytube circuit breaker is open, using fallback method to get video info")
+        with stage_timer.stage('video_info'):
+            data = oembed_video_info()
+        video_info_sources.inc(source='oembed_breaker_open')
+        return {'data': data, 'degraded': True}, METADATA_FALLBACK_TTL
+    
+    def upgrade(index, data):
+        # pytube answered after oEmbed won; replace the degraded entry
+        if video_id:
+            metadata_cache.set(video_id, {'data': data, 'degraded': False})
+    
+    with stage_timer.stage('video_info'):
+        index, data = info_hedger.run([lambda: pytube_video_info(url), oembed_video_info],
+                                      accept=lambda data: bool(data.get('title')), on_late=upgrade)
+    if index == 0:
+        video_info_sources.inc(source='pytube')
+        return {'data': data, 'degraded': False}, METADATA_CACHE_TTL
+    video_info_sources.inc(source='oembed_hedge')
+    logger.info(f"Using fallback video info for {video_id}")
+    return {'data': data, 'degraded': True}, METADATA_FALLBACK_TTL
+
+def get_video_info(url):
+    """Get video information, reusing the metadata cache when the URL has a video ID"""
+    video_id = extract_video_id(url)
+    if video_id:
+        entry = metadata_cache.get_or_load(video_id, lambda: load_video_info(url))
+    else:
+        entry, _ = load_video_info(url)
+    return entry['data']
+
+def present_info(data, host_url):
+    """Video information as sent to clients, with thumbnails served through /api/thumbnail"""
+    if not is_video_id(data.get('id')):
+        return data
+    base_url = f"{host_url.rstrip('/')}/api/thumbnail/{data['id']}"
+    return dict(data, thumbnail=base_url,
+                thumbnails={str(width): f"{base_url}?w={width}" for width in VARIANT_WIDTHS})
+
+def load_manifest(url):
+    """Resolve the stream manifest for a URL with pytube.
+    
+    Returns a (manifest, ttl) pair for manifest_cache.get_or_load().
+    """
+    yt = initialize_youtube(url)
+    with stage_timer.stage('streams'):
+        manifest, ttl = build_manifest(yt, extract_video_id(url) or yt.video_id)
+    return manifest, min(ttl, MANIFEST_CACHE_MAX_TTL)
+
+def get_manifest(url):
+    """Get the stream manifest for a URL, reusing it until its stream URLs expire"""
+    video_id = extract_video_id(url)
+    if not video_id:
+        manifest, _ = load_manifest(url)
+        return manifest
+    return manifest_cache.get_or_load(video_id, lambda: load_manifest(url))
+
+def refresh_stream_url(url, manifest, stream):
+    """Re-resolve a stream's signed URL through pytube after it has lapsed"""
+    manifest_cache.delete(manifest['id'])
+    fresh_manifest = get_manifest(url)
+    fresh_stream = next((s for s in fresh_manifest['streams'] if s['itag'] == stream['itag']), None)
+    if not fresh_stream:
+        raise UpstreamError(410, f"Stream {stream['itag']} is no longer offered")
+    return fresh_stream['url']
+
+def download_manifest_stream(url, manifest, stream, file_path, on_progress=None):
+    """Download a manifest stream, resuming a partial file and re-resolving lapsed URLs"""
+    headers = browser_headers()
+    started = time.monotonic()
+    with stage_timer.stage('download'):
+        filesize = stream.get('filesize') or segmented_downloader.probe_size(stream['url'], headers)
+        if filesize:
+            segmented_downloader.download(stream['url'], file_path, filesize, headers, on_progress,
+                                          refresh_url=lambda: refresh_stream_url(url, manifest, stream))
+        else:
+            # Upstream ignores Range requests, so fall back to a plain sequential download
+            download_stream(stream, file_path)
+    elapsed = time.monotonic() - started
+    if elapsed > 0:
+        download_throughput.observe(os.path.getsize(file_path) / elapsed)
+    return file_path
+
+def negotiate_audio_format(format_type):
+    """Resolve format=audio to a concrete container from the request's Accept header.
+    
+    Containers that the best audio streams already use are preferred, since
+    they are remuxed instead of re-encoded; MP3 is only chosen when the
+    client accepts nothing else.
+    """
+    if format_type != 'audio':
+        return format_type
+    if not request.accept_mimetypes:
+        # No Accept header means any type is acceptable
+        return 'webm'
+    best = request.accept_mimetypes.best_match(['audio/webm', 'audio/mp4', 'audio/mpeg'])
+    return {'audio/webm': 'webm', 'audio/mp4': 'm4a'}.get(best, 'mp3')
+
+def audio_bitrate(quality):
+    """Transcode bitrate in kbps for an audio quality such as '128' or '192kbps'"""
+    bitrate = _digits(quality)
+    if not bitrate or str(quality).endswith('p'):
+        # A video quality such as the '360p' default
+        return 128
+    return min(max(bitrate, 32), 320)
+
+def audio_plan(format_type, quality, stream):
+    """How an audio download is produced: remuxed from its source or transcoded"""
+    container = AUDIO_CONTAINERS[format_type]
+    source_codec = stream['codecs'][0] if stream.get('codecs') else stream['subtype']
+    if stream['subtype'] == container['source']:
+        # Bitrate 0 means the source's own bitrate
+        return {'path': 'remux', 'codec': 'copy', 'bitrate': 0, 'output_codec': source_codec,
+                'source_itag': stream['itag']}
+    return {'path': 'transcode', 'codec': container['codec'], 'bitrate': audio_bitrate(quality),
+            'output_codec': container['codec'], 'source_itag': stream['itag']}
+
+def download_cache_key(manifest, stream, format_type, quality):
+    """Key of a finished download in the download cache.
+    
+    Audio outputs are keyed by (video ID, source itag, codec, bitrate) so a
+    transcode is reused by every request that would produce the same bytes.
+    """
+    if format_type in AUDIO_CONTAINERS:
+        plan = audio_plan(format_type, quality, stream)
+        return (manifest['id'], stream['itag'], plan['codec'], plan['bitrate'])
+    return (manifest['id'], stream['itag'], 'mp4')
+
+def open_manifest_upstream(url, manifest, stream, range_header):
+    """Open a proxied upstream connection, re-resolving once if the signed URL is rejected"""
+    try:
+        return open_upstream(stream['url'], browser_headers(), range_header, session=http_pool.session)
+    except UpstreamError as e:
+        if e.status_code != 403:
+            raise
+        logger.info(f"Stream URL rejected for {manifest['id']}, re-resolving manifest")
+        manifest_cache.delete(manifest['id'])
+        fresh_manifest = get_manifest(url)
+        fresh_stream = next((s for s in fresh_manifest['streams'] if s['itag'] == stream['itag']), None)
+        if not fresh_stream:
+            raise
+        return open_upstream(fresh_stream['url'], browser_headers(), range_header, session=http_pool.session)
+
+def safe_download_name(title, extension):
+    """Filename for the Content-Disposition header of a download"""
+    safe_filename = title.replace('/', '_').replace('\\', '_').replace('"', '').replace("'", "")
+    if len(safe_filename) > 100:
+        safe_filename = safe_filename[:100]
+    return f"{safe_filename}.{extension}"
+
+def adaptive_tracks(manifest, format_type, quality):
+    """Video-only and audio-only streams to mux for a video quality above what progressive streams offer"""
+    if format_type in AUDIO_CONTAINERS or not MULTI_INPUT:
+        return None
+    return select_adaptive_streams(manifest, quality)
+
+def source_file(url, manifest, stream):
+    """Open a stream's source download in the download cache, starting it if needed.
+    
+    Sources are resumable cache items of their own, so an interrupted
+    download resumes and every output made from the same stream reuses it.
+    """
+    return download_cache.get_or_fill(
+        (manifest['id'], stream['itag'], 'source'), stream['subtype'],
+        lambda path, advance: download_manifest_stream(url, manifest, stream, path, advance),
+        resumable=True)
+
+def produce_muxed(url, manifest, video, audio, output_file, stats=None):
+    """Mux separate video and audio streams into fragmented MP4 without re-encoding.
+    
+    Both tracks are downloaded concurrently into the download cache and
+    ffmpeg reads each of them as it arrives, so the output can be streamed
+    before either download finishes.
+    """
+    sources = [source_file(url, manifest, video), source_file(url, manifest, audio)]
+    try:
+        with open(output_file, 'wb') as output, stage_timer.stage('ffmpeg'):
+            result = transcode_pool.run([source.iter_chunks() for source in sources], mux_args(), output,
+                                        kind='mux')
+    finally:
+        for source in sources:
+            source.close()
+    
+    if stats is not None:
+        stats.update(result)
+
+def produce_clip(url, manifest, streams, output_args, clip, output_file, stats=None):
+    """Cut clip['start']..clip['end'] out of one stream or a video/audio pair.
+    
+    Each stream's index (MP4 sidx or WebM cues) gives the byte offset of its
+    keyframe-aligned segments, so only the initialization data and the
+    segments covering the clip are fetched. Unless the clip is accurate, it
+    starts at the video's last keyframe at or before start so that nothing
+    has to be re-encoded. An accurate clip is re-encoded as a whole, not
+    only the part before its first keyframe.
+    """
+    start = clip['start']
+    end = min(clip['end'], manifest['length']) if manifest.get('length') else clip['end']
+    
+    indexes = []
+    openers = []
+    for stream in streams:
+        open_range = lambda range_header, stream=stream: open_manifest_upstream(url, manifest, stream, range_header)
+        openers.append(open_range)
+        try:
+            indexes.append(read_index(open_range, stream['subtype']))
+        except ClipError as e:
+            logger.warning(f"No usable index for itag {stream['itag']} of {manifest['id']}, "
+                           f"fetching the whole stream: {e}")
+            indexes.append(None)
+    
+    cut_start = start
+    if not clip['accurate'] and streams[0]['type'] == 'video' and indexes[0] is not None:
+        cut_start = keyframe_before(indexes[0], start)
+    
+    sources = [clip_source(open_range, index, cut_start, end) if index else relay(open_range(None))
+               for open_range, index in zip(openers, indexes)]
+    with open(output_file, 'wb') as output, stage_timer.stage('ffmpeg'):
+        result = transcode_pool.run(sources, clip_time_args(cut_start, end) + output_args, output, kind='clip')
+    
+    if stats is not None:
+        stats.update(result)
+
+def produce_audio(url, manifest, stream, format_type, quality, output_file, stats=None):
+    """Remux or transcode an audio stream into output_file while the source is still arriving.
+    
+    ffmpeg reads the source from a pipe and its output is written to
+    output_file as it is produced, so clients tailing the cache item get
+    audio after a second or two instead of after the whole download.
+    """
+    plan = audio_plan(format_type, quality, stream)
+    
+    # A finished source download in the cache is read from disk; otherwise
+    # the upstream response is piped straight into ffmpeg
+    source = download_cache.get((manifest['id'], stream['itag'], 'source'))
+    if source is not None and not source.complete:
+        source.close()
+        source = None
+    
+    try:
+        if source is not None:
+            chunks = source.iter_chunks()
+        else:
+            chunks = relay(open_manifest_upstream(url, manifest, stream, None))
+        with open(output_file, 'wb') as output, stage_timer.stage('ffmpeg'):
+            result = transcode_pool.run([chunks], audio_args(format_type, plan['bitrate'] or None), output,
+                                        kind=plan['path'])
+    finally:
+        if source is not None:
+            source.close()
+    
+    if stats is not None:
+        stats.update(result)
+
+def send_cached_file(cached_file, content_type, download_name):
+    """Build the response for a download cache item.
+    
+    Complete files get Content-Length, ETag, Range/206 and If-Range handling;
+    files still being filled are streamed as they grow.
+    """
+    if not cached_file.complete:
+        response = Response(cached_file.iter_chunks(idle=request.environ.get(IDLE_CHUNKS_ENVIRON, False)),
+                            mimetype=content_type)
+        # Release the cache entry even if the client never reads the body
+        response.call_on_close(cached_file.close)
+    elif SENDFILE_MODE == 'x-accel-redirect':
+        cached_file.close()
+        response = Response(mimetype=content_type)
+        response.headers['X-Accel-Redirect'] = f"{X_ACCEL_PREFIX.rstrip('/')}/{os.path.basename(cached_file.path)}"
+    else:
+        response = send_file(cached_file.path, mimetype=content_type, conditional=True)
+        # send_file holds its own descriptor, which survives eviction on POSIX;
+        # on Windows eviction of an open file fails and is retried later
+        cached_file.close()
+    
+    response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+    return response
+
+def expected_download_size(streams, clip, length):
+    """Bytes a download of streams will write, scaled down to a clip's share of the video"""
+    size = sum(stream.get('filesize') or 0 for stream in streams)
+    if clip and length:
+        size = size * min(1, (clip['end'] - clip['start']) / length)
+    return int(size)
+
+def timing_entries(timings):
+    """Stage timings as JSON-friendly [stage, seconds] pairs"""
+    return [[stage, round(seconds, 4)] for stage, seconds in timings.entries()]
+
+def run_traced_job(job, publish):
+    """Run a download job as a span of the trace that submitted it, profiling it if that request is profiled"""
+    with tracer.span('job', **{'job.id': job['id'], 'job.format': job['format'], 'job.quality': job['quality']}):
+        with profiler.track(tracer.current()):
+            return run_download_job(job, publish)
+
+def run_download_job(job, publish):
+    """Produce a download job's file in the download cache"""
+    url = job['url']
+    format_type = job['format']
+    quality = job['quality']
+    timings = stage_timer.collect()
+    stage_timer.record('queue', job['started_at'] - job['created_at'])
+    
+    try:
+        # Resolve streams (cached per video until the signed URLs expire)
+        manifest = get_manifest(url)
+        
+        # Get file based on format and quality
+        is_audio = format_type in AUDIO_CONTAINERS
+        source_subtype = AUDIO_CONTAINERS[format_type]['source'] if is_audio else None
+        stream = select_stream(manifest, format_type, quality, source_subtype)
+        # Qualities above the best progressive stream come from separate tracks
+        tracks = adaptive_tracks(manifest, format_type, quality)
+        clip = (job['options'] or {}).get('clip')
+        if clip and not is_audio:
+            # Clips are cut from the adaptive streams, whose indexes locate each keyframe
+            tracks = select_adaptive_streams(manifest, quality, only_if_better=False) if MULTI_INPUT else None
+            if not tracks:
+                raise JobError('Clips are not available for this video', 422)
+        if clip and manifest.get('length') and clip['start'] >= manifest['length']:
+            raise JobError('Clip starts after the end of the video', 422)
+        
+        if not stream and not tracks:
+            kind = 'audio' if is_audio else 'video'
+            raise JobError(f'No suitable {kind} stream found', 404)
+        
+        # Finished files are cached by (video, stream, output format); a request
+        # for an item that is still downloading follows the partial file
+        transcode_stats = {}
+        if tracks:
+            video, audio = tracks
+            cache_key = (manifest['id'], video['itag'], 'mux', audio['itag'])
+            producer = lambda path, advance: produce_muxed(url, manifest, video, audio, path, transcode_stats)
+            content_type = 'video/mp4'
+            extension = 'mp4'
+        elif is_audio:
+            cache_key = download_cache_key(manifest, stream, format_type, quality)
+            producer = lambda path, advance: produce_audio(url, manifest, stream, format_type, quality, path,
+                                                           transcode_stats)
+            content_type = AUDIO_CONTAINERS[format_type]['mimetype']
+            extension = format_type
+        else:
+            cache_key = download_cache_key(manifest, stream, format_type, quality)
+            producer = lambda path, advance: download_manifest_stream(url, manifest, stream, path, advance)
+            content_type = 'video/mp4'
+            extension = 'mp4'
+        
+        download_name = safe_download_name(manifest['title'], extension)
+        if clip:
+            streams = list(tracks) if tracks else [stream]
+            if tracks:
+                output_args = mux_args(reencode=clip['accurate'])
+            else:
+                output_args = audio_args(format_type, audio_plan(format_type, quality, stream)['bitrate'] or None)
+            cache_key += ('clip', round(clip['start'] * 1000), round(clip['end'] * 1000), int(clip['accurate']))
+            producer = lambda path, advance: produce_clip(url, manifest, streams, output_args, clip, path,
+                                                          transcode_stats)
+            download_name = safe_download_name(
+                f"{manifest['title']} ({clip['start']:g}-{clip['end']:g}s)", extension)
+        
+        job_producer = producer
+        trace = tracer.current()
+        
+        def producer(path, advance):
+            # Runs on the cache's fill thread; its stages count towards this job
+            stage_timer.attach(timings)
+            tracer.attach(trace)
+            with profiler.track(trace):
+                job_producer(path, advance)
+        
+        # Nothing new is written when the item is cached or another job is producing it
+        expected_size = 0
+        if not download_cache.contains(cache_key):
+            expected_size = expected_download_size([video, audio] if tracks else [stream], clip,
+                                                   manifest.get('length'))
+        with disk_budget.reserve(expected_size):
+            cached_file = download_cache.get_or_fill(cache_key, extension, producer,
+                                                     resumable=not is_audio and not tracks and not clip)
+            
+            try:
+                # Surface download errors before anyone attaches to the output
+                cached_file.wait_started()
+                
+                result = {
+                    'cache_key': list(cache_key),
+                    'content_type': content_type,
+                    'download_name': download_name
+                }
+                if clip:
+                    result['clip'] = clip
+                if tracks:
+                    result['video'] = {'path': 'mux', 'resolution': video['resolution'],
+                                       'video_itag': video['itag'], 'audio_itag': audio['itag']}
+                elif is_audio:
+                    result['audio'] = audio_plan(format_type, quality, stream)
+                result['timings'] = timing_entries(timings)
+                publish(result)
+                
+                cached_file.wait_complete()
+                if transcode_stats:
+                    # Only set when this job ran ffmpeg, not when it joined another's output
+                    result['transcode'] = transcode_stats
+                result['timings'] = timing_entries(timings)
+                return result
+            finally:
+                cached_file.close()
+    
+    except InsufficientDisk as e:
+        raise JobError(str(e), 503)
+    except TranscodeError as e:
+        raise JobError(f"Conversion failed: {str(e)}", 500)
+    except ClipError as e:
+        raise JobError(f"Clip failed: {str(e)}", 422)
+    except UpstreamError as e:
+        raise JobError(f"Download failed: {str(e)}", 502)
+    except (exceptions.PytubeError, HTTPError) as e:
+        logger.exception(f"Pytube error: {str(e)}")
+        raise JobError(f"Download failed: {str(e)}", 500)
+
+def job_file_available(result):
+    """Whether a completed job's file is still in the download cache"""
+    return bool(result) and download_cache.contains(tuple(result['cache_key']))
+
+def job_view(job):
+    """Public representation of a job"""
+    view = {key: job[key] for key in ('id', 'url', 'video_id', 'format', 'quality', 'priority', 'group_id',
+                                      'state', 'error', 'created_at', 'started_at', 'finished_at')}
+    if job['result'] and job['state'] in ('running', 'completed'):
+        view['file_url'] = f"/api/jobs/{job['id']}/file"
+        if 'transcode' in job['result']:
+            view['transcode'] = job['result']['transcode']
+        if 'timings' in job['result']:
+            # Seconds per stage, summed over stages that ran more than once
+            view['timings'] = {}
+            for stage, seconds in job['result']['timings']:
+                view['timings'][stage] = round(view['timings'].get(stage, 0) + seconds, 4)
+    if job['options'] and 'clip' in job['options']:
+        view['clip'] = job['options']['clip']
+    return view
+
+def send_job_file(job):
+    """Respond with a job's output, following it while it is still being produced"""
+    if job['state'] == 'failed':
+        response = jsonify({'error': job['error']})
+        response.status_code = job['error_status'] or 500
+        if response.status_code == 503:
+            # Out of disk space; some should be freed once the running downloads finish
+            response.headers['Retry-After'] = str(max(1, math.ceil(job_queue.estimate_wait())))
+        return response
+    if job['state'] == 'cancelled' or not job['result']:
+        return jsonify({'error': f"Job is {job['state']}", 'job': job_view(job)}), 409
+    
+    result = job['result']
+    cached_file = download_cache.get(tuple(result['cache_key']))
+    if cached_file is None:
+        return jsonify({'error': 'File is no longer available'}), 410
+    
+    response = send_cached_file(cached_file, result['content_type'], result['download_name'])
+    if 'audio' in result:
+        # Lets clients and dashboards tell cheap remuxes from CPU-bound transcodes
+        audio = result['audio']
+        response.headers['X-Audio-Path'] = audio['path']
+        response.headers['X-Audio-Codec'] = audio['output_codec']
+        response.headers['X-Audio-Source-Itag'] = str(audio['source_itag'])
+        if audio['bitrate']:
+            response.headers['X-Audio-Bitrate'] = f"{audio['bitrate']}k"
+    if 'video' in result:
+        response.headers['X-Video-Path'] = result['video']['path']
+        response.headers['X-Video-Resolution'] = result['video']['resolution']
+    logger.info(f"Streaming download started for {result['download_name']}")
+    return response
+
+def archive_entries(items):
+    """Fetch archive items through the job queue, in order, with the next few queued ahead.
+    
+    Yields the entries stream_zip() expects: each carries its cached file's
+    chunks, or the error that kept it out of the archive.
+    """
+    upcoming = iter(items)
+    pending = deque()
+    
+    def queue_next():
+        item = next(upcoming, None)
+        if item is None:
+            return
+        job = None
+        if not item.get('error'):
+            try:
+                job, _ = job_queue.submit(item['url'], extract_video_id(item['url']), item['format'],
+                                          item['quality'], priority=SYNC_JOB_PRIORITY)
+            except Exception as e:
+                logger.exception("Error queueing archive item")
+                item['error'] = str(e)
+        pending.append((item, job))
+    
+    for _ in range(ARCHIVE_PREFETCH + 1):
+        queue_next()
+    
+    while pending:
+        entry, job = pending.popleft()
+        queue_next()
+        if job is not None:
+            job = job_queue.wait_ready(job['id'])
+            entry['job_id'] = job['id']
+            if job['state'] in ('failed', 'cancelled') or not job['result']:
+                entry['error'] = job['error'] or f"Job is {job['state']}"
+            else:
+                cached_file = download_cache.get(tuple(job['result']['cache_key']))
+                if cached_file is None:
+                    entry['error'] = 'File is no longer available'
+                else:
+                    entry['name'] = job['result']['download_name']
+                    entry['chunks'] = cached_file.iter_chunks()
+        yield entry
+
+def event_stream(events, sse):
+    """Encode (event, payload) pairs as NDJSON lines or as server-sent events"""
+    for event, payload in events:
+        if sse:
+            yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+        else:
+            yield json.dumps({'type': event, **payload}) + '\n'
+
+def collection_events(collection, entries, summary=None):
+    """Wrap a playlist's entry events with its details first and a count or error last.
+    
+    summary is a dict merged into the last event; entries may fill it in as they are produced.
+    """
+    yield 'playlist', describe_collection(collection)
+    count = 0
+    try:
+        for entry in entries:
+            count += 1
+            yield 'entry', entry
+    except Exception as e:
+        logger.exception("Error while paging through playlist")
+        yield 'error', {'error': str(e), 'count': count, **(summary or {})}
+        return
+    yield 'end', {'count': count, **(summary or {})}
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.monotonic()
+    g.timings = stage_timer.collect()
+    profiled = profiler.should_profile() or (request.headers.get('X-Profile') == '1' and admin_authorized())
+    g.trace = tracer.start(request.headers.get(TRACEPARENT_HEADER), profiled=profiled)
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.request_span = tracer.start_span(f"{request.method} {endpoint}", KIND_SERVER,
+                                       {'http.request.method': request.method, 'url.path': request.path,
+                                        'http.route': endpoint})
+    if profiled:
+        g.profile_token = profiler.begin(g.trace.trace_id, f"{request.method} {request.full_path}")
+
+@app.teardown_request
+def stop_request_profiling(exc):
+    # Ends on the thread that ran the view; streamed bodies are profiled chunk by chunk
+    if 'profile_token' in g:
+        profiler.end(g.pop('profile_token'))
+
+@app.after_request
+def record_request_metrics(response):
+    """Count and time the request, and report its stages in Server-Timing"""
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    started = g.request_started
+    headers_sent = time.monotonic() - started
+    request_count.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    response.headers['Server-Timing'] = server_timing(g.timings.entries() + [('total', headers_sent)])
+    response.headers['X-Trace-Id'] = g.trace.trace_id
+    request_span = g.request_span
+    if request_span:
+        request_span.set('http.response.status_code', response.status_code)
+    
+    streamed = response.is_streamed and not response.direct_passthrough
+    if streamed:
+        response.response = count_client_bytes(response.response, endpoint)
+        if g.trace.profiled:
+            response.response = profile_chunks(response.response, g.trace)
+    
+    def finish():
+        elapsed = time.monotonic() - started
+        request_seconds.observe(elapsed, endpoint=endpoint)
+        if response.is_streamed:
+            stage_timer.record('send', elapsed - headers_sent)
+        if not streamed:
+            client_bytes.inc(response.content_length or 0, endpoint=endpoint)
+        tracer.end_span(request_span)
+        tracer.attach(None)
+    
+    if response.direct_passthrough and hasattr(response.response, 'close'):
+        # Passed straight to the server (a file wrapper, possibly for sendfile),
+        # which only closes the wrapper itself
+        close_file = response.response.close
+        
+        def close():
+            try:
+                close_file()
+            finally:
+                finish()
+        
+        response.response.close = close
+    else:
+        response.call_on_close(finish)
+    return response
+
+def count_client_bytes(chunks, endpoint):
+    """Pass a response body through, counting the bytes sent"""
+    try:
+        for chunk in chunks:
+            client_bytes.inc(len(chunk), endpoint=endpoint)
+            yield chunk
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+
+def profile_chunks(chunks, trace):
+    """Pass a response body through, profiling whichever thread produces each chunk"""
+    iterator = iter(chunks)
+    try:
+        while True:
+            with profiler.track(trace):
+                chunk = next(iterator, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+
+def admin_authorized():
+    """Whether the current request carries the admin token"""
+    if not ADMIN_TOKEN:
+        return False
+    supplied = request.headers.get('Authorization', '').encode('utf-8')
+    return hmac.compare_digest(supplied, f"Bearer {ADMIN_TOKEN}".encode('utf-8'))
+
+def admin_denied():
+    """Return a 404 response while admin endpoints are off, 401 without the admin token, else None"""
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Not found'}), 404
+    if not admin_authorized():
+        return jsonify({'error': 'Unauthorized'}), 401
+    return None
+
+def admit(cost=1, queued=True, jobs=1):
+    """Return a 429/503 response if the current request may not start a download now, else None.
+    
+    jobs is how many jobs the request keeps queued or running at once.
+    """
+    admitted = g.get('admitted')
+    if admitted == 'queued' or (admitted and not queued):
+        # Already admitted by the endpoint that handed the request on
+        return None
+    # A request already charged for its rate is only checked for room in the queue now
+    rejection = admission.check(request.remote_addr, 0 if admitted else cost, queued, jobs)
+    if rejection is None:
+        g.admitted = 'queued' if queued else 'rate'
+        return None
+    response = jsonify({'error': rejection.message, 'retry_after': rejection.retry_after})
+    response.status_code = rejection.status
+    response.headers['Retry-After'] = str(rejection.retry_after)
+    return response
+
+def playlist_limit(value):
+    """Number of playlist entries to process for a requested limit"""
+    limit = int(value) if value else PLAYLIST_MAX_VIDEOS
+    return max(1, min(limit, PLAYLIST_MAX_VIDEOS))
+
+def open_collection_or_error(url):
+    """Return (collection, None) for a playlist or channel URL, or (None, 400 response) if it cannot be listed"""
+    try:
+        return open_collection(url), None
+    except (exceptions.PytubeError, HTTPError) as e:
+        logger.warning(f"Could not open playlist or channel {url}: {e}")
+        return None, (jsonify({'error': f"Could not open playlist or channel: {str(e)}"}), 400)
+
+def clip_options(args):
+    """Job options for a clip requested with start/end (and accurate), or None for the whole video"""
+    if args.get('start') in (None, '') and args.get('end') in (None, ''):
+        return None
+    if args.get('end') in (None, ''):
+        raise ValueError("end is required for a clip")
+    start = parse_time(args.get('start') or 0)
+    end = parse_time(args.get('end'))
+    if not (math.isfinite(start) and math.isfinite(end)):
+        raise ValueError("Times are too large")
+    if not 0 <= start < end:
+        raise ValueError("end must be after start")
+    accurate = str(args.get('accurate', '')).lower() in ('1', 'true', 'yes')
+    if accurate and CLIP_ACCURATE_MAX_SECONDS and end - start > CLIP_ACCURATE_MAX_SECONDS:
+        raise ValueError(f"accurate clips can be at most {CLIP_ACCURATE_MAX_SECONDS:g} seconds long")
+    return {'clip': {'start': start, 'end': end, 'accurate': accurate}}
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -132,9 +1107,166 @@ def health_check():
         'status': 'ok',
         'version': '1.0.0',
         'python_backend': True,
-        'library': 'pytube'
+        'library': 'pytube',
+        'cache': {
+            'metadata': metadata_cache.stats(),
+            'manifest': manifest_cache.stats(),
+            'cipher': cipher_cache.stats(),
+            'downloads': download_cache.stats(),
+            'thumbnails': thumbnail_cache.stats()
+        },
+        'downloader': segmented_downloader.stats(),
+        'http': http_pool.stats(),
+        'transcode': transcode_pool.stats(),
+        'extractor': {
+            'pytube_breaker': pytube_breaker.stats(),
+            'hedging': info_hedger.stats()
+        },
+        'jobs': job_queue.stats(),
+        'admission': admission.stats(),
+        'janitor': janitor.stats(),
+        'tracing': tracer.stats(),
+        'profiler': profiler.stats(),
+        'warmup': warmup.stats()
     })
 
+# /api/health/live answers while the process can serve requests at all, for
+# restarting it when it cannot. /api/health/ready answers 503 while warm-up
+# runs, ffmpeg is missing, DOWNLOAD_DIR or the download cache's disk is short
+# of MIN_FREE_DISK_BYTES, or ADMISSION_MAX_PENDING jobs are queued or running,
+# so load balancers only route to instances that can take the work.
+@app.route('/api/health/live', methods=['GET'])
+def liveness_check():
+    return jsonify({'status': 'alive'})
+
+def readiness_checks():
+    """Each readiness check as a dict with 'ok' and what it looked at"""
+    free_bytes = shutil.disk_usage(DOWNLOAD_DIR).free
+    ffmpeg = shutil.which(transcode_pool.ffmpeg)
+    pending = job_queue.pending()
+    return {
+        'warmup': dict(warmup.stats(), ok=warmup.done.is_set()),
+        'ffmpeg': {'ok': ffmpeg is not None, 'path': ffmpeg},
+        'download_dir': {'ok': free_bytes >= MIN_FREE_DISK_BYTES and os.access(DOWNLOAD_DIR, os.W_OK),
+                         'free_bytes': free_bytes, 'min_free_bytes': MIN_FREE_DISK_BYTES},
+        'download_cache': dict(disk_budget.stats(), ok=disk_budget.has_room()),
+        'queue': {'ok': pending < ADMISSION_MAX_PENDING, 'pending': pending, 'max_pending': ADMISSION_MAX_PENDING}
+    }
+
+@app.route('/api/health/ready', methods=['GET'])
+def readiness_check():
+    checks = readiness_checks()
+    ready = all(check['ok'] for check in checks.values())
+    return jsonify({'status': 'ready' if ready else 'not ready', 'checks': checks}), 200 if ready else 503
+
+def component_metrics():
+    """Metrics read from the stats() of the pools, caches and queues at scrape time"""
+    http = http_pool.stats()
+    jobs = job_queue.stats()
+    transcode = transcode_pool.stats()
+    downloads = download_cache.stats()
+    disk = disk_budget.stats()
+    # Shared caches count the lookups that missed locally and went to the shared tier
+    caches = {'metadata': metadata_cache.stats(), 'manifest': manifest_cache.stats(), 'cipher': cipher_cache.stats(),
+              'downloads': downloads, 'thumbnails': thumbnail_cache.stats()}
+    lookups = {'hits': [], 'misses': []}
+    for name, stats in caches.items():
+        for outcome, samples in lookups.items():
+            samples.append(('', [('cache', name), ('tier', 'local')], stats[outcome]))
+            if 'far' in stats:
+                samples.append(('', [('cache', name), ('tier', 'shared')], stats['far'][outcome]))
+    families = [
+        ('ytdl_cache_hits_total', 'counter', 'Cache lookups answered, by cache and tier', lookups['hits']),
+        ('ytdl_cache_misses_total', 'counter', 'Cache lookups not answered, by cache and tier', lookups['misses']),
+        ('ytdl_upstream_bytes_total', 'counter', 'Response body bytes received from upstream hosts',
+         [('', [('host', host)], counters['bytes']) for host, counters in http['hosts'].items()]),
+        ('ytdl_upstream_requests_total', 'counter', 'Requests sent to upstream hosts',
+         [('', [('host', host)], counters['requests']) for host, counters in http['hosts'].items()]),
+        ('ytdl_upstream_handshakes_total', 'counter', 'New connections opened to upstream hosts',
+         [('', [('host', host)], counters['handshakes']) for host, counters in http['hosts'].items()]),
+        ('ytdl_download_recent_bytes_per_second', 'gauge', 'Throughput of the most recent segmented downloads',
+         [('', [], segmented_downloader.stats()['recent_mb_per_s'] * 1024 * 1024)]),
+        ('ytdl_active_downloads', 'gauge', 'Download cache items being written',
+         [('', [], downloads['filling'])]),
+        ('ytdl_jobs_running', 'gauge', 'Download jobs running', [('', [], jobs['busy_workers'])]),
+        ('ytdl_jobs_queued', 'gauge', 'Download jobs waiting for a worker', [('', [], jobs['queue_depth'])]),
+        ('ytdl_disk_bytes', 'gauge', 'Bytes on disk by use',
+         [('', [('area', 'downloads')], downloads['bytes']),
+          ('', [('area', 'partial')], download_cache.partial_bytes()),
+          ('', [('area', 'thumbnails')], thumbnail_cache.stats()['bytes']),
+          ('', [('area', 'temp')], janitor.temp_bytes()),
+          ('', [('area', 'reserved')], disk['reserved_bytes'])]),
+        ('ytdl_disk_free_bytes', 'gauge', 'Free space on the download cache disk', [('', [], disk['free_bytes'])]),
+        ('ytdl_ffmpeg_processes', 'gauge', 'ffmpeg processes running', [('', [], transcode['active'])]),
+        ('ytdl_ffmpeg_max_processes', 'gauge', 'ffmpeg processes allowed at once',
+         [('', [], transcode['max_processes'])]),
+        ('ytdl_ffmpeg_runs_total', 'counter', 'Completed ffmpeg runs by kind',
+         [('', [('kind', kind)], totals['runs']) for kind, totals in transcode['by_kind'].items()]),
+        ('ytdl_ffmpeg_cpu_seconds_total', 'counter', 'CPU time used by ffmpeg by kind',
+         [('', [('kind', kind)], totals['cpu_seconds']) for kind, totals in transcode['by_kind'].items()]),
+        ('ytdl_ffmpeg_failures_total', 'counter', 'Failed ffmpeg runs', [('', [], transcode['failures'])]),
+        ('ytdl_pytube_breaker_open', 'gauge', 'Whether pytube is being skipped by its circuit breaker',
+         [('', [], int(pytube_breaker.stats()['state'] == 'open'))])
+    ]
+    return ''.join(render_family(*family) for family in families)
+
+metrics.add_collector(component_metrics)
+
+@app.route('/api/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Metrics in the Prometheus text format"""
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/api/admin/profiling', methods=['GET', 'POST'])
+def profiling_settings():
+    """Show or change the fraction of requests profiled (POST {"sample_rate": 0.05}, optionally "reset": true)"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or request.form
+        if 'sample_rate' in data:
+            try:
+                sample_rate = float(data['sample_rate'])
+            except (TypeError, ValueError):
+                return jsonify({'error': 'sample_rate must be a number'}), 400
+            if not 0 <= sample_rate <= 1:
+                return jsonify({'error': 'sample_rate must be between 0 and 1'}), 400
+            profiler.sample_rate = sample_rate
+            logger.info(f"Profiling sample rate set to {sample_rate}")
+        if str(data.get('reset', '')).lower() in ('1', 'true', 'yes'):
+            profiler.reset()
+    return jsonify({'profiler': profiler.stats(), 'traces': profiler.traces()})
+
+@app.route('/api/admin/profile', methods=['GET'])
+def profile_stacks():
+    """Sampled stacks of the profiled requests, or of one (trace_id), in collapsed stack format or as JSON"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    trace_id = request.args.get('trace_id')
+    if request.args.get('format') == 'json':
+        stacks = profiler.stacks(trace_id)
+        if stacks is None:
+            return jsonify({'error': 'Trace not found'}), 404
+        return jsonify({'trace_id': trace_id, 'samples': sum(stacks.values()),
+                        'stacks': [{'stack': stack, 'count': count} for stack, count in stacks.most_common()]})
+    collapsed = profiler.collapsed(trace_id)
+    if collapsed is None:
+        return jsonify({'error': 'Trace not found'}), 404
+    return Response(collapsed, content_type='text/plain; charset=utf-8')
+
+@app.route('/api/admin/traces/<trace_id>', methods=['GET'])
+def trace_spans(trace_id):
+    """Recorded spans of a trace that are still buffered, in the OTLP JSON encoding"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    spans = tracer.spans(trace_id.lower())
+    if not spans:
+        return jsonify({'error': 'Trace not found'}), 404
+    return jsonify({'trace_id': trace_id.lower(), 'spans': spans})
+
 @app.route('/api/video/info', methods=['GET'])
 def video_info():
     """Get video information"""
@@ -146,182 +1278,396 @@ def video_info():
     logger.info(f"Processing URL: {url}")
     
     try:
-        # Attempt to get info with pytube
-        yt = initialize_youtube(url)
-        
-        # Format response for our frontend
-        formats = [
-            {"value": "mp4-720p", "label": "MP4 720p", "size": "Variable", "quality": "720p"},
-            {"value": "mp4-360p", "label": "MP4 360p", "size": "Variable", "quality": "360p"},
-            {"value": "mp3-128", "label": "MP3 Audio", "size": "Variable", "quality": "128"}
-        ]
-        
-        response_data = {
-            "id": extract_video_id(url),
-            "title": yt.title,
-            "author": yt.author,
-            "thumbnail": yt.thumbnail_url,
-            "duration": format_duration(yt.length),
-            "views": format_views(yt.views),
-            "formats": formats
-        }
-        
-        return jsonify(response_data)
+        return jsonify(present_info(get_video_info(url), request.host_url))
         
     except (exceptions.PytubeError, HTTPError) as e:
-        logger.exception(f"Pytube error: {str(e)}")
-        
+        return jsonify({"error": f"Could not fetch video info: {str(e)}"}), 500
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def produce_thumbnail(video_id, width, output_file):
+    """Write a video's thumbnail, resized to width unless it is 0, to output_file"""
+    if not width:
+        name = fetch_thumbnail(http_pool.session, video_id, output_file, {'Referer': 'https://www.youtube.com/'})
+        logger.info(f"Fetched {name} thumbnail for {video_id}")
+        return
+    # Variants are made from the full-size thumbnail, which is cached too
+    original = thumbnail_cache.get_or_fill((video_id, 'thumbnail', 0), 'jpg',
+                                           lambda path, advance: produce_thumbnail(video_id, 0, path))
+    try:
+        original.wait_complete()
+        with open(original.path, 'rb') as f:
+            data = f.read()
+    finally:
+        original.close()
+    with open(output_file, 'wb') as output:
+        transcode_pool.run([[data]], resize_args(width), output, kind='thumbnail')
+
+@app.route('/api/thumbnail/<video_id>', methods=['GET'])
+def thumbnail(video_id):
+    """Serve the best available thumbnail for a video, optionally resized with ?w=<width>"""
+    if not is_video_id(video_id):
+        return jsonify({'error': 'Invalid video ID'}), 400
+    try:
+        width = int(request.args.get('w', 0))
+    except ValueError:
+        width = -1
+    if width and width not in VARIANT_WIDTHS:
+        return jsonify({'error': f"w must be one of {', '.join(map(str, VARIANT_WIDTHS))}"}), 400
+    
+    try:
+        cached_file = thumbnail_cache.get_or_fill((video_id, 'thumbnail', width), 'jpg',
+                                                  lambda path, advance: produce_thumbnail(video_id, width, path))
         try:
-            # Use fallback method
-            logger.info("Using fallback method to get video info")
-            fallback_data = get_video_info_fallback(url)
-            return jsonify(fallback_data)
-        except Exception as fallback_error:
-            logger.exception(f"Fallback also failed: {str(fallback_error)}")
-            return jsonify({"error": f"Could not fetch video info: {str(e)}"}), 500
+            cached_file.wait_complete()
+            with open(cached_file.path, 'rb') as f:
+                data = f.read()
+        finally:
+            cached_file.close()
+    except ThumbnailNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except TranscodeError as e:
+        logger.error(f"Resizing thumbnail of {video_id} failed: {str(e)}")
+        return jsonify({'error': f"Resizing failed: {str(e)}"}), 500
+    except requests.RequestException as e:
+        logger.error(f"Fetching thumbnail of {video_id} failed: {str(e)}")
+        return jsonify({'error': f"Could not fetch thumbnail: {str(e)}"}), 502
     
-    except Exception as e:
-        logger.exception("Error fetching video info")
+    response = Response(data, mimetype='image/jpeg')
+    response.set_etag(content_etag(data))
+    response.headers['Cache-Control'] = f'public, max-age={THUMBNAIL_MAX_AGE}'
+    return response.make_conditional(request)
+
+@app.route('/api/video/info/batch', methods=['POST'])
+def video_info_batch():
+    """Get information for many videos, streamed as NDJSON in the order they resolve"""
+    data = request.get_json(silent=True) or {}
+    urls = data.get('urls')
+    
+    if not isinstance(urls, list) or not urls:
+        return jsonify({'error': 'urls must be a non-empty list'}), 400
+    if len(urls) > INFO_BATCH_MAX_URLS:
+        return jsonify({'error': f'At most {INFO_BATCH_MAX_URLS} URLs per batch'}), 413
+    
+    # Group the submitted URLs by video ID so each video is resolved once
+    by_id = {}
+    invalid = []
+    for index, url in enumerate(urls):
+        video_id = extract_video_id(url) if isinstance(url, str) else None
+        if video_id:
+            by_id.setdefault(video_id, []).append(index)
+        else:
+            invalid.append(index)
+    
+    logger.info(f"Batch info request - {len(urls)} URLs, {len(by_id)} videos")
+    
+    host_url = request.host_url
+    
+    def resolve(video_id):
+        return present_info(get_video_info(f"https://www.youtube.com/watch?v={video_id}"), host_url)
+    
+    def generate():
+        for index in invalid:
+            yield json.dumps({'indices': [index], 'url': urls[index],
+                              'error': 'Could not extract video ID from URL', 'status': 400}) + '\n'
         
-        # Try fallback method
+        futures = {info_batch_executor.submit(resolve, video_id): video_id for video_id in by_id}
         try:
-            logger.info("Using fallback method after general error")
-            fallback_data = get_video_info_fallback(url)
-            return jsonify(fallback_data)
-        except Exception as fallback_error:
-            logger.exception(f"Fallback also failed: {str(fallback_error)}")
-            return jsonify({"error": str(e)}), 500
+            for future in as_completed(futures):
+                video_id = futures[future]
+                line = {'id': video_id, 'indices': by_id[video_id]}
+                try:
+                    line['data'] = future.result()
+                except (exceptions.PytubeError, HTTPError) as e:
+                    line.update(error=f"Could not fetch video info: {str(e)}", status=500)
+                except Exception as e:
+                    line.update(error=str(e), status=500)
+                yield json.dumps(line) + '\n'
+        finally:
+            # The client went away; don't resolve videos nobody will read
+            for future in futures:
+                future.cancel()
+    
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/api/playlist', methods=['GET'])
+def playlist_info():
+    """Stream the videos of a playlist or channel as NDJSON, or as server-sent events"""
+    url = request.args.get('url')
+    
+    if not url:
+        return jsonify({'error': 'URL is required'}), 400
+    if not collection_kind(url):
+        return jsonify({'error': 'URL is not a playlist or channel'}), 400
+    try:
+        limit = playlist_limit(request.args.get('limit'))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    
+    with_info = request.args.get('info', '1') != '0'
+    sse = request.args.get('stream') == 'sse' or 'text/event-stream' in request.headers.get('Accept', '')
+    logger.info(f"Playlist request - URL: {url}, Limit: {limit}, Info: {with_info}")
+    
+    collection, error = open_collection_or_error(url)
+    if error:
+        return error
+    host_url = request.host_url
+    
+    def entries():
+        listed = iter_entries(collection, limit)
+        if not with_info:
+            yield from listed
+            return
+        # Metadata is resolved a few entries ahead of the one being sent
+        resolved = resolve_windowed(info_batch_executor, listed,
+                                    lambda entry: present_info(get_video_info(entry['url']), host_url),
+                                    INFO_BATCH_CONCURRENCY)
+        for entry, future in resolved:
+            try:
+                entry['data'] = future.result()
+            except (exceptions.PytubeError, HTTPError) as e:
+                entry.update(error=f"Could not fetch video info: {str(e)}", status=500)
+            except Exception as e:
+                entry.update(error=str(e), status=500)
+            yield entry
+    
+    return Response(event_stream(collection_events(collection, entries()), sse),
+                    mimetype='text/event-stream' if sse else 'application/x-ndjson')
+
+@app.route('/api/playlist/jobs', methods=['POST'])
+def playlist_jobs():
+    """Queue download jobs for every video of a playlist or channel, streaming each job as it is queued"""
+    data = request.get_json(silent=True) or request.form
+    url = data.get('url')
+    format_type = negotiate_audio_format(data.get('format', 'mp4'))
+    quality = data.get('quality', '360p')
+    
+    if not url:
+        return jsonify({'error': 'URL is required'}), 400
+    if not collection_kind(url):
+        return jsonify({'error': 'URL is not a playlist or channel'}), 400
+    try:
+        limit = playlist_limit(data.get('limit'))
+        priority = int(data.get('priority', 0))
+        concurrency = int(data.get('concurrency', PLAYLIST_JOB_CONCURRENCY))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'limit, priority and concurrency must be integers'}), 400
+    concurrency = max(1, min(concurrency, PLAYLIST_JOB_CONCURRENCY))
+    # Opened first so a URL that cannot be listed is not charged for
+    collection, error = open_collection_or_error(url)
+    if error:
+        return error
+    # Admitted with room for one job; the rest are queued only while the queue has room
+    rejection = admit(cost=limit)
+    if rejection:
+        return rejection
+    
+    # The playlist's jobs share a group so that only `concurrency` of them run at once
+    group_id = uuid.uuid4().hex
+    logger.info(f"Playlist jobs request - URL: {url}, Group: {group_id}, Concurrency: {concurrency}")
+    
+    summary = {}
+    
+    def entries():
+        for entry in iter_entries(collection, limit):
+            if job_queue.pending() >= ADMISSION_MAX_PENDING:
+                # The client can post the playlist again later; jobs already queued are deduplicated
+                logger.warning(f"Queue is full, stopped queueing playlist jobs of group {group_id}")
+                summary.update(truncated=True, retry_after=math.ceil(job_queue.estimate_wait(1)))
+                return
+            job, created = job_queue.submit(entry['url'], entry['id'], format_type, quality, priority,
+                                            group_id=group_id, group_limit=concurrency)
+            entry.update(job=job_view(job), created=created)
+            yield entry
+    
+    return Response(event_stream(collection_events(collection, entries(), summary), sse=False),
+                    mimetype='application/x-ndjson', headers={'X-Job-Group': group_id})
+
+@app.route('/api/archive', methods=['POST'])
+def download_archive():
+    """Download several videos as one ZIP, streamed while the items are still downloading"""
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'items must be a non-empty list'}), 400
+    if len(items) > ARCHIVE_MAX_ITEMS:
+        return jsonify({'error': f'At most {ARCHIVE_MAX_ITEMS} items per archive'}), 413
+    
+    # Resolved here, while the request's Accept header is still available
+    entries = []
+    for index, item in enumerate(items):
+        item = item if isinstance(item, dict) else {}
+        entry = {
+            'index': index,
+            'url': item.get('url'),
+            'format': negotiate_audio_format(item.get('format', 'mp4')),
+            'quality': item.get('quality', '360p')
+        }
+        if not entry['url']:
+            entry['error'] = 'URL is required'
+        entries.append(entry)
+    
+    # Items are queued a few at a time while the archive is written, not all at once
+    rejection = admit(cost=len(entries), jobs=min(len(entries), ARCHIVE_PREFETCH + 1))
+    if rejection:
+        return rejection
+    
+    archive_name = safe_download_name(data.get('name') or 'youtube-downloads', 'zip')
+    logger.info(f"Archive request - {len(entries)} items as {archive_name}")
+    
+    response = Response(stream_zip(archive_entries(entries)), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="{archive_name}"'
+    return response
 
 @app.route('/api/video/download', methods=['GET'])
 def download_video():
     """Download video endpoint using Pytube with improved error handling"""
     url = request.args.get('url')
-    format_type = request.args.get('format', 'mp4')
+    format_type = negotiate_audio_format(request.args.get('format', 'mp4'))
     quality = request.args.get('quality', '360p')
     
     if not url:
         return jsonify({'error': 'URL is required'}), 400
+    try:
+        options = clip_options(request.args)
+    except ValueError as e:
+        return jsonify({'error': f"Invalid clip: {e}"}), 400
+    rejection = admit()
+    if rejection:
+        return rejection
     
     logger.info(f"Download request - URL: {url}, Format: {format_type}, Quality: {quality}")
     
     try:
-        # Create a unique download directory for this request
-        request_id = str(uuid.uuid4())
-        temp_dir = os.path.join(DOWNLOAD_DIR, request_id)
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        # Initialize YouTube object with proper headers
-        yt = initialize_youtube(url)
+        # Run the download as a high priority job and stream its output as
+        # soon as the job starts producing it
+        job, _ = job_queue.submit(url, extract_video_id(url), format_type, quality,
+                                  priority=SYNC_JOB_PRIORITY, options=options)
+        job = job_queue.wait_ready(job['id'])
+        if job['result'] and 'timings' in job['result']:
+            # The job's stages so far, run on a worker on this request's behalf
+            g.timings.extend(job['result']['timings'])
+        return send_job_file(job)
+    
+    except Exception as e:
+        logger.exception("Error during download")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/video/stream', methods=['GET'])
+def stream_video():
+    """Relay a stream from upstream to the client as it arrives, without touching disk"""
+    url = request.args.get('url')
+    format_type = request.args.get('format', 'mp4')
+    quality = request.args.get('quality', '360p')
+    
+    if not url:
+        return jsonify({'error': 'URL is required'}), 400
+    
+    # Audio is remuxed or converted and clips are cut, which only the download endpoint does
+    if format_type in AUDIO_CONTAINERS or format_type == 'audio' or 'start' in request.args or 'end' in request.args:
+        return download_video()
+    rejection = admit(queued=False)
+    if rejection:
+        return rejection
+    
+    logger.info(f"Proxy request - URL: {url}, Quality: {quality}")
+    
+    try:
+        manifest = get_manifest(url)
+        # Separate video and audio tracks have to be muxed by the download endpoint
+        if adaptive_tracks(manifest, format_type, quality):
+            return download_video()
         
-        # Get file based on format and quality
-        output_file = None
-        is_audio = format_type == 'mp3'
+        stream = select_stream(manifest, format_type, quality)
+        if not stream:
+            return jsonify({'error': 'No suitable video stream found'}), 404
         
-        if is_audio:
-            # For audio we get the audio stream
-            audio_stream = yt.streams.filter(only_audio=True).order_by('abr').desc().first()
-            if not audio_stream:
-                return jsonify({'error': 'No suitable audio stream found'}), 404
-            
-            # Download the audio file
-            output_file = audio_stream.download(output_path=temp_dir)
-            
-            # Convert to MP3 if needed (requires ffmpeg)
-            base, _ = os.path.splitext(output_file)
-            mp3_file = f"{base}.mp3"
-            
-            try:
-                # Try using FFmpeg if available
-                import subprocess
-                subprocess.call(['ffmpeg', '-y', '-i', output_file, '-vn', '-ar', '44100', 
-                                 '-ac', '2', '-b:a', f'{quality}k', mp3_file])
-                os.remove(output_file)  # Remove the original file
-                output_file = mp3_file
-            except Exception as e:
-                logger.warning(f"Couldn't convert to MP3: {e} - sending original format")
-                # Just rename the file to .mp3
-                os.rename(output_file, mp3_file)
-                output_file = mp3_file
-                
-            # Set content type for response
-            content_type = 'audio/mpeg'
-        else:
-            # For video, select appropriate stream based on quality
-            # First try progressive streams (include both video and audio)
-            video_stream = None
-            progressive_streams = yt.streams.filter(progressive=True, file_extension='mp4')
-            
-            # Try to match requested quality or get the closest one
-            if quality == '1080p':
-                video_stream = progressive_streams.filter(resolution='1080p').first()
-                if not video_stream:
-                    video_stream = progressive_streams.order_by('resolution').desc().first()
-            elif quality == '720p':
-                video_stream = progressive_streams.filter(resolution='720p').first()
-                if not video_stream:
-                    video_stream = progressive_streams.order_by('resolution').desc().first()
-            else:
-                # For 480p/360p or other qualities
-                video_stream = progressive_streams.filter(resolution='360p').first()
-                if not video_stream:
-                    video_stream = progressive_streams.order_by('resolution').asc().first()
-            
-            # If no stream found, try any video stream as fallback
-            if not video_stream:
-                video_stream = yt.streams.filter(file_extension='mp4').first()
-                
-            if not video_stream:
-                return jsonify({'error': 'No suitable video stream found'}), 404
-                
-            # Download the video file
-            output_file = video_stream.download(output_path=temp_dir)
-            content_type = 'video/mp4'
+        download_name = safe_download_name(manifest['title'], 'mp4')
         
-        if not output_file or not os.path.exists(output_file):
-            return jsonify({'error': 'Download failed - file not created'}), 500
-            
-        # Generate safe filename for download
-        safe_filename = yt.title.replace('/', '_').replace('\\', '_').replace('"', '').replace("'", "")
-        if len(safe_filename) > 100:
-            safe_filename = safe_filename[:100]
-            
-        extension = 'mp3' if is_audio else 'mp4'
+        # A finished copy on disk beats another upstream round-trip
+        cached_file = download_cache.get(download_cache_key(manifest, stream, format_type, quality))
+        if cached_file is not None:
+            return send_cached_file(cached_file, 'video/mp4', download_name)
         
-        # Function to stream file in chunks
-        def generate():
-            with open(output_file, 'rb') as f:
-                while chunk := f.read(8192):
-                    yield chunk
-                    
-            # Clean up after streaming is complete
-            try:
-                if os.path.exists(output_file):
-                    os.remove(output_file)
-                if os.path.exists(temp_dir):
-                    shutil.rmtree(temp_dir)
-                logger.info(f"Cleaned up temporary files for {request_id}")
-            except Exception as e:
-                logger.error(f"Error cleaning up files: {e}")
+        upstream = open_manifest_upstream(url, manifest, stream, request.headers.get('Range'))
         
-        # Set up the streaming response
-        response = Response(generate(), mimetype=content_type)
-        response.headers['Content-Disposition'] = f'attachment; filename="{safe_filename}.{extension}"'
-        logger.info(f"Streaming download started for {safe_filename}.{extension}")
+        response = Response(relay(upstream), status=upstream.status_code, mimetype='video/mp4')
+        response.headers.update(passthrough_headers(upstream))
+        response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+        # Close the upstream connection even if the client never reads the body
+        response.call_on_close(upstream.close)
+        logger.info(f"Proxying {download_name} (HTTP {upstream.status_code})")
         
         return response
     
+    except UpstreamError as e:
+        logger.error(f"Upstream error while proxying: {str(e)}")
+        return jsonify({"error": str(e)}), 502
     except (exceptions.PytubeError, HTTPError) as e:
         logger.exception(f"Pytube error: {str(e)}")
-        return jsonify({"error": f"Download failed: {str(e)}"}), 500
+        return jsonify({"error": f"Stream failed: {str(e)}"}), 500
     except Exception as e:
-        logger.exception("Error during download")
+        logger.exception("Error while proxying stream")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    """Queue a download job"""
+    data = request.get_json(silent=True) or request.form
+    url = data.get('url')
+    format_type = negotiate_audio_format(data.get('format', 'mp4'))
+    quality = data.get('quality', '360p')
+    
+    if not url:
+        return jsonify({'error': 'URL is required'}), 400
+    try:
+        priority = int(data.get('priority', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'priority must be an integer'}), 400
+    try:
+        options = clip_options(data)
+    except ValueError as e:
+        return jsonify({'error': f"Invalid clip: {e}"}), 400
+    rejection = admit()
+    if rejection:
+        return rejection
+    
+    job, created = job_queue.submit(url, extract_video_id(url), format_type, quality, priority, options=options)
+    logger.info(f"Job {job['id']} {'queued' if created else 'reused'} for {url}")
+    return jsonify(job_view(job)), 202 if created else 200
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Get a job's state"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_view(job))
+
+@app.route('/api/jobs/<job_id>/file', methods=['GET'])
+def get_job_file(job_id):
+    """Download a job's output"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return send_job_file(job)
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancel a queued or running job"""
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['state'] != 'cancelled':
+        return jsonify({'error': f"Job is already {job['state']}", 'job': job_view(job)}), 409
+    return jsonify(job_view(job))
+
 @app.route('/api/video/direct-download', methods=['GET'])
 def get_direct_link():
     """Get direct download URL with more robust approach to avoid 403 errors"""
     url = request.args.get('url')
-    format_type = request.args.get('format', 'mp4')
+    format_type = negotiate_audio_format(request.args.get('format', 'mp4'))
     quality = request.args.get('quality', '360p')
     
     if not url:
@@ -335,42 +1681,42 @@ def get_direct_link():
         return jsonify({'error': 'Could not extract video ID from URL'}), 400
     
     try:
-        # Method 1: Try using pytube with proper headers
-        yt = initialize_youtube(url)
+        # Method 1: Use the cached stream manifest, resolving it with pytube on a miss
+        manifest = get_manifest(url)
         
         # Get stream based on format and quality
-        stream = None
-        is_audio = format_type == 'mp3'
+        is_audio = format_type in AUDIO_CONTAINERS
+        source_subtype = AUDIO_CONTAINERS[format_type]['source'] if is_audio else None
+        stream = select_stream(manifest, format_type, quality, source_subtype)
         
-        if is_audio:
-            stream = yt.streams.filter(only_audio=True).order_by('abr').desc().first()
-        else:
-            streams = yt.streams.filter(progressive=True, file_extension='mp4')
-            
-            if quality == '1080p':
-                stream = streams.filter(resolution='1080p').first()
-            elif quality == '720p':
-                stream = streams.filter(resolution='720p').first()
-            else:
-                stream = streams.filter(resolution='360p').first()
-                
-            # Fallback to any available stream if specific quality not found
-            if not stream:
-                stream = streams.first()
+        # No single upstream URL has both tracks at this quality, so point at
+        # our muxed download and list the separate track URLs as well
+        tracks = adaptive_tracks(manifest, format_type, quality)
+        if tracks:
+            video, audio = tracks
+            api_url = f"/api/video/download?url={quote(url, safe='')}&format=mp4&quality={quality}"
+            return jsonify({
+                'url': f"{request.host_url.rstrip('/')}{api_url}",
+                'title': manifest['title'],
+                'format': 'mp4',
+                'muxed': True,
+                'resolution': video['resolution'],
+                'tracks': {'video': video['url'], 'audio': audio['url']}
+            })
         
         if not stream:
             return jsonify({'error': 'No suitable stream found'}), 404
             
         # Get the direct URL
-        direct_url = stream.url
+        direct_url = stream['url']
             
         if not direct_url:
             return jsonify({'error': 'Could not get direct URL'}), 500
             
         return jsonify({
             'url': direct_url,
-            'title': yt.title,
-            'format': 'mp3' if is_audio else 'mp4'
+            'title': manifest['title'],
+            'format': format_type if is_audio else 'mp4'
         })
         
     except (exceptions.PytubeError, HTTPError) as e:
@@ -381,14 +1727,17 @@ def get_direct_link():
             logger.info("Falling back to server-side download endpoint")
             
             # For direct link failures, we'll return a link to our own endpoint
-            # which handles the download more reliably
-            api_url = f"/api/video/download?url={url}&format={format_type}&quality={quality}"
+            # which handles the download more reliably. Video is relayed as it
+            # arrives; audio needs the download endpoint's remux or conversion.
+            is_audio = format_type in AUDIO_CONTAINERS
+            endpoint = 'download' if is_audio else 'stream'
+            api_url = f"/api/video/{endpoint}?url={url}&format={format_type}&quality={quality}"
             host_url = request.host_url.rstrip('/')
             
             return jsonify({
                 'url': f"{host_url}{api_url}",
                 'title': f"YouTube Video {video_id}",
-                'format': 'mp3' if format_type == 'mp3' else 'mp4',
+                'format': format_type if is_audio else 'mp4',
                 'fallback': True
             })
             
@@ -400,6 +1749,58 @@ def get_direct_link():
         logger.exception("Error getting direct link")
         return jsonify({"error": str(e)}), 500
 
+job_queue = JobQueue(JOBS_DB, run_traced_job, workers=JOB_WORKERS,
+                     is_result_available=job_file_available, retention=JOB_RETENTION)
+admission = Admission(job_queue, client_buckets, disk_budget, max_pending=ADMISSION_MAX_PENDING)
+
+# With WARMUP=1 the work that would otherwise fall on the first requests runs
+# in the background at startup: WARMUP_CONNECTIONS keep-alive connections are
+# opened to each of WARMUP_URLS, and WARMUP_VIDEO_ID is resolved with pytube
+# so the current player JS is fetched and its cipher parsed. Until it has
+# finished /api/health/ready answers 503.
+WARMUP = os.environ.get('WARMUP', '0').lower() in ('1', 'true', 'yes')
+WARMUP_URLS = os.environ.get('WARMUP_URLS', 'https://www.youtube.com/,https://i.ytimg.com/')
+WARMUP_CONNECTIONS = int(os.environ.get('WARMUP_CONNECTIONS', 4))
+WARMUP_VIDEO_ID = os.environ.get('WARMUP_VIDEO_ID', 'jNQXAC9IVRw')
+
+def warm_player():
+    # Not through the manifest cache: a shared cache hit would skip pytube
+    manifest, _ = load_manifest(f"https://www.youtube.com/watch?v={WARMUP_VIDEO_ID}")
+    logger.info(f"Warm-up resolved {len(manifest['streams'])} streams of {WARMUP_VIDEO_ID}")
+
+warmup_steps = []
+if WARMUP:
+    warmup_steps = [(f"connect {url}", lambda url=url: http_pool.warm(url, WARMUP_CONNECTIONS))
+                    for url in WARMUP_URLS.split(',') if url]
+    warmup_steps.append(('player', warm_player))
+warmup = Warmup(warmup_steps)
+
+_startup_lock = threading.Lock()
+_started = False
+
+def create_app():
+    """Start the backend and return the Flask app.
+    
+    Importing this module only defines things. This creates DOWNLOAD_DIR,
+    loads the caches' indexes, opens the job database and starts the job
+    workers, janitor, span exporter and warm-up; servers call it once
+    before serving (later calls just return the app).
+    """
+    global _started
+    with _startup_lock:
+        if not _started:
+            os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+            download_cache.load()
+            thumbnail_cache.load()
+            if span_exporter:
+                span_exporter.start()
+            # Restored jobs start running here, with everything they use defined
+            job_queue.start()
+            janitor.start()
+            warmup.start()
+            _started = True
+    return app
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, threaded=True)
+    create_app().run(host='0.0.0.0', port=port, threaded=True)
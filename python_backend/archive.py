@@ -0,0 +1,88 @@
+import json
+import logging
+import time
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+# Name of the archive member listing every requested item and its outcome
+MANIFEST_NAME = 'manifest.json'
+
+
+class _Sink:
+    """Write-only file object collecting what zipfile writes until it is drained"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+
+def unique_name(name, used):
+    """Make an archive member name unique by numbering repeats"""
+    candidate = name
+    stem, dot, extension = name.rpartition('.')
+    if not dot:
+        stem, extension = name, ''
+    number = 1
+    while candidate in used:
+        number += 1
+        candidate = f"{stem} ({number}){dot}{extension}"
+    used.add(candidate)
+    return candidate
+
+
+def stream_zip(entries):
+    """Yield a ZIP archive built from entries as it is written.
+
+    entries yields dicts with 'name' and 'chunks' (an iterator of bytes) for
+    members to write, or with 'error' for items that could not be fetched;
+    every dict is recorded in a trailing manifest.json. Members are stored
+    without compression and with ZIP64 headers, since their sizes are not
+    known up front. A member whose chunks fail part way is kept truncated
+    and marked as such in the manifest.
+    """
+    sink = _Sink()
+    archive = zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+    used = {MANIFEST_NAME}
+    manifest = []
+
+    for entry in entries:
+        chunks = entry.pop('chunks', None)
+        if chunks is not None:
+            entry['name'] = unique_name(entry['name'], used)
+            info = zipfile.ZipInfo(entry['name'], date_time=time.localtime()[:6])
+            size = 0
+            try:
+                with archive.open(info, 'w', force_zip64=True) as member:
+                    for chunk in chunks:
+                        member.write(chunk)
+                        size += len(chunk)
+                        yield from sink.drain()
+                entry['status'] = 'ok'
+            except Exception as e:
+                logger.exception(f"Archive member {entry['name']} failed after {size} bytes")
+                entry.update(status='incomplete', error=str(e))
+            finally:
+                close = getattr(chunks, 'close', None)
+                if close:
+                    close()
+            entry['bytes'] = size
+            yield from sink.drain()
+        else:
+            entry['status'] = 'failed'
+        manifest.append(entry)
+
+    archive.writestr(zipfile.ZipInfo(MANIFEST_NAME, date_time=time.localtime()[:6]),
+                     json.dumps({'items': manifest}, indent=2))
+    archive.close()
+    yield from sink.drain()
@@ -0,0 +1,36 @@
+import os
+import sys
+
+import uvicorn
+
+from app import create_app, metrics
+from asgi_bridge import WsgiBridge, requested_workers
+
+# The async server runs the same Flask app. Views run on ASYNC_WORKERS threads
+# (download requests hold one until their job starts producing output, so keep
+# it above ADMISSION_MAX_PENDING); response bodies are sent from the event
+# loop with each chunk produced on one of ASYNC_BODY_THREADS threads. Bodies
+# following a download in progress give their thread back while they wait, but
+# proxied streams and clips relayed from upstream hold one while the upstream
+# is slow: ASYNC_BODY_THREADS of those at once make every other body's chunks
+# queue (ytdl_async_body_chunks_queued), so size it for the number of slow
+# relays expected at once. Beyond ASYNC_MAX_CONNECTIONS requests in flight,
+# new ones get 503.
+PORT = int(os.environ.get('PORT', 5000))
+ASYNC_WORKERS = int(os.environ.get('ASYNC_WORKERS', 128))
+ASYNC_BODY_THREADS = int(os.environ.get('ASYNC_BODY_THREADS', 32))
+ASYNC_MAX_CONNECTIONS = int(os.environ.get('ASYNC_MAX_CONNECTIONS', 4096))
+ASYNC_FILE_CHUNK_SIZE = int(os.environ.get('ASYNC_FILE_CHUNK_SIZE', 64 * 1024))
+ASYNC_KEEPALIVE_TIMEOUT = int(os.environ.get('ASYNC_KEEPALIVE_TIMEOUT', 5))
+# One process only: the job queue, download cache index and admission state
+# live in it, so several worker processes would each keep their own and race
+# on the same files. Scale with ASYNC_WORKERS and ASYNC_BODY_THREADS instead
+if requested_workers(sys.argv, os.environ) > 1:
+    sys.exit("asgi.py runs in a single process; drop --workers and WEB_CONCURRENCY")
+application = WsgiBridge(create_app(), workers=ASYNC_WORKERS, body_threads=ASYNC_BODY_THREADS,
+                         max_connections=ASYNC_MAX_CONNECTIONS, file_chunk_size=ASYNC_FILE_CHUNK_SIZE)
+metrics.add_collector(application.collect)
+
+if __name__ == '__main__':
+    uvicorn.run(application, host='0.0.0.0', port=PORT, log_config=None, access_log=False,
+                timeout_keep_alive=ASYNC_KEEPALIVE_TIMEOUT)
@@ -0,0 +1,299 @@
+import asyncio
+import contextvars
+import io
+import json
+import logging
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.wsgi import FileWrapper
+
+from download_cache import IDLE_CHUNK, IDLE_CHUNKS_ENVIRON, TAIL_POLL_INTERVAL
+from metrics import render_family
+
+logger = logging.getLogger(__name__)
+
+# Larger request bodies are refused with 413; the API only takes small JSON and form posts
+MAX_REQUEST_BODY = 16 * 1024 ** 2
+
+_END = object()
+
+
+class _Disconnected(Exception):
+    pass
+
+
+def requested_workers(argv, environ):
+    """Worker processes asked for on the server's command line (--workers, -w) or by WEB_CONCURRENCY.
+
+    Spawned and forked workers inherit both, so a worker sees the count too.
+    """
+    for index, arg in enumerate(argv):
+        if arg in ('--workers', '-w') and index + 1 < len(argv):
+            return int(argv[index + 1])
+        if arg.startswith('--workers='):
+            return int(arg.split('=', 1)[1])
+    return int(environ.get('WEB_CONCURRENCY', 1))
+
+
+class WsgiBridge:
+    """ASGI application serving a WSGI application without a thread per connection.
+
+    A request's view runs on one of `workers` threads. Its response body is
+    then sent from the event loop: each chunk is produced on one of
+    body_threads threads (reading a file, following a download in progress
+    or relaying upstream) and sent with the server's flow control, so a
+    client that reads slowly holds a coroutine and a couple of chunks but no
+    thread. A body following a download in progress yields IDLE_CHUNK while
+    it has nothing new, and is asked again after TAIL_POLL_INTERVAL from the
+    event loop, so waiting on a fill holds no thread either. A body relaying
+    upstream does hold its thread while it waits for the upstream socket:
+    body_threads such bodies at once make every other body's chunks queue.
+    Every step of a request runs in the same contextvars context, so
+    per-request state such as its trace and stage timings carries from the
+    view to the body. Bytes passed to the WSGI write() callable are sent
+    ahead of the rest of the body. Requests beyond max_connections in flight
+    are answered with 503.
+    """
+
+    def __init__(self, wsgi_app, workers=128, body_threads=32, max_connections=4096, file_chunk_size=64 * 1024):
+        self.wsgi_app = wsgi_app
+        self.workers = workers
+        self.body_threads = body_threads
+        self.max_connections = max_connections
+        self.file_chunk_size = file_chunk_size
+        self.view_pool = ThreadPoolExecutor(workers, thread_name_prefix='asgi-view')
+        self.body_pool = ThreadPoolExecutor(body_threads, thread_name_prefix='asgi-body')
+        # Changed from the body threads too
+        self._body_lock = threading.Lock()
+        self.body_busy = 0
+        self.body_queued = 0
+        self.idle_waits = 0
+        # Only changed on the event loop
+        self.active = 0
+        self.views = 0
+        self.served = 0
+        self.rejected = 0
+        self.disconnects = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            # Returning without accepting turns a websocket away
+            return
+        if self.active >= self.max_connections:
+            self.rejected += 1
+            await self._send_json(send, 503, {'error': 'Server is busy', 'retry_after': 1}, [(b'retry-after', b'1')])
+            return
+        self.active += 1
+        try:
+            await self._serve(scope, receive, send)
+        except _Disconnected:
+            self.disconnects += 1
+        finally:
+            self.active -= 1
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.view_pool.shutdown(wait=False)
+                self.body_pool.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _send_json(self, send, status, data, headers=()):
+        body = json.dumps(data).encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json'),
+                                (b'content-length', str(len(body)).encode('latin-1'))] + list(headers)})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _read_body(self, receive):
+        """The request body, or None if it is larger than MAX_REQUEST_BODY"""
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise _Disconnected()
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > MAX_REQUEST_BODY:
+                return None
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    def _file_wrapper(self, file, buffer_size=8192):
+        # Files are read a chunk per thread hop; a stalled client holds about two
+        # chunks (one queued in the transport, one waiting to be sent)
+        return FileWrapper(file, max(buffer_size, self.file_chunk_size))
+
+    def _environ(self, scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': self._file_wrapper,
+            IDLE_CHUNKS_ENVIRON: True
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1')
+            value = value.decode('latin-1')
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name == 'content-length':
+                environ['CONTENT_LENGTH'] = value
+            else:
+                key = 'HTTP_' + name.upper().replace('-', '_')
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    async def _watch_disconnect(self, receive, disconnected):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+
+    async def _serve(self, scope, receive, send):
+        body = await self._read_body(receive)
+        if body is None:
+            await self._send_json(send, 413, {'error': 'Request body too large'})
+            return
+
+        environ = self._environ(scope, body)
+        context = contextvars.copy_context()
+        loop = asyncio.get_running_loop()
+        response = {}
+        # Bytes passed to write(), sent ahead of the next chunk of the body
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+
+            def write(data):
+                if data:
+                    written.append(data)
+            return write
+
+        def run_view():
+            iterable = self.wsgi_app(environ, start_response)
+            try:
+                iterator = iter(iterable)
+                # The first chunk comes with the view, saving a hop for small responses
+                return iterable, iterator, next(iterator, _END)
+            except Exception:
+                # Nothing will be sent, but the body may hold cache readers or upstream connections
+                close = getattr(iterable, 'close', None)
+                if close:
+                    close()
+                raise
+
+        self.views += 1
+        try:
+            iterable, iterator, chunk = await loop.run_in_executor(self.view_pool, context.run, run_view)
+        except Exception:
+            logger.exception("Unhandled error in view")
+            await self._send_json(send, 500, {'error': 'Internal server error'})
+            return
+        finally:
+            self.views -= 1
+
+        disconnected = asyncio.Event()
+        watcher = asyncio.ensure_future(self._watch_disconnect(receive, disconnected))
+        try:
+            await send({'type': 'http.response.start', 'status': response['status'],
+                        'headers': response['headers']})
+            async for chunk in self._chunks(loop, context, iterator, chunk, written, disconnected):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if disconnected.is_set():
+                raise _Disconnected()
+            await send({'type': 'http.response.body', 'body': b''})
+            self.served += 1
+        finally:
+            watcher.cancel()
+            close = getattr(iterable, 'close', None)
+            if close:
+                await self._in_body_thread(loop, context, close)
+
+    def _run_body(self, context, function, *args):
+        with self._body_lock:
+            self.body_queued -= 1
+            self.body_busy += 1
+        try:
+            return context.run(function, *args)
+        finally:
+            with self._body_lock:
+                self.body_busy -= 1
+
+    async def _in_body_thread(self, loop, context, function, *args):
+        """Run function in context on a body thread, counted as queued until a thread takes it"""
+        with self._body_lock:
+            self.body_queued += 1
+        return await loop.run_in_executor(self.body_pool, self._run_body, context, function, *args)
+
+    async def _chunks(self, loop, context, iterator, first, written, disconnected):
+        """The rest of a response body, produced a chunk per hop onto the body threads"""
+        chunk = first
+        while not disconnected.is_set():
+            while written:
+                yield written.pop(0)
+            if chunk is _END:
+                return
+            if chunk is IDLE_CHUNK:
+                # Nothing new yet; wait here rather than on a body thread
+                self.idle_waits += 1
+                await asyncio.sleep(TAIL_POLL_INTERVAL)
+            elif chunk:
+                yield chunk
+            chunk = await self._in_body_thread(loop, context, next, iterator, _END)
+
+    def collect(self):
+        """Metrics for the registry, rendered at scrape time"""
+        with self._body_lock:
+            body_busy, body_queued = self.body_busy, self.body_queued
+        return ''.join([
+            render_family('ytdl_async_connections', 'gauge', 'Requests in flight in the async server',
+                          [('', [], self.active)]),
+            render_family('ytdl_async_views', 'gauge', 'Views running on the async server\'s worker threads',
+                          [('', [], self.views)]),
+            render_family('ytdl_async_body_threads_busy', 'gauge', 'Body threads producing a response chunk',
+                          [('', [], body_busy)]),
+            render_family('ytdl_async_body_chunks_queued', 'gauge',
+                          'Response chunks waiting for a free body thread', [('', [], body_queued)]),
+            render_family('ytdl_async_body_idle_waits_total', 'counter',
+                          'Waits on the event loop for a download in progress to advance', [('', [], self.idle_waits)]),
+            render_family('ytdl_async_responses_total', 'counter', 'Responses sent in full by the async server',
+                          [('', [], self.served)]),
+            render_family('ytdl_async_rejected_total', 'counter',
+                          'Requests turned away at the async server\'s connection limit', [('', [], self.rejected)]),
+            render_family('ytdl_async_disconnects_total', 'counter',
+                          'Requests whose client went away before the response was sent',
+                          [('', [], self.disconnects)])
+        ])
@@ -0,0 +1,299 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import requests
+
+from youtube_standin import YouTubeStandIn, generate_media, video_ids
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCENARIOS = ('info_cold', 'info_warm', 'download_cold', 'download_warm', 'mp3', 'direct_link')
+
+
+def watch_url(video_id):
+    return quote(f"https://www.youtube.com/watch?v={video_id}", safe='')
+
+
+def scenario_paths(name, ids):
+    """Request paths a scenario sends, one per video.
+
+    Scenarios run in the order of SCENARIOS and share one server, so the
+    warm scenarios find what the cold ones cached. mp3 and direct_link use
+    videos of their own so that neither finds a cached download.
+    """
+    half = len(ids) // 2
+    if name in ('info_cold', 'info_warm'):
+        return [f"/api/video/info?url={watch_url(v)}" for v in ids]
+    if name in ('download_cold', 'download_warm'):
+        return [f"/api/video/download?url={watch_url(v)}&format=mp4&quality=360p" for v in ids[:half]]
+    if name == 'mp3':
+        return [f"/api/video/download?url={watch_url(v)}&format=mp3&quality=128" for v in ids[half:]]
+    if name == 'direct_link':
+        return [f"/api/video/direct-download?url={watch_url(v)}&format=mp4&quality=360p" for v in ids[half:]]
+    raise ValueError(f"Unknown scenario: {name}")
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def latency_summary(seconds):
+    return {f"p{p}": round(percentile(seconds, p) * 1000, 1) if seconds else None for p in (50, 95, 99)}
+
+
+class ProcessMonitor:
+    """Samples the CPU time (including reaped children such as ffmpeg) and RSS of a process from /proc"""
+
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.available = os.path.exists(f"/proc/{pid}/stat")
+        self._ticks = os.sysconf('SC_CLK_TCK') if self.available else None
+        self._page_size = os.sysconf('SC_PAGE_SIZE') if self.available else None
+        self.peak_rss = 0
+        self._stop = threading.Event()
+
+    def cpu_seconds(self):
+        if not self.available:
+            return None
+        with open(f"/proc/{self.pid}/stat") as f:
+            # Fields after the command name, which may contain spaces
+            fields = f.read().rpartition(')')[2].split()
+        utime, stime, cutime, cstime = (int(value) for value in fields[11:15])
+        return (utime + stime + cutime + cstime) / self._ticks
+
+    def rss(self):
+        if not self.available:
+            return None
+        with open(f"/proc/{self.pid}/statm") as f:
+            return int(f.read().split()[1]) * self._page_size
+
+    def start(self):
+        threading.Thread(target=self._sample, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def reset_peak(self):
+        self.peak_rss = self.rss() or 0
+
+    def _sample(self):
+        while self.available and not self._stop.wait(self.interval):
+            try:
+                self.peak_rss = max(self.peak_rss, self.rss())
+            except OSError:
+                return
+
+
+def fetch(session, url):
+    """GET url and read the whole body; returns (status, seconds to headers, seconds to last byte, bytes)"""
+    started = time.monotonic()
+    try:
+        with session.get(url, stream=True, timeout=300) as response:
+            first_byte = time.monotonic() - started
+            size = sum(len(chunk) for chunk in response.iter_content(65536))
+            return response.status_code, first_byte, time.monotonic() - started, size
+    except requests.RequestException:
+        return None, None, time.monotonic() - started, 0
+
+
+def run_scenario(base_url, paths, concurrency, monitor):
+    """Send paths with concurrency requests in flight and summarize latency, throughput and server resources"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    cpu_before = monitor.cpu_seconds()
+    monitor.reset_peak()
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda path: fetch(session, base_url + path), paths))
+    wall = time.monotonic() - started
+    cpu_after = monitor.cpu_seconds()
+    session.close()
+
+    ok = [r for r in results if r[0] is not None and r[0] < 400]
+    total_bytes = sum(r[3] for r in ok)
+    return {
+        'requests': len(results),
+        'errors': len(results) - len(ok),
+        'concurrency': concurrency,
+        'wall_seconds': round(wall, 3),
+        'latency_ms': latency_summary([r[2] for r in ok]),
+        'first_byte_ms': latency_summary([r[1] for r in ok]),
+        'requests_per_second': round(len(ok) / wall, 2) if wall else None,
+        'throughput_mb_s': round(total_bytes / wall / (1024 * 1024), 2) if wall else None,
+        'bytes': total_bytes,
+        'server_cpu_seconds': round(cpu_after - cpu_before, 3) if cpu_before is not None else None,
+        'server_rss_mb': round(monitor.rss() / (1024 * 1024), 1) if monitor.available else None,
+        'server_peak_rss_mb': round(monitor.peak_rss / (1024 * 1024), 1) if monitor.available else None
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_backend(upstream, work_dir, ffmpeg, extra_env, server='threaded'):
+    """Start the backend (app.py, or asgi.py for the async server) against the stand-in.
+
+    Its state goes in work_dir. Waits until it reports ready (including any
+    warm-up) and returns (process, base URL, seconds that took).
+    """
+    port = free_port()
+    env = dict(os.environ,
+               PORT=str(port),
+               UPSTREAM_OVERRIDE=upstream,
+               DOWNLOAD_CACHE_DIR=os.path.join(work_dir, 'cache'),
+               THUMBNAIL_CACHE_DIR=os.path.join(work_dir, 'thumbnails'),
+               JOBS_DB=os.path.join(work_dir, 'jobs.sqlite3'),
+               # Every benchmark request comes from one address
+               CLIENT_RATE='1000000',
+               CLIENT_BURST='1000000',
+               MIN_FREE_DISK_BYTES='0')
+    env.update(extra_env)
+    ffmpeg_path = shutil.which(ffmpeg)
+    if ffmpeg_path:
+        # The backend runs whatever ffmpeg is first on its PATH
+        env['PATH'] = os.path.dirname(ffmpeg_path) + os.pathsep + env.get('PATH', '')
+    log = open(os.path.join(work_dir, 'backend.log'), 'wb')
+    script = 'asgi.py' if server == 'async' else 'app.py'
+    started = time.monotonic()
+    process = subprocess.Popen([sys.executable, os.path.join(BACKEND_DIR, script)], cwd=BACKEND_DIR, env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Backend exited with {process.returncode}; see {log.name}")
+        try:
+            if requests.get(base_url + '/api/health/ready', timeout=1).ok:
+                return process, base_url, round(time.monotonic() - started, 3)
+        except requests.RequestException:
+            pass
+        time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"Backend did not start within 60s; see {log.name}")
+
+
+def compare(results, baseline, max_regression):
+    """Regressions of results against a baseline run, as messages"""
+    regressions = []
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        if current['errors'] > previous['errors']:
+            regressions.append(f"{name}: {current['errors']} errors, was {previous['errors']}")
+        for key in ('p50', 'p95', 'p99'):
+            now, before = current['latency_ms'][key], previous['latency_ms'][key]
+            if now and before and now > before * (1 + max_regression):
+                regressions.append(f"{name}: {key} latency {now}ms, was {before}ms")
+        now, before = current['requests_per_second'], previous['requests_per_second']
+        if now is not None and before and now < before * (1 - max_regression):
+            regressions.append(f"{name}: {now} requests/s, was {before}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the backend against a local YouTube stand-in')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"comma-separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument('--videos', type=int, default=20, help='distinct videos per scenario')
+    parser.add_argument('--concurrency', type=int, default=4, help='requests in flight at once')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the stand-in waits before responding')
+    parser.add_argument('--bandwidth', type=int, default=8 * 1024 * 1024,
+                        help='bytes per second per stand-in connection (0 for unlimited)')
+    parser.add_argument('--media-seconds', type=int, default=60, help='length of the synthetic media')
+    parser.add_argument('--media-dir', default=os.path.join(BACKEND_DIR, 'downloads', 'bench-media'),
+                        help='where generated media is kept between runs')
+    parser.add_argument('--fixtures', help='directory of recorded pages to serve instead of synthetic ones')
+    parser.add_argument('--ffmpeg', default='ffmpeg')
+    parser.add_argument('--server', choices=('threaded', 'async'), default='threaded',
+                        help="Flask's threaded server (app.py) or the async server (asgi.py)")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra environment for the backend, e.g. JOB_WORKERS=8')
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='allowed slowdown against the baseline, as a fraction')
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error(f"Unknown scenario: {name}")
+    extra_env = dict(item.split('=', 1) for item in args.env)
+
+    media = generate_media(args.media_dir, args.media_seconds, args.ffmpeg)
+    standin = YouTubeStandIn(media, args.media_seconds, args.latency, args.bandwidth or None, args.fixtures).start()
+    work_dir = tempfile.mkdtemp(prefix='ytdl-bench-')
+    process, base_url, startup_seconds = start_backend(standin.base_url, work_dir, args.ffmpeg, extra_env,
+                                                       args.server)
+    print(f"Backend ready in {startup_seconds}s")
+    monitor = ProcessMonitor(process.pid).start()
+    ids = video_ids(args.videos * 2)
+
+    results = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'config': {key: getattr(args, key) for key in ('server', 'videos', 'concurrency', 'latency', 'bandwidth',
+                                                       'media_seconds', 'fixtures')},
+        'backend_env': extra_env,
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+        'startup_seconds': startup_seconds,
+        'scenarios': {}
+    }
+    try:
+        for name in SCENARIOS:
+            if name not in names:
+                continue
+            summary = run_scenario(base_url, scenario_paths(name, ids), args.concurrency, monitor)
+            results['scenarios'][name] = summary
+            print(f"{name:14} {summary['requests']:4} requests {summary['errors']:3} errors  "
+                  f"p50 {summary['latency_ms']['p50']}ms  p95 {summary['latency_ms']['p95']}ms  "
+                  f"p99 {summary['latency_ms']['p99']}ms  {summary['requests_per_second']} req/s  "
+                  f"{summary['throughput_mb_s']} MB/s  cpu {summary['server_cpu_seconds']}s  "
+                  f"rss {summary['server_peak_rss_mb']}MB")
+        results['upstream'] = standin.stats()
+    finally:
+        monitor.stop()
+        process.terminate()
+        process.wait(timeout=10)
+        standin.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.max_regression)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.max_regression:.0%} against {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+import bisect
+import logging
+import math
+import struct
+
+from proxy import relay
+
+logger = logging.getLogger(__name__)
+
+# Bytes fetched from the start of a stream to find its index; grown up to
+# MAX_HEAD_BYTES when the index turns out to be larger
+HEAD_BYTES = 64 * 1024
+MAX_HEAD_BYTES = 4 * 1024 * 1024
+
+# Matroska/WebM element IDs used to find the cues
+EBML_ID = 0x1A45DFA3
+SEGMENT_ID = 0x18538067
+INFO_ID = 0x1549A966
+TIMECODE_SCALE_ID = 0x2AD7B1
+CUES_ID = 0x1C53BB6B
+CUE_POINT_ID = 0xBB
+CUE_TIME_ID = 0xB3
+CUE_TRACK_POSITIONS_ID = 0xB7
+CUE_CLUSTER_POSITION_ID = 0xF1
+CLUSTER_ID = 0x1F43B675
+
+
+class ClipError(Exception):
+    """Raised when a clip cannot be cut from a stream's index"""
+
+
+class _NeedMore(Exception):
+    """The index extends past the bytes fetched so far"""
+
+    def __init__(self, needed):
+        super().__init__(f"Index needs {needed} bytes")
+        self.needed = needed
+
+
+def parse_time(value):
+    """Seconds for a clip time given as '90', '90.5', '1:30' or '1:02:03.5'"""
+    seconds = 0.0
+    for part in str(value).strip().split(':'):
+        part = float(part)
+        if not math.isfinite(part) or part < 0:
+            raise ValueError("Times must be finite and not negative")
+        seconds = seconds * 60 + part
+    return seconds
+
+
+def _read_vint(data, pos, keep_marker=False):
+    """Read an EBML variable length integer; returns (value, next position, all bits set)"""
+    if pos >= len(data):
+        raise _NeedMore(pos + 8)
+    first = data[pos]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise ClipError("Invalid EBML integer")
+    if pos + length > len(data):
+        raise _NeedMore(pos + length)
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    unknown = not keep_marker and value == (1 << (7 * length)) - 1
+    return value, pos + length, unknown
+
+
+def _read_element(data, pos):
+    """Read an EBML element header; returns (id, data start, data end or None if unknown size)"""
+    element_id, pos, _ = _read_vint(data, pos, keep_marker=True)
+    size, pos, unknown = _read_vint(data, pos)
+    return element_id, pos, None if unknown else pos + size
+
+
+def _read_uint(data, start, end):
+    if end > len(data):
+        raise _NeedMore(end)
+    return int.from_bytes(data[start:end], 'big')
+
+
+def parse_webm_index(data):
+    """Find the cues of a WebM stream.
+
+    Returns {'init_end', 'segments'} where segments are (start time, first
+    byte) pairs of the clusters listed in the cues, in order.
+    """
+    element_id, pos, end = _read_element(data, 0)
+    if element_id != EBML_ID:
+        raise ClipError("Not a WebM stream")
+    element_id, segment_start, _ = _read_element(data, end)
+    if element_id != SEGMENT_ID:
+        raise ClipError("WebM segment not found")
+
+    timecode_scale = 1000000
+    cues = []
+    pos = segment_start
+    while True:
+        element_id, body, end = _read_element(data, pos)
+        if element_id == CLUSTER_ID:
+            break
+        if end is None:
+            raise ClipError("Unsized WebM element before the first cluster")
+        if element_id in (INFO_ID, CUES_ID) and end > len(data):
+            raise _NeedMore(end)
+        if element_id == INFO_ID:
+            child = body
+            while child < end:
+                child_id, child_body, child_end = _read_element(data, child)
+                if child_id == TIMECODE_SCALE_ID:
+                    timecode_scale = _read_uint(data, child_body, child_end)
+                child = child_end
+        elif element_id == CUES_ID:
+            cues = _parse_cues(data, body, end, segment_start)
+        pos = end
+
+    if not cues:
+        raise ClipError("WebM stream has no cues before its first cluster")
+    segments = [(time * timecode_scale / 1e9, position) for time, position in sorted(cues)]
+    return {'init_end': pos, 'segments': segments}
+
+
+def _parse_cues(data, pos, end, segment_start):
+    """List (cue time, absolute cluster position) pairs from a Cues element"""
+    cues = []
+    while pos < end:
+        element_id, body, point_end = _read_element(data, pos)
+        if element_id == CUE_POINT_ID:
+            time = position = None
+            child = body
+            while child < point_end:
+                child_id, child_body, child_end = _read_element(data, child)
+                if child_id == CUE_TIME_ID:
+                    time = _read_uint(data, child_body, child_end)
+                elif child_id == CUE_TRACK_POSITIONS_ID:
+                    grandchild = child_body
+                    while grandchild < child_end:
+                        grand_id, grand_body, grand_end = _read_element(data, grandchild)
+                        if grand_id == CUE_CLUSTER_POSITION_ID:
+                            position = segment_start + _read_uint(data, grand_body, grand_end)
+                        grandchild = grand_end
+                child = child_end
+            if time is not None and position is not None:
+                cues.append((time, position))
+        pos = point_end
+    return cues
+
+
+def parse_mp4_index(data):
+    """Find the segment index (sidx) of a fragmented MP4 stream.
+
+    Returns {'init_end', 'segments'} where segments are (start time, first
+    byte) pairs of the subsegments, each of which starts with a keyframe.
+    """
+    pos = 0
+    while pos + 8 <= len(data):
+        size, box_type = struct.unpack('>I4s', data[pos:pos + 8])
+        header = 8
+        if size == 1:
+            if pos + 16 > len(data):
+                raise _NeedMore(pos + 16)
+            size = struct.unpack('>Q', data[pos + 8:pos + 16])[0]
+            header = 16
+        if size < header:
+            raise ClipError("Invalid MP4 box")
+        if box_type in (b'moof', b'mdat'):
+            break
+        if box_type == b'sidx':
+            if pos + size > len(data):
+                raise _NeedMore(pos + size)
+            return {'init_end': pos, 'segments': _parse_sidx(data[pos + header:pos + size], pos + size)}
+        pos += size
+    else:
+        raise _NeedMore(pos + 8)
+    raise ClipError("MP4 stream has no segment index")
+
+
+def _parse_sidx(body, box_end):
+    version = body[0]
+    timescale = struct.unpack('>I', body[8:12])[0]
+    if version == 0:
+        earliest, first_offset = struct.unpack('>II', body[12:20])
+        pos = 20
+    else:
+        earliest, first_offset = struct.unpack('>QQ', body[12:28])
+        pos = 28
+    count = struct.unpack('>H', body[pos + 2:pos + 4])[0]
+    pos += 4
+
+    segments = []
+    time = earliest
+    offset = box_end + first_offset
+    for _ in range(count):
+        reference, duration, _ = struct.unpack('>III', body[pos:pos + 12])
+        pos += 12
+        segments.append((time / timescale, offset))
+        time += duration
+        offset += reference & 0x7FFFFFFF
+    return segments
+
+
+def read_index(open_range, subtype):
+    """Fetch the start of a stream and parse its index.
+
+    open_range(range_header) must return an open upstream response. Returns
+    the index plus the fetched bytes, whose first init_end bytes are the
+    stream's initialization data.
+    """
+    parse = parse_webm_index if subtype == 'webm' else parse_mp4_index
+    size = HEAD_BYTES
+    while True:
+        head = b''.join(relay(open_range(f"bytes=0-{size - 1}")))
+        try:
+            index = parse(head)
+        except _NeedMore as e:
+            if len(head) < size or e.needed > MAX_HEAD_BYTES:
+                raise ClipError("Stream index not found in the first bytes of the stream")
+            size = max(e.needed, size * 2)
+            continue
+        index['head'] = head
+        return index
+
+
+def keyframe_before(index, time):
+    """Start time of the last indexed segment that starts at or before time"""
+    starts = [start for start, _ in index['segments']]
+    return starts[max(0, bisect.bisect_right(starts, time) - 1)]
+
+
+def clip_source(open_range, index, start, end):
+    """Yield the stream's initialization data followed by only the segments covering start..end"""
+    segments = index['segments']
+    starts = [segment_start for segment_start, _ in segments]
+    first = max(0, bisect.bisect_right(starts, start) - 1)
+    # The segment after the one containing end is where the range stops
+    after = bisect.bisect_left(starts, end, lo=first + 1)
+    first_byte = segments[first][1]
+    range_header = f"bytes={first_byte}-"
+    if after < len(segments):
+        range_header += str(segments[after][1] - 1)
+
+    yield index['head'][:index['init_end']]
+    yield from relay(open_range(range_header))
+
+
+def clip_time_args(start, end):
+    """ffmpeg options that keep start..end of the (original) input timeline, starting the output at zero"""
+    return ['-copyts', '-ss', f'{start:.3f}', '-to', f'{end:.3f}', '-avoid_negative_ts', 'make_zero']
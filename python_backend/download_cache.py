@@ -0,0 +1,364 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Partial files are named <digest>.partial.<ext>; resumable producers may keep
+# sidecar files next to them that share the prefix
+PARTIAL_MARKER = '.partial'
+
+# How often a reader tailing an in-progress file checks for new data
+TAIL_POLL_INTERVAL = 0.1
+
+# Set in the WSGI environ by servers that take IDLE_CHUNK in a response body
+# to mean "nothing yet" and ask for the next chunk TAIL_POLL_INTERVAL later, so
+# a body tailing a fill does not hold a thread while it waits (see asgi_bridge.py)
+IDLE_CHUNKS_ENVIRON = 'ytdl.idle_chunks'
+
+
+class _IdleChunk(bytes):
+    pass
+
+
+# Empty, so anything passing the body through treats it as no data
+IDLE_CHUNK = _IdleChunk()
+
+
+class _Entry:
+    """A published file in the cache"""
+
+    def __init__(self, path, size, last_access, hits=0):
+        self.path = path
+        self.size = size
+        self.last_access = last_access
+        self.hits = hits
+        self.readers = 0
+
+
+class _Fill:
+    """An in-progress download that readers can tail while it is written"""
+
+    def __init__(self, partial_path, final_path, resumable=False):
+        self.partial_path = partial_path
+        self.final_path = final_path
+        self.resumable = resumable
+        self.done = threading.Event()
+        self.error = None
+        # Length of the prefix that is safe to read, for producers that write
+        # out of order; None means the file is written sequentially
+        self.watermark = None
+        # Readers count against the fill until it is published, then against its entry
+        self.readers = 0
+        self.entry = None
+
+    def advance(self, watermark):
+        """Record that the first watermark bytes of the file are final"""
+        self.watermark = watermark
+
+
+class CachedFile:
+    """A reader handle for a cache item, complete or still being filled"""
+
+    def __init__(self, cache, path, fill=None, entry=None):
+        self._cache = cache
+        self.path = path
+        self._fill = fill
+        self._entry = entry
+        # Open now so the handle survives the partial file being renamed into
+        # place; unbuffered so reads never run ahead of the fill's watermark
+        self._file = open(fill.partial_path if fill else path, 'rb', buffering=0)
+
+    @property
+    def complete(self):
+        return self._fill is None or (self._fill.done.is_set() and self._fill.error is None)
+
+    def _readable(self):
+        """Bytes of the file that are safe to read while it is being filled"""
+        if self._fill.watermark is not None:
+            return self._fill.watermark
+        return os.fstat(self._file.fileno()).st_size
+
+    def wait_started(self):
+        """Block until the file has data or its fill finished; re-raise a failed fill"""
+        fill = self._fill
+        while fill is not None and not fill.done.is_set():
+            if self._readable() > 0:
+                return
+            fill.done.wait(TAIL_POLL_INTERVAL)
+        if fill is not None and fill.error is not None:
+            self.close()
+            raise fill.error
+
+    def wait_complete(self):
+        """Block until the item is published; re-raise a failed fill"""
+        if self._fill is not None:
+            self._fill.done.wait()
+            if self._fill.error is not None:
+                self.close()
+                raise self._fill.error
+
+    def iter_chunks(self, chunk_size=65536, idle=False):
+        """Yield the file's bytes, following a partial file until its fill completes.
+
+        Only bytes below the fill's watermark are read, during the fill and
+        after it, and a failed fill is re-raised as soon as it is seen, so
+        preallocated or out-of-order bytes of a failed fill are never sent.
+        With idle, IDLE_CHUNK is yielded instead of waiting for the fill to advance.
+        """
+        try:
+            while True:
+                fill = self._fill
+                size = chunk_size
+                done = False
+                if fill is not None:
+                    # Checked before measuring, so a finished fill is measured in full
+                    done = fill.done.is_set()
+                    if fill.error is not None:
+                        raise fill.error
+                    size = min(chunk_size, self._readable() - self._file.tell())
+                chunk = self._file.read(size) if size > 0 else b''
+                if chunk:
+                    yield chunk
+                    continue
+                if fill is None or done:
+                    return
+                if idle:
+                    yield IDLE_CHUNK
+                else:
+                    fill.done.wait(TAIL_POLL_INTERVAL)
+        finally:
+            self.close()
+
+    def close(self):
+        """Release the file and the cache entry"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._cache._release(self._fill, self._entry)
+
+
+class DownloadCache:
+    """Content-addressed on-disk cache of finished downloads with a byte quota.
+
+    Items are keyed by (video ID, itag, output variant). The first request for a
+    missing item fills it in a background thread; concurrent requests for the
+    same item tail the partially written file instead of downloading again.
+    Files are published with an atomic rename and evicted least recently used
+    (or least frequently used) first once the quota is exceeded. Partial files
+    of resumable items that failed are kept for partial_retention seconds so a
+    later request can continue them; sweep_partials(), which the caller runs
+    periodically, deletes them after that. load() creates the directory and
+    indexes what an earlier run left in it.
+    """
+
+    def __init__(self, root, max_bytes, policy='lru', partial_retention=3600):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError(f"Unknown eviction policy: {policy}")
+        self.root = root
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.partial_retention = partial_retention
+        self._entries = {}
+        self._fills = {}
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+        self.evictions = 0
+        self.resumed = 0
+
+    def load(self):
+        """Create the cache directory and rebuild the index from files left by a previous run"""
+        os.makedirs(self.root, exist_ok=True)
+        self.sweep_partials()
+        # One stat per file: scandir knows the file type without one
+        for entry in os.scandir(self.root):
+            if PARTIAL_MARKER in entry.name or not entry.is_file():
+                continue
+            digest = entry.name.split('.', 1)[0]
+            stat = entry.stat()
+            self._entries[digest] = _Entry(entry.path, stat.st_size, stat.st_mtime)
+            self.total_bytes += stat.st_size
+        logger.info(f"Download cache loaded {len(self._entries)} files ({self.total_bytes} bytes)")
+        return self
+
+    def sweep_partials(self):
+        """Delete partial files that have not been touched within the retention window"""
+        cutoff = time.time() - self.partial_retention
+        with self._lock:
+            active = set(self._fills)
+        for name in os.listdir(self.root):
+            if PARTIAL_MARKER not in name or name.split('.', 1)[0] in active:
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def partial_bytes(self):
+        """Bytes held by partial files, of fills in progress and of failed resumable fills"""
+        total = 0
+        for name in os.listdir(self.root):
+            if PARTIAL_MARKER in name:
+                try:
+                    total += os.path.getsize(os.path.join(self.root, name))
+                except OSError:
+                    pass
+        return total
+
+    @staticmethod
+    def digest(key):
+        """Content address for a cache key tuple"""
+        return hashlib.sha256(':'.join(str(part) for part in key).encode('utf-8')).hexdigest()[:32]
+
+    def get(self, key):
+        """Return a handle for a published or in-progress item, or None without starting a fill"""
+        digest = self.digest(key)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                return self._open(digest, entry)
+            fill = self._fills.get(digest)
+            if fill is None:
+                return None
+            self.joined += 1
+            fill.readers += 1
+            return CachedFile(self, fill.final_path, fill)
+
+    def contains(self, key):
+        """Whether an item is published or being filled"""
+        digest = self.digest(key)
+        with self._lock:
+            return digest in self._entries or digest in self._fills
+
+    def _open(self, digest, entry):
+        """Open a published entry; caller must hold the lock"""
+        entry.hits += 1
+        entry.last_access = time.time()
+        entry.readers += 1
+        self.hits += 1
+        return CachedFile(self, entry.path, entry=entry)
+
+    def get_or_fill(self, key, extension, producer, resumable=False):
+        """Return a handle for an item, starting producer(partial_path, advance) on a miss.
+
+        producer must write the complete item to the path it is given. A
+        producer that does not write sequentially calls advance(n) as the first
+        n bytes become final. It runs in a background thread; its exception is
+        re-raised to every reader.
+
+        A resumable producer is handed any partial file left by an earlier
+        failed fill of the same item, and that file is kept if it fails again.
+        Readers see none of its bytes until the producer calls advance().
+        """
+        digest = self.digest(key)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                return self._open(digest, entry)
+
+            fill = self._fills.get(digest)
+            if fill is not None:
+                self.joined += 1
+            else:
+                self.misses += 1
+                partial_path = os.path.join(self.root, f"{digest}{PARTIAL_MARKER}.{extension}")
+                if resumable and os.path.exists(partial_path):
+                    self.resumed += 1
+                open(partial_path, 'ab' if resumable else 'wb').close()
+                final_path = os.path.join(self.root, f"{digest}.{extension}")
+                fill = self._fills[digest] = _Fill(partial_path, final_path, resumable)
+                if resumable:
+                    fill.advance(0)
+                threading.Thread(target=self._run_fill, args=(digest, fill, producer),
+                                 daemon=True).start()
+            # Registered as a reader up front so the entry cannot be evicted
+            # between publishing and the reader finishing
+            fill.readers += 1
+            return CachedFile(self, fill.final_path, fill)
+
+    def _run_fill(self, digest, fill, producer):
+        """Produce an item and atomically publish it"""
+        try:
+            producer(fill.partial_path, fill.advance)
+            size = os.path.getsize(fill.partial_path)
+            # The whole file is final now, whatever the producer last reported
+            fill.advance(size)
+            with self._lock:
+                # Renamed under the lock so joining readers never see the partial path vanish
+                os.replace(fill.partial_path, fill.final_path)
+                entry = fill.entry = _Entry(fill.final_path, size, time.time())
+                entry.readers = fill.readers
+                self._entries[digest] = entry
+                self.total_bytes += size
+                del self._fills[digest]
+                self._evict()
+            logger.info(f"Cached download {os.path.basename(fill.final_path)} ({size} bytes)")
+        except Exception as e:
+            logger.exception(f"Filling download cache item {digest} failed")
+            fill.error = e
+            with self._lock:
+                self._fills.pop(digest, None)
+            if not fill.resumable:
+                try:
+                    os.remove(fill.partial_path)
+                except OSError:
+                    pass
+        finally:
+            fill.done.set()
+
+    def _release(self, fill, entry):
+        """Drop a reader reference; caller must not hold the lock"""
+        with self._lock:
+            if fill is not None:
+                # A later fill of the same item has a count of its own
+                entry = fill.entry
+                if entry is None:
+                    fill.readers -= 1
+            if entry is not None:
+                entry.readers = max(0, entry.readers - 1)
+            self._evict()
+
+    def _evict(self):
+        """Remove idle entries until the quota is met; caller must hold the lock"""
+        if self.total_bytes <= self.max_bytes:
+            return
+        if self.policy == 'lfu':
+            order = lambda item: (item[1].hits, item[1].last_access)
+        else:
+            order = lambda item: item[1].last_access
+        for digest, entry in sorted(self._entries.items(), key=order):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if entry.readers > 0:
+                continue
+            try:
+                os.remove(entry.path)
+            except OSError as e:
+                logger.warning(f"Could not evict {entry.path}: {e}")
+                continue
+            del self._entries[digest]
+            self.total_bytes -= entry.size
+            self.evictions += 1
+
+    def stats(self):
+        """Return usage and hit/miss counters"""
+        with self._lock:
+            return {
+                'files': len(self._entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'policy': self.policy,
+                'filling': len(self._fills),
+                'hits': self.hits,
+                'misses': self.misses,
+                'joined_in_progress': self.joined,
+                'evictions': self.evictions,
+                'resumed_fills': self.resumed
+            }
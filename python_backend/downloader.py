@@ -0,0 +1,356 @@
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from manifest import url_expiry
+from proxy import UpstreamError
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from a segment response before each positional write
+WRITE_CHUNK_SIZE = 256 * 1024
+
+# Upstream statuses that retrying the same URL cannot fix
+FATAL_STATUSES = (401, 404)
+
+# Statuses that mean the signed URL has lapsed or was revoked
+EXPIRED_STATUSES = (403, 410)
+
+# Refresh a signed URL proactively when it has less than this many seconds left
+URL_REFRESH_MARGIN = 60
+
+# Suffix of the sidecar file recording which segments of a partial file are complete
+PROGRESS_SUFFIX = '.progress'
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """Exponential backoff with jitter for the given retry attempt (1-based)"""
+    ceiling = min(cap, base * (2 ** (attempt - 1)))
+    return random.uniform(ceiling / 2, ceiling)
+
+
+class _SegmentTracker:
+    """Tracks finished segments to report the contiguous prefix written so far"""
+
+    def __init__(self, segments, on_progress):
+        self._ends = {start: end for start, end in segments}
+        self._done = set()
+        self._next = segments[0][0] if segments else 0
+        self._on_progress = on_progress
+        self._lock = threading.Lock()
+
+    def finish(self, start):
+        with self._lock:
+            self._done.add(start)
+            advanced = False
+            while self._next in self._done:
+                self._next = self._ends[self._next] + 1
+                advanced = True
+            if advanced and self._on_progress:
+                self._on_progress(self._next)
+
+
+class _ProgressFile:
+    """Durable record of the completed segments of a partial download"""
+
+    def __init__(self, file_path, filesize, segment_size):
+        self.path = file_path + PROGRESS_SUFFIX
+        self.filesize = filesize
+        self.segment_size = segment_size
+        self.done = set()
+        self._lock = threading.Lock()
+
+    def load(self, file_path):
+        """Read completed segments left by an earlier attempt, if they still apply"""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        if (state.get('filesize') != self.filesize or state.get('segment_size') != self.segment_size
+                or not os.path.exists(file_path) or os.path.getsize(file_path) != self.filesize):
+            return set()
+        self.done = set(state.get('done', []))
+        return set(self.done)
+
+    def mark(self, start):
+        """Record a segment as complete; its bytes must already be on disk"""
+        with self._lock:
+            self.done.add(start)
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump({'filesize': self.filesize, 'segment_size': self.segment_size,
+                           'done': sorted(self.done)}, f)
+            os.replace(temp_path, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class _DownloadState:
+    """The current URL of a download plus its shared retry and refresh budgets"""
+
+    def __init__(self, url, refresh_url, retry_budget, max_refreshes):
+        self.url = url
+        self.generation = 0
+        self._refresh_url = refresh_url
+        self.retries_left = retry_budget
+        self.refreshes_left = max_refreshes if refresh_url else 0
+        self.retries = 0
+        self.refreshes = 0
+        self._lock = threading.Lock()
+
+    def current(self):
+        with self._lock:
+            return self.url, self.generation
+
+    def refresh(self, seen_generation):
+        """Re-resolve the URL unless another segment already did; False when out of refreshes"""
+        with self._lock:
+            if self.generation != seen_generation:
+                return True
+            if self.refreshes_left <= 0:
+                return False
+            self.refreshes_left -= 1
+            self.url = self._refresh_url()
+            self.generation += 1
+            self.refreshes += 1
+            logger.info("Re-resolved expired stream URL")
+            return True
+
+    def spend_retry(self):
+        """Take one retry from the download's budget; False when it is exhausted"""
+        with self._lock:
+            if self.retries_left <= 0:
+                return False
+            self.retries_left -= 1
+            self.retries += 1
+            return True
+
+
+class SegmentedDownloader:
+    """Downloads a stream of known size as concurrent byte-range segments.
+
+    Segments are fetched over a shared keep-alive connection pool and written
+    in place into a preallocated file, so per-connection throttling upstream
+    is multiplied by the parallelism. A failed segment is retried on its own
+    from the last byte it wrote, with exponential backoff and jitter, within a
+    retry budget shared by the whole download. Completed segments are recorded
+    in a sidecar file so that a later call for the same file skips them.
+    """
+
+    def __init__(self, connections=4, segment_size=8 * 1024 * 1024, max_retries=3,
+                 retry_budget=12, max_refreshes=2, timeout=15, session=None):
+        self.connections = connections
+        self.segment_size = segment_size
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+        self.max_refreshes = max_refreshes
+        self.timeout = timeout
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.session = session
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=50)
+        self.downloads = 0
+        self.segment_retries = 0
+        self.url_refreshes = 0
+        self.resumed_bytes = 0
+
+    def segments(self, filesize):
+        """Split a file size into inclusive (start, end) byte ranges"""
+        return [(start, min(start + self.segment_size, filesize) - 1)
+                for start in range(0, filesize, self.segment_size)]
+
+    def probe_size(self, url, headers=None):
+        """Learn a stream's size from a one-byte Range request, or None if ranges are unsupported"""
+        request_headers = dict(headers or {})
+        request_headers['Range'] = 'bytes=0-0'
+        with self.session.get(url, headers=request_headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code != 206:
+                return None
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            return int(total) if total.isdigit() else None
+
+    def download(self, url, file_path, filesize, headers=None, on_progress=None, refresh_url=None):
+        """Download url into file_path and return throughput figures.
+
+        on_progress, if given, is called with the length of the contiguous
+        prefix of the file that has been written. refresh_url, if given, is
+        called to obtain a fresh signed URL when the current one has lapsed.
+        Segments completed by an earlier call for the same file are reused.
+        """
+        headers = headers or {}
+        segments = self.segments(filesize)
+        tracker = _SegmentTracker(segments, on_progress)
+        progress = _ProgressFile(file_path, filesize, self.segment_size)
+        state = _DownloadState(url, refresh_url, self.retry_budget, self.max_refreshes)
+        started = time.monotonic()
+
+        expiry = url_expiry(url)
+        if expiry and expiry - time.time() < URL_REFRESH_MARGIN:
+            state.refresh(0)
+
+        if on_progress:
+            on_progress(0)
+        done = progress.load(file_path)
+        if not done:
+            # Nothing reusable; don't trust an old sidecar with a fresh file
+            progress.remove()
+        resumed = sum(end - start + 1 for start, end in segments if start in done)
+        for start, _ in segments:
+            if start in done:
+                tracker.finish(start)
+        if resumed:
+            logger.info(f"Resuming download with {resumed} of {filesize} bytes already on disk")
+
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        try:
+            self._preallocate(fd, filesize)
+            write_lock = threading.Lock()
+            pending = [(start, end) for start, end in segments if start not in done]
+            with ThreadPoolExecutor(max_workers=self.connections) as pool:
+                futures = [pool.submit(contextvars.copy_context().run, self._fetch_segment, state, headers, fd,
+                                       write_lock, progress, start, end)
+                           for start, end in pending]
+                try:
+                    for (start, _), future in zip(pending, futures):
+                        future.result()
+                        tracker.finish(start)
+                except Exception:
+                    # Don't start segments that can no longer be used
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            os.close(fd)
+            with self._lock:
+                self.segment_retries += state.retries
+                self.url_refreshes += state.refreshes
+        progress.remove()
+
+        seconds = max(time.monotonic() - started, 1e-6)
+        fetched = filesize - resumed
+        result = {
+            'bytes': filesize,
+            'fetched_bytes': fetched,
+            'seconds': round(seconds, 3),
+            'mb_per_s': round(fetched / seconds / (1024 * 1024), 2),
+            'segments': len(segments),
+            'connections': self.connections,
+            'retries': state.retries,
+            'url_refreshes': state.refreshes
+        }
+        with self._lock:
+            self.downloads += 1
+            self.resumed_bytes += resumed
+            self._recent.append(result)
+        logger.info(f"Downloaded {fetched} bytes in {len(pending)} segments over "
+                    f"{self.connections} connections: {result['mb_per_s']} MB/s")
+        return result
+
+    def _preallocate(self, fd, filesize):
+        """Reserve the full file size up front so segments can be written in place"""
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, filesize)
+                return
+            except OSError:
+                pass
+        os.ftruncate(fd, filesize)
+
+    def _write_at(self, fd, write_lock, data, offset):
+        """Write data at offset without disturbing other writers"""
+        view = memoryview(data)
+        if hasattr(os, 'pwrite'):
+            while view:
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+        else:
+            with write_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                while view:
+                    view = view[os.write(fd, view):]
+
+    def _fetch_segment(self, state, headers, fd, write_lock, progress, start, end):
+        """Fetch one byte range into place, continuing from the last written byte on failure"""
+        position = [start]
+        attempt = 0
+        while True:
+            url, generation = state.current()
+            try:
+                self._fetch_range(url, headers, fd, write_lock, position, end)
+                break
+            except UpstreamError as e:
+                if e.status_code in EXPIRED_STATUSES:
+                    if not state.refresh(generation):
+                        raise
+                    continue
+                # A 200 means Range is ignored, which no retry will change
+                if e.status_code in FATAL_STATUSES or e.status_code < 400:
+                    raise
+                error = e
+            except (requests.RequestException, IOError) as e:
+                error = e
+            attempt += 1
+            if attempt > self.max_retries or not state.spend_retry():
+                raise error
+            delay = backoff_delay(attempt)
+            logger.warning(f"Retrying segment {start}-{end} from byte {position[0]} "
+                           f"in {delay:.1f}s (attempt {attempt}): {error}")
+            time.sleep(delay)
+
+        # Make the segment durable before recording it as complete
+        os.fsync(fd)
+        progress.mark(start)
+
+    def _fetch_range(self, url, headers, fd, write_lock, position, end):
+        """Fetch bytes position[0]..end (inclusive), advancing position as they are written"""
+        request_headers = dict(headers)
+        request_headers['Range'] = f"bytes={position[0]}-{end}"
+        with self.session.get(url, headers=request_headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code >= 400:
+                raise UpstreamError(response.status_code,
+                                    f"Range {position[0]}-{end} returned HTTP {response.status_code}")
+            if response.status_code != 206:
+                raise UpstreamError(response.status_code, "Upstream did not honour the Range request")
+            for chunk in response.iter_content(chunk_size=WRITE_CHUNK_SIZE):
+                if position[0] + len(chunk) > end + 1:
+                    chunk = chunk[:end + 1 - position[0]]
+                self._write_at(fd, write_lock, chunk, position[0])
+                position[0] += len(chunk)
+            if position[0] != end + 1:
+                raise IOError(f"Range ended {end + 1 - position[0]} bytes early")
+
+    def stats(self):
+        """Return throughput of recent downloads for tuning segment size and parallelism"""
+        with self._lock:
+            recent = list(self._recent)
+            total_bytes = sum(r['fetched_bytes'] for r in recent)
+            total_seconds = sum(r['seconds'] for r in recent)
+            return {
+                'connections': self.connections,
+                'segment_size': self.segment_size,
+                'downloads': self.downloads,
+                'segment_retries': self.segment_retries,
+                'url_refreshes': self.url_refreshes,
+                'resumed_bytes': self.resumed_bytes,
+                'recent_mb_per_s': round(total_bytes / total_seconds / (1024 * 1024), 2) if total_seconds else 0.0,
+                'last': recent[-1] if recent else None
+            }
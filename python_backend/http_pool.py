@@ -0,0 +1,290 @@
+import io
+import json
+import logging
+import random
+import socket
+import threading
+from functools import partial
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlparse, urlunparse
+
+import requests
+from pytube import request as pytube_request
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from tracing import KIND_CLIENT
+
+logger = logging.getLogger(__name__)
+
+# Responses from these hosts are media and are streamed; anything else is
+# read in full so its connection goes straight back to the pool
+MEDIA_HOST_SUFFIX = '.googlevideo.com'
+
+
+# Set on requests redirected to an upstream override, naming the host they were meant for
+FORWARDED_HOST_HEADER = 'X-Forwarded-Host'
+
+
+def host_group(host):
+    """Label for a host in pool stats; the many googlevideo.com edge hosts share one"""
+    if host and host.endswith(MEDIA_HOST_SUFFIX):
+        return '*' + MEDIA_HOST_SUFFIX
+    return host
+
+
+class _CountingPoolMixin:
+    """Reports every new connection, i.e. every TCP (and TLS) handshake"""
+
+    def __init__(self, *args, on_connect=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._on_connect = on_connect
+
+    def _new_conn(self):
+        if self._on_connect:
+            self._on_connect(self.host)
+        return super()._new_conn()
+
+
+class _CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class _CountingAdapter(HTTPAdapter):
+    """HTTPAdapter whose per-host connection pools count their handshakes, and responses their body bytes"""
+
+    def __init__(self, on_connect, on_bytes, **kwargs):
+        self._on_connect = on_connect
+        self._on_bytes = on_bytes
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': partial(_CountingHTTPConnectionPool, on_connect=self._on_connect),
+            'https': partial(_CountingHTTPSConnectionPool, on_connect=self._on_connect)
+        }
+
+    def build_response(self, req, resp):
+        response = super().build_response(req, resp)
+        host = req.headers.get(FORWARDED_HOST_HEADER) or urlparse(response.url).hostname
+        on_bytes = self._on_bytes
+        # requests reads bodies through read(), or read_chunked() for chunked
+        # responses; both are wrapped on this one response object
+        read, read_chunked = resp.read, resp.read_chunked
+
+        def counting_read(*args, **kwargs):
+            data = read(*args, **kwargs)
+            on_bytes(host, len(data))
+            return data
+
+        def counting_read_chunked(*args, **kwargs):
+            for chunk in read_chunked(*args, **kwargs):
+                on_bytes(host, len(chunk))
+                yield chunk
+
+        resp.read = counting_read
+        resp.read_chunked = counting_read_chunked
+        return response
+
+
+class _PooledSession(requests.Session):
+    """Session that fills in a rotating User-Agent and a default timeout"""
+
+    def __init__(self, pool):
+        super().__init__()
+        self._pool = pool
+
+    def request(self, method, url, headers=None, **kwargs):
+        request_headers = {'User-Agent': random.choice(self._pool.user_agents)}
+        request_headers.update(headers or {})
+        kwargs.setdefault('timeout', self._pool.timeout)
+        parsed = urlparse(url)
+        self._pool._count_request(parsed.hostname)
+        override = self._pool.upstream_override
+        if override:
+            request_headers[FORWARDED_HOST_HEADER] = parsed.hostname
+            url = urlunparse(parsed._replace(scheme=override.scheme, netloc=override.netloc))
+        tracer = self._pool.tracer
+        if not tracer:
+            return super().request(method, url, headers=request_headers, **kwargs)
+        # The span covers the call up to the response headers; streamed bodies are read later
+        with tracer.span(f"{method} {host_group(parsed.hostname)}", KIND_CLIENT,
+                         **{'http.request.method': method, 'server.address': parsed.hostname or ''}) as span:
+            request_headers.update(tracer.outbound_headers())
+            response = super().request(method, url, headers=request_headers, **kwargs)
+            if span:
+                span.set('http.response.status_code', response.status_code)
+            return response
+
+
+class _UrllibResponse:
+    """The parts of urllib's HTTP response that pytube uses, backed by a requests response"""
+
+    def __init__(self, response, streamed):
+        self._response = response
+        # Bodies that were not streamed have already been read off the connection
+        self._body = None if streamed else io.BytesIO(response.content)
+        self.status = response.status_code
+        self.headers = response.headers
+
+    def read(self, amt=None):
+        if self._body is not None:
+            return self._body.read(amt)
+        data = self._response.raw.read(amt, decode_content=True)
+        if amt is None or not data:
+            self._response.close()
+        return data
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.status
+
+    def close(self):
+        self._response.close()
+
+    def __del__(self):
+        # pytube drops some responses unread (stream() probes the size with
+        # one); release their connection instead of leaving it checked out
+        self._response.close()
+
+
+class HttpPool:
+    """Process-wide outbound HTTP client with keep-alive connection pools per host.
+
+    Every request made through session reuses an idle connection to its host
+    when there is one, so TCP and TLS handshakes are only paid when more
+    requests run at once than have run before. Requests without a
+    User-Agent get one picked from user_agents. install_pytube() routes
+    pytube's own requests through the same pools.
+
+    With an upstream_override base URL, every request is sent there instead,
+    with the host it was meant for in X-Forwarded-Host; benchmarks use this
+    to point the backend at a local stand-in for YouTube. With a tracer,
+    every request carries the current trace in a traceparent header and is
+    a client span of it.
+    """
+
+    def __init__(self, user_agents, max_hosts=32, connections_per_host=16, timeout=(5, 15), upstream_override=None,
+                 tracer=None):
+        self.user_agents = user_agents
+        self.upstream_override = urlparse(upstream_override) if upstream_override else None
+        self.tracer = tracer
+        self.max_hosts = max_hosts
+        self.connections_per_host = connections_per_host
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._hosts = {}  # host group -> {'requests', 'handshakes', 'bytes'}
+        self.adapter = _CountingAdapter(self._count_handshake, self._count_bytes, pool_connections=max_hosts,
+                                        pool_maxsize=connections_per_host)
+        self.session = _PooledSession(self)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+    def _counters(self, host):
+        return self._hosts.setdefault(host_group(host), {'requests': 0, 'handshakes': 0, 'bytes': 0})
+
+    def _count_request(self, host):
+        with self._lock:
+            self._counters(host)['requests'] += 1
+
+    def _count_handshake(self, host):
+        with self._lock:
+            self._counters(host)['handshakes'] += 1
+
+    def _count_bytes(self, host, size):
+        with self._lock:
+            self._counters(host)['bytes'] += size
+
+    def install_pytube(self):
+        """Send pytube's requests through the pool instead of a fresh urllib connection each"""
+        pytube_request._execute_request = self.execute_pytube_request
+
+    def execute_pytube_request(self, url, method=None, headers=None, data=None,
+                               timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        """Drop-in for pytube.request._execute_request, raising urllib's errors as pytube expects"""
+        if not url.lower().startswith('http'):
+            raise ValueError("Invalid URL")
+        request_headers = {'accept-language': 'en-US,en'}
+        request_headers.update(headers or {})
+        if data and not isinstance(data, bytes):
+            data = json.dumps(data).encode('utf-8')
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = self.timeout
+        method = method or ('POST' if data else 'GET')
+        stream = method == 'GET' and (urlparse(url).hostname or '').endswith(MEDIA_HOST_SUFFIX)
+
+        try:
+            response = self.session.request(method, url, headers=request_headers, data=data,
+                                            timeout=timeout, stream=stream)
+        except requests.Timeout as e:
+            raise URLError(socket.timeout(str(e)))
+        except requests.RequestException as e:
+            raise URLError(e)
+        if response.status_code >= 400:
+            body = response.content
+            response.close()
+            raise HTTPError(url, response.status_code, response.reason, response.headers, io.BytesIO(body))
+        return _UrllibResponse(response, stream)
+
+    def warm(self, url, connections=1):
+        """Open up to connections keep-alive connections to url's host before they are needed.
+
+        HEAD requests are sent at once so each takes its own connection, and
+        the connections stay idle in the pool afterwards. Any response counts;
+        raises the last error if no request got one.
+        """
+        errors = []
+
+        def head():
+            try:
+                self.session.head(url, allow_redirects=False).close()
+            except requests.RequestException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=head, name='pool-warm', daemon=True)
+                   for _ in range(max(1, min(connections, self.connections_per_host)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if len(errors) == len(threads):
+            raise errors[-1]
+        return len(threads) - len(errors)
+
+    def stats(self):
+        """Return request, handshake and body byte counts, and connections in use or idle, per host"""
+        hosts = {}
+        with self._lock:
+            for host, counters in self._hosts.items():
+                hosts[host] = dict(counters, in_use=0, idle=0)
+
+        pools = self.adapter.poolmanager.pools
+        with pools.lock:
+            open_pools = list(pools._container.values())
+        for pool in open_pools:
+            queue = pool.pool
+            if queue is None:
+                continue
+            counters = hosts.setdefault(host_group(pool.host),
+                                        {'requests': 0, 'handshakes': 0, 'bytes': 0, 'in_use': 0, 'idle': 0})
+            counters['in_use'] += queue.maxsize - queue.qsize()
+            counters['idle'] += sum(1 for conn in list(queue.queue) if conn is not None)
+
+        total_requests = sum(h['requests'] for h in hosts.values())
+        total_handshakes = sum(h['handshakes'] for h in hosts.values())
+        return {
+            'max_hosts': self.max_hosts,
+            'connections_per_host': self.connections_per_host,
+            'requests': total_requests,
+            'handshakes': total_handshakes,
+            'reused': max(0, total_requests - total_handshakes),
+            'bytes': sum(h['bytes'] for h in hosts.values()),
+            'hosts': hosts
+        }
@@ -0,0 +1,102 @@
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# "import time: self [us] | cumulative | imported package", nested imports indented
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def local_modules():
+    return {name[:-3] for name in os.listdir(BACKEND_DIR) if name.endswith('.py')}
+
+
+def measure(module, env=None):
+    """Run one `python -X importtime` import of module; returns [(name, depth, self_us, cumulative_us)]"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"], cwd=BACKEND_DIR,
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            imports.append((name, (len(indent) - 1) // 2, int(self_us), int(cumulative_us)))
+    return imports
+
+
+def summarize(imports, module, local):
+    """Import time of module in total, for its own body, and per top-level package and local module"""
+    total = next((cumulative for name, depth, _, cumulative in imports if name == module and depth == 0), None)
+    if total is None:
+        raise RuntimeError(f"{module} is not in the import time report")
+    packages = {}
+    for name, _, self_us, _ in imports:
+        package = name.split('.', 1)[0]
+        packages[package] = packages.get(package, 0) + self_us
+    return {
+        'total': total,
+        'module_body': next(self_us for name, depth, self_us, _ in imports if name == module and depth == 0),
+        'packages': packages,
+        'local': {name: cumulative for name, _, _, cumulative in imports if name in local and name != module}
+    }
+
+
+def median_runs(runs):
+    """Per-key medians over several summaries; keys missing from a run count as 0"""
+    def median(values):
+        return round(statistics.median(values) / 1000, 2)
+
+    merged = {'total_ms': median([run['total'] for run in runs]),
+              'module_body_ms': median([run['module_body'] for run in runs])}
+    for key in ('packages', 'local'):
+        names = set().union(*(run[key] for run in runs))
+        merged[f"{key}_ms"] = dict(sorted(((name, median([run[key].get(name, 0) for run in runs]))
+                                           for name in names), key=lambda item: -item[1]))
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report where the time to import the backend goes")
+    parser.add_argument('--module', default='app', help='module to import, e.g. app or asgi')
+    parser.add_argument('--runs', type=int, default=5, help='imports measured; medians are reported')
+    parser.add_argument('--top', type=int, default=15, help='packages listed')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra environment for the import, e.g. DOWNLOAD_CACHE_DIR=/tmp/cache')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    parser.add_argument('--max-ms', type=float, help='exit with status 1 if the median import takes longer')
+    args = parser.parse_args()
+
+    env = dict(os.environ, **dict(item.split('=', 1) for item in args.env))
+    local = local_modules()
+    # The first import also compiles bytecode; leave it out
+    measure(args.module, env)
+    report = median_runs([summarize(measure(args.module, env), args.module, local) for _ in range(args.runs)])
+
+    print(f"import {args.module}: {report['total_ms']}ms (median of {args.runs}), "
+          f"{report['module_body_ms']}ms of it in the module body")
+    print("Packages (own time of all their modules):")
+    for name, ms in list(report['packages_ms'].items())[:args.top]:
+        share = ms / report['total_ms'] if report['total_ms'] else 0
+        print(f"  {name:24} {ms:8.2f}ms {share:6.1%}")
+    print("Backend modules (including what they import first):")
+    for name, ms in report['local_ms'].items():
+        print(f"  {name:24} {ms:8.2f}ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(report, module=args.module, runs=args.runs), f, indent=2)
+        print(f"Report written to {args.output}")
+    if args.max_ms is not None and report['total_ms'] > args.max_ms:
+        print(f"Import takes {report['total_ms']}ms, over the {args.max_ms}ms budget")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
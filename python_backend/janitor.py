@@ -0,0 +1,113 @@
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Before downloads went through the download cache, each request wrote to a
+# temp dir named str(uuid.uuid4()) in the download dir; nothing creates them now
+LEGACY_TEMP_DIR_PATTERN = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}$')
+
+
+def is_legacy_temp_dir(name):
+    return bool(LEGACY_TEMP_DIR_PATTERN.match(name))
+
+
+def directory_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return total
+
+
+class Janitor:
+    """Background thread that reclaims disk space left behind by interrupted requests.
+
+    Every interval seconds it runs each of the sweeps, such as a cache's
+    partial file cleanup. Until none are left, it also removes the
+    per-request temp directories of the old download layout (named by a
+    hyphenated uuid4) under root once they are max_age seconds old; this is
+    a one-time cleanup after upgrading, as nothing creates them any more.
+    """
+
+    def __init__(self, root, interval=300, max_age=3600, sweeps=()):
+        self.root = root
+        self.interval = interval
+        self.max_age = max_age
+        self.sweeps = list(sweeps)
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.removed_dirs = 0
+        self.removed_bytes = 0
+        self.legacy_cleaned = False
+
+    def start(self):
+        threading.Thread(target=self._loop, name='janitor', daemon=True).start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run()
+            except Exception:
+                logger.exception("Janitor run failed")
+
+    def run(self):
+        """Run the sweeps once, and remove old-layout temp directories while any are left"""
+        removed_dirs = removed_bytes = 0
+        if not self.legacy_cleaned:
+            removed_dirs, removed_bytes, remaining = self._remove_legacy_temp_dirs()
+            self.legacy_cleaned = not remaining
+
+        for sweep in self.sweeps:
+            sweep()
+
+        with self._lock:
+            self.runs += 1
+            self.removed_dirs += removed_dirs
+            self.removed_bytes += removed_bytes
+
+    def _legacy_temp_dirs(self):
+        return [os.path.join(self.root, name) for name in os.listdir(self.root)
+                if is_legacy_temp_dir(name) and os.path.isdir(os.path.join(self.root, name))]
+
+    def _remove_legacy_temp_dirs(self):
+        """Remove old-layout temp directories older than max_age; returns (removed, bytes, still there)"""
+        cutoff = time.time() - self.max_age
+        removed_dirs = removed_bytes = remaining = 0
+        for path in self._legacy_temp_dirs():
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    remaining += 1
+                    continue
+                size = directory_size(path)
+                shutil.rmtree(path)
+            except OSError as e:
+                logger.warning(f"Could not remove orphaned temp dir {path}: {e}")
+                remaining += 1
+                continue
+            removed_dirs += 1
+            removed_bytes += size
+        if removed_dirs:
+            logger.info(f"Janitor removed {removed_dirs} orphaned temp dirs ({removed_bytes} bytes)")
+        if not remaining:
+            logger.info("No temp dirs of the old download layout are left")
+        return removed_dirs, removed_bytes, remaining
+
+    def temp_bytes(self):
+        """Bytes still held by old-layout temp directories under root"""
+        if self.legacy_cleaned:
+            return 0
+        return sum(directory_size(path) for path in self._legacy_temp_dirs())
+
+    def stats(self):
+        with self._lock:
+            return {'runs': self.runs, 'removed_dirs': self.removed_dirs, 'removed_bytes': self.removed_bytes,
+                    'legacy_cleaned': self.legacy_cleaned}
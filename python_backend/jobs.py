@@ -0,0 +1,342 @@
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATES = ('queued', 'running')
+TERMINAL_STATES = ('completed', 'failed', 'cancelled')
+
+# Assumed run time of a job before any has completed, for wait estimates
+DEFAULT_JOB_SECONDS = 10
+
+# Completed jobs whose run times are averaged for wait estimates
+DURATION_SAMPLES = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    dedup_key TEXT NOT NULL,
+    url TEXT NOT NULL,
+    video_id TEXT,
+    format TEXT NOT NULL,
+    quality TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    error_status INTEGER,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_dedup ON jobs (dedup_key, state);
+CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished_at);
+"""
+
+# Columns added after the first release, applied to existing databases on open
+MIGRATIONS = {
+    'group_id': 'ALTER TABLE jobs ADD COLUMN group_id TEXT',
+    'group_limit': 'ALTER TABLE jobs ADD COLUMN group_limit INTEGER',
+    'options': 'ALTER TABLE jobs ADD COLUMN options TEXT'
+}
+
+
+class JobError(Exception):
+    """A job failure with the HTTP status that best describes it"""
+
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class JobQueue:
+    """Priority queue of download jobs run by a fixed pool of worker threads.
+
+    Job state lives in a SQLite file so queued work survives a restart; jobs
+    that were running when the process stopped are queued again. Submitting a
+    job identical to one that is queued, running or completed with its result
+    still available returns the existing job instead of adding another.
+
+    runner(job, publish) does the work and returns the job's result dict. It
+    may call publish(result) early, once callers can attach to the output
+    while it is still being produced.
+
+    Jobs submitted with a group (such as the videos of one playlist) run at
+    most group_limit at a time, leaving the other workers to everyone else.
+
+    Nothing is opened or started until start().
+    """
+
+    def __init__(self, db_path, runner, workers=2, is_result_available=None, retention=86400):
+        self.runner = runner
+        self.workers = workers
+        self.retention = retention
+        self._is_result_available = is_result_available or (lambda result: True)
+        self.db_path = db_path
+        self._db = None
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._ready = {}  # job id -> Event set once a result is published or the job ends
+        self._groups = {}  # queued job id -> (group id, limit)
+        self._group_running = {}  # group id -> running jobs
+        self._busy = 0
+        # Jobs in the heap that are still queued; cancelled ones stay in the heap until popped
+        self._queued = 0
+        self._contexts = {}  # queued job id -> contextvars.Context of its submitter
+        self._durations = deque(maxlen=DURATION_SAMPLES)
+
+    def start(self):
+        """Open the database, queue the jobs a previous process left unfinished and start the workers"""
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+        self._migrate()
+        self._restore()
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True).start()
+        return self
+
+    def _migrate(self):
+        columns = {row['name'] for row in self._db.execute('PRAGMA table_info(jobs)')}
+        for column, statement in MIGRATIONS.items():
+            if column not in columns:
+                self._db.execute(statement)
+        self._db.commit()
+
+    def _restore(self):
+        """Queue jobs left unfinished by a previous process"""
+        with self._cond:
+            self._prune()
+            self._db.execute("UPDATE jobs SET state = 'queued', started_at = NULL, result = NULL "
+                             "WHERE state = 'running'")
+            self._db.commit()
+            rows = self._db.execute("SELECT id, priority, group_id, group_limit FROM jobs "
+                                    "WHERE state = 'queued' ORDER BY created_at").fetchall()
+            for row in rows:
+                self._push(row['id'], row['priority'], row['group_id'], row['group_limit'])
+        if rows:
+            logger.info(f"Restored {len(rows)} queued jobs")
+
+    def _prune(self):
+        """Forget finished jobs older than the retention window; caller must hold the lock"""
+        self._db.execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?",
+                         (time.time() - self.retention,))
+
+    def _push(self, job_id, priority, group_id=None, group_limit=None):
+        """Queue a job id; higher priority runs first, then oldest first"""
+        heapq.heappush(self._heap, (-priority, next(self._seq), job_id))
+        self._queued += 1
+        if group_id and group_limit:
+            self._groups[job_id] = (group_id, group_limit)
+        self._ready.setdefault(job_id, threading.Event())
+        self._cond.notify()
+
+    @staticmethod
+    def _to_dict(row):
+        if row is None:
+            return None
+        job = dict(row)
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        job['options'] = json.loads(job['options']) if job['options'] else None
+        return job
+
+    def _get(self, job_id):
+        """Fetch a job row as a dict; caller must hold the lock"""
+        return self._to_dict(self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def get(self, job_id):
+        """Return a job as a dict, or None"""
+        with self._cond:
+            return self._get(job_id)
+
+    def submit(self, url, video_id, format_type, quality, priority=0, group_id=None, group_limit=None,
+               options=None):
+        """Queue a job, or return an identical existing one.
+
+        options is a JSON-serializable dict of further settings for the runner
+        (such as a clip's start and end); it is part of what makes jobs identical.
+        Returns (job, created).
+        """
+        options = json.dumps(options, sort_keys=True) if options else None
+        dedup_key = f"{video_id or url}:{format_type}:{quality}"
+        if options:
+            dedup_key += f":{options}"
+        with self._cond:
+            rows = self._db.execute(
+                "SELECT * FROM jobs WHERE dedup_key = ? AND state IN ('queued', 'running', 'completed') "
+                "ORDER BY created_at DESC", (dedup_key,)).fetchall()
+            for row in rows:
+                job = self._to_dict(row)
+                if job['state'] != 'completed' or self._is_result_available(job['result']):
+                    return job, False
+
+            job_id = uuid.uuid4().hex
+            self._db.execute(
+                "INSERT INTO jobs (id, dedup_key, url, video_id, format, quality, priority, state, created_at, "
+                "group_id, group_limit, options) VALUES (?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?, ?, ?)",
+                (job_id, dedup_key, url, video_id, format_type, quality, priority, time.time(),
+                 group_id, group_limit, options))
+            self._prune()
+            self._db.commit()
+            # The job runs in a copy of the submitter's context, so it stays in the request's trace
+            self._contexts[job_id] = contextvars.copy_context()
+            self._push(job_id, priority, group_id, group_limit)
+            return self._get(job_id), True
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job; returns the job, or None if it does not exist.
+
+        A running job's work is not interrupted (other requests may share its
+        output) but the job is marked cancelled and its result discarded.
+        """
+        with self._cond:
+            job = self._get(job_id)
+            if job is not None and job['state'] == 'queued':
+                # Left in the heap for a worker to skip, but no longer counted as pending
+                self._queued -= 1
+            self._db.execute("UPDATE jobs SET state = 'cancelled', finished_at = ? "
+                             "WHERE id = ? AND state IN ('queued', 'running')", (time.time(), job_id))
+            self._db.commit()
+            job = self._get(job_id)
+        if job is not None and job['state'] == 'cancelled':
+            self._ready.get(job_id, threading.Event()).set()
+        return job
+
+    def wait_ready(self, job_id, timeout=None):
+        """Block until a job has published a result or finished, then return it"""
+        with self._cond:
+            event = self._ready.get(job_id)
+            job = self._get(job_id)
+        if event is not None and job is not None and job['state'] in ACTIVE_STATES and not job['result']:
+            event.wait(timeout)
+            job = self.get(job_id)
+        return job
+
+    def _publish(self, job_id, result):
+        """Store a result that callers can attach to before the job completes"""
+        with self._cond:
+            self._db.execute("UPDATE jobs SET result = ? WHERE id = ? AND state = 'running'",
+                             (json.dumps(result), job_id))
+            self._db.commit()
+        self._ready[job_id].set()
+
+    def _finish(self, job_id, state, result=None, error=None, error_status=None):
+        """Record a job's outcome unless it was cancelled meanwhile"""
+        with self._cond:
+            self._db.execute(
+                "UPDATE jobs SET state = ?, result = COALESCE(?, result), error = ?, error_status = ?, "
+                "finished_at = ? WHERE id = ? AND state = 'running'",
+                (state, json.dumps(result) if result is not None else None, error, error_status,
+                 time.time(), job_id))
+            self._db.commit()
+            self._busy -= 1
+            self._release_group(job_id)
+        self._ready.pop(job_id, threading.Event()).set()
+
+    def _release_group(self, job_id):
+        """Free a popped job's slot in its group; caller must hold the lock"""
+        group = self._groups.pop(job_id, None)
+        if group:
+            self._group_running[group[0]] -= 1
+            if not self._group_running[group[0]]:
+                del self._group_running[group[0]]
+            # A job held back by its group's limit may now run
+            self._cond.notify_all()
+
+    def _pop_runnable(self):
+        """Pop the highest priority job whose group is under its limit; caller must hold the lock"""
+        held_back = []
+        try:
+            while self._heap:
+                item = heapq.heappop(self._heap)
+                group = self._groups.get(item[2])
+                if group and self._group_running.get(group[0], 0) >= group[1]:
+                    held_back.append(item)
+                    continue
+                if group:
+                    self._group_running[group[0]] = self._group_running.get(group[0], 0) + 1
+                return item[2]
+            return None
+        finally:
+            for item in held_back:
+                heapq.heappush(self._heap, item)
+
+    def _work(self):
+        """Worker loop: run the highest priority queued job"""
+        while True:
+            with self._cond:
+                job_id = self._pop_runnable()
+                while job_id is None:
+                    self._cond.wait()
+                    job_id = self._pop_runnable()
+                job = self._get(job_id)
+                if job is None or job['state'] != 'queued':
+                    # Cancelled while queued, which already uncounted it
+                    if job is None:
+                        self._queued -= 1
+                    self._contexts.pop(job_id, None)
+                    self._release_group(job_id)
+                    self._ready.pop(job_id, threading.Event()).set()
+                    continue
+                self._queued -= 1
+                self._db.execute("UPDATE jobs SET state = 'running', started_at = ? WHERE id = ?",
+                                 (time.time(), job_id))
+                self._db.commit()
+                self._busy += 1
+                job = self._get(job_id)
+
+            logger.info(f"Running job {job_id} ({job['format']} {job['quality']} {job['url']})")
+            started = time.monotonic()
+            try:
+                # Jobs restored from the database have no submitter
+                context = self._contexts.pop(job_id, None) or contextvars.Context()
+                result = context.run(self.runner, job, lambda result: self._publish(job_id, result))
+                with self._cond:
+                    self._durations.append(time.monotonic() - started)
+                self._finish(job_id, 'completed', result=result)
+            except JobError as e:
+                logger.error(f"Job {job_id} failed: {e}")
+                self._finish(job_id, 'failed', error=str(e), error_status=e.status_code)
+            except Exception as e:
+                logger.exception(f"Job {job_id} failed")
+                self._finish(job_id, 'failed', error=str(e), error_status=500)
+
+    def _average_duration(self):
+        """Mean run time of recently completed jobs; caller must hold the lock"""
+        if not self._durations:
+            return DEFAULT_JOB_SECONDS
+        return sum(self._durations) / len(self._durations)
+
+    def pending(self):
+        """Number of jobs queued or running"""
+        with self._cond:
+            return self._queued + self._busy
+
+    def estimate_wait(self, jobs_ahead=None):
+        """Seconds until the workers get through jobs_ahead jobs (by default everything pending)"""
+        with self._cond:
+            if jobs_ahead is None:
+                jobs_ahead = self._queued + self._busy
+            return max(1, jobs_ahead) * self._average_duration() / self.workers
+
+    def stats(self):
+        """Return queue depth, job counts by state and the recent average job run time"""
+        with self._cond:
+            counts = dict(self._db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            return {
+                'workers': self.workers,
+                'busy_workers': self._busy,
+                'queue_depth': counts.get('queued', 0),
+                'avg_job_seconds': round(self._average_duration(), 3),
+                'states': counts
+            }
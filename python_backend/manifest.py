@@ -0,0 +1,267 @@
+import copy
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+import pytube
+from pytube import extract, request as pytube_request
+from pytube.cipher import Cipher
+
+logger = logging.getLogger(__name__)
+
+# Stream URLs are refreshed this many seconds before their signed expiry so
+# that a download started from a cached URL does not lapse mid-transfer
+EXPIRY_MARGIN = 300
+
+# Signed googlevideo URLs normally last six hours; used when no expire param is present
+DEFAULT_URL_LIFETIME = 6 * 3600
+
+
+def _digits(value):
+    """Integer value of a pytube-style label such as '720p' or '128kbps'"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    digits = ''.join(filter(str.isdigit, str(value)))
+    return int(digits) if digits else None
+
+
+def url_expiry(url):
+    """Return the unix time a signed stream URL expires at, or None"""
+    expire = parse_qs(urlparse(url).query).get('expire', [None])[0]
+    try:
+        return int(expire)
+    except (TypeError, ValueError):
+        return None
+
+
+def stream_to_dict(stream):
+    """Serialize a pytube Stream to a plain dict that can be cached"""
+    return {
+        'itag': stream.itag,
+        'mime_type': stream.mime_type,
+        'type': stream.type,
+        'subtype': stream.subtype,
+        'codecs': list(stream.codecs),
+        'resolution': stream.resolution,
+        'fps': getattr(stream, 'fps', None),
+        'abr': stream.abr,
+        # Read the manifest's contentLength directly; Stream.filesize would
+        # issue a HEAD request when it is missing
+        'filesize': stream._filesize or None,
+        'progressive': stream.is_progressive,
+        'includes_audio': stream.includes_audio_track,
+        'includes_video': stream.includes_video_track,
+        'url': stream.url
+    }
+
+
+def build_manifest(yt, video_id):
+    """Resolve the stream list for an initialized YouTube object.
+
+    Returns (manifest, ttl) where ttl is derived from the earliest expiry of
+    the signed stream URLs.
+    """
+    streams = [stream_to_dict(s) for s in yt.streams]
+    now = time.time()
+    expiries = [e for e in (url_expiry(s['url']) for s in streams) if e]
+    expires_at = min(expiries) if expiries else now + DEFAULT_URL_LIFETIME
+    manifest = {
+        'id': video_id,
+        'title': yt.title,
+        'author': yt.author,
+        'length': yt.length,
+        'streams': streams,
+        'expires_at': expires_at
+    }
+    return manifest, max(0, expires_at - now - EXPIRY_MARGIN)
+
+
+def _ordered(streams, key, descending=False):
+    """Sort streams by the integer value of an attribute, dropping those without it"""
+    present = [s for s in streams if _digits(s.get(key)) is not None]
+    return sorted(present, key=lambda s: _digits(s[key]), reverse=descending)
+
+
+def select_audio_stream(manifest, subtype=None):
+    """Pick the highest bitrate audio-only stream, optionally of one subtype"""
+    audio = [s for s in manifest['streams']
+             if s['type'] == 'audio' and (subtype is None or s['subtype'] == subtype)]
+    ordered = _ordered(audio, 'abr', descending=True)
+    return ordered[0] if ordered else None
+
+
+def select_video_stream(manifest, quality):
+    """Pick a progressive MP4 stream closest to the requested quality"""
+    progressive = [s for s in manifest['streams']
+                   if s['progressive'] and s['subtype'] == 'mp4']
+    exact = [s for s in progressive if s['resolution'] == quality]
+    if quality in ('1080p', '720p'):
+        if exact:
+            return exact[0]
+        ordered = _ordered(progressive, 'resolution', descending=True)
+    else:
+        # For 480p/360p or other qualities
+        exact = [s for s in progressive if s['resolution'] == '360p']
+        if exact:
+            return exact[0]
+        ordered = _ordered(progressive, 'resolution')
+    if ordered:
+        return ordered[0]
+
+    # If no progressive stream found, try any MP4 stream as fallback
+    mp4 = [s for s in manifest['streams'] if s['subtype'] == 'mp4']
+    return mp4[0] if mp4 else None
+
+
+# Video codecs in order of player support, preferred when several adaptive
+# streams have the same resolution
+VIDEO_CODEC_PREFERENCE = ('avc1', 'vp9', 'vp09', 'av01')
+
+
+def _codec_rank(stream):
+    codec = stream['codecs'][0] if stream.get('codecs') else ''
+    for rank, prefix in enumerate(VIDEO_CODEC_PREFERENCE):
+        if codec.startswith(prefix):
+            return rank
+    return len(VIDEO_CODEC_PREFERENCE)
+
+
+def select_adaptive_streams(manifest, quality, only_if_better=True):
+    """Pick a video-only and an audio-only stream to mux when no progressive stream reaches a quality.
+
+    Returns (video, audio), or None when a progressive stream is good enough
+    or the adaptive streams offer nothing better. With only_if_better=False
+    the best pair up to the quality is returned regardless, for callers that
+    need the adaptive streams' indexes.
+    """
+    target = _digits(quality)
+    if not target:
+        return None
+    best_progressive = 0
+    if only_if_better:
+        progressive = [_digits(s['resolution']) for s in manifest['streams']
+                       if s['progressive'] and s['subtype'] == 'mp4' and _digits(s['resolution'])]
+        best_progressive = max(progressive, default=0)
+        if best_progressive >= target:
+            return None
+
+    video_only = [s for s in manifest['streams']
+                  if s['type'] == 'video' and not s['includes_audio'] and _digits(s['resolution'])]
+    fitting = [s for s in video_only if best_progressive < _digits(s['resolution']) <= target]
+    if not fitting and not only_if_better:
+        # Nothing as small as asked for; take the smallest there is
+        fitting = _ordered(video_only, 'resolution')[:1]
+    if not fitting:
+        return None
+    # Highest resolution first, then the most widely playable codec, then frame rate
+    video = min(fitting, key=lambda s: (-_digits(s['resolution']), _codec_rank(s), -(s.get('fps') or 0)))
+    audio = select_audio_stream(manifest, 'mp4') or select_audio_stream(manifest)
+    if not audio:
+        return None
+    return video, audio
+
+
+def select_stream(manifest, format_type, quality, source_subtype=None):
+    """Pick the stream to serve for a format/quality request.
+
+    Audio formats prefer a source_subtype stream, which can be remuxed into
+    the output without re-encoding, and otherwise take the best audio stream.
+    """
+    if format_type in ('mp3', 'm4a', 'webm'):
+        return (source_subtype and select_audio_stream(manifest, source_subtype)) or select_audio_stream(manifest)
+    return select_video_stream(manifest, quality)
+
+
+def download_stream(stream, file_path):
+    """Download a manifest stream's URL to file_path and return the path"""
+    with open(file_path, 'wb') as f:
+        for chunk in pytube_request.stream(stream['url']):
+            f.write(chunk)
+    return file_path
+
+
+class _ParsedPlayer:
+    """The parts of a player's Cipher that stay the same from video to video"""
+
+    def __init__(self, cipher):
+        self.transform_plan = cipher.transform_plan
+        self.transform_map = cipher.transform_map
+        self.js_func_patterns = cipher.js_func_patterns
+        self.throttling_plan = cipher.throttling_plan
+        # calculate_n() writes a video's n into the array; keep an untouched copy
+        self.throttling_array = copy.deepcopy(cipher.throttling_array)
+
+    def cipher(self):
+        """A fresh Cipher for one video, built without parsing the player again"""
+        cipher = Cipher.__new__(Cipher)
+        cipher.transform_plan = self.transform_plan
+        cipher.transform_map = self.transform_map
+        cipher.js_func_patterns = self.js_func_patterns
+        cipher.throttling_plan = self.throttling_plan
+        # The array refers to itself; deepcopy keeps that reference pointing at the copy
+        cipher.throttling_array = copy.deepcopy(self.throttling_array)
+        cipher.calculated_n = None
+        return cipher
+
+
+class CipherCache:
+    """Reuses parsed player ciphers across videos served by the same player JS.
+
+    pytube already keeps the most recent player JS text in memory, but it
+    rebuilds the Cipher (a regex parse of the whole player) for every video.
+    A Cipher keeps the n value it calculated for its video, so only the parsed
+    parts are cached and every call gets a Cipher of its own.
+    """
+
+    def __init__(self, max_players=4):
+        self.max_players = max_players
+        self._players = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _player_key(self, js):
+        """Identify the player: its version when pytube knows the URL, else a digest"""
+        if js is pytube.__js__ and pytube.__js_url__:
+            parts = urlparse(pytube.__js_url__).path.split('/')
+            if 'player' in parts and parts.index('player') + 1 < len(parts):
+                return parts[parts.index('player') + 1]
+        return hashlib.sha1(js.encode('utf-8')).hexdigest()
+
+    def get(self, js):
+        """Return a new Cipher for the given player JS, parsing the player only once"""
+        key = self._player_key(js)
+        with self._lock:
+            player = self._players.get(key)
+            if player is not None:
+                self._players.move_to_end(key)
+                self.hits += 1
+                return player.cipher()
+            self.misses += 1
+
+        # Parse outside the lock; a failed parse raises and is not cached
+        cipher = Cipher(js=js)
+        logger.info(f"Parsed cipher for player {key}")
+        with self._lock:
+            self._players[key] = _ParsedPlayer(cipher)
+            while len(self._players) > self.max_players:
+                self._players.popitem(last=False)
+        return cipher
+
+    def install(self):
+        """Route pytube's signature deciphering through this cache"""
+        extract.Cipher = lambda js: self.get(js)
+
+    def stats(self):
+        """Return hit/miss counters"""
+        with self._lock:
+            return {
+                'players': list(self._players),
+                'hits': self.hits,
+                'misses': self.misses
+            }
@@ -0,0 +1,214 @@
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds, from a cache hit to a long transcode
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def render_family(name, kind, help_text, samples):
+    """Prometheus text for one metric; samples are (suffix, labels, value) with labels a list of pairs"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for suffix, labels, value in samples:
+        lines.append(f"{name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}  # label values tuple -> value
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        with self._lock:
+            return [('', list(zip(self.labelnames, key)), value) for key, value in self._values.items()]
+
+    def render(self):
+        return render_family(self.name, self.kind, self.help, self._samples())
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Per-bucket (not cumulative) counts, then the sum
+                series = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-1] += value
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            values = [(key, list(series)) for key, series in self._values.items()]
+        for key, series in values:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                samples.append(('_bucket', labels + [('le', _format_value(float(bound)))], cumulative))
+            samples.append(('_sum', labels, round(series[-1], 6)))
+            samples.append(('_count', labels, cumulative))
+        return samples
+
+
+class Registry:
+    """A set of metrics rendered together in the Prometheus text format.
+
+    Collectors are functions called on every render that return the text of
+    metrics read from somewhere else, such as a component's stats().
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        parts = [metric.render() for metric in self._metrics]
+        for collector in self._collectors:
+            try:
+                parts.append(collector())
+            except Exception:
+                logger.exception("Metrics collector failed")
+        return ''.join(parts)
+
+
+class Timings:
+    """Durations of the stages of one piece of work, in the order they finished"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = []
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self._entries.append((stage, seconds))
+
+    def extend(self, entries):
+        for stage, seconds in entries:
+            self.add(stage, seconds)
+
+    def entries(self):
+        with self._lock:
+            return list(self._entries)
+
+
+_current_timings = ContextVar('timings', default=None)
+
+
+class StageTimer:
+    """Times named stages into a histogram labelled by stage.
+
+    Stages are also added to the Timings collected for the current context
+    (a request or a job), so they can be reported back to the client.
+    Threads that work on behalf of a context join it with attach(). With a
+    tracer, every stage is a span of the current trace as well.
+    """
+
+    def __init__(self, histogram, tracer=None):
+        self.histogram = histogram
+        self.tracer = tracer
+
+    def collect(self):
+        """Start collecting stage timings for the current context and return them"""
+        timings = Timings()
+        _current_timings.set(timings)
+        return timings
+
+    def attach(self, timings):
+        """Record this thread's stages into timings collected elsewhere"""
+        _current_timings.set(timings)
+
+    def _observe(self, stage, seconds):
+        self.histogram.observe(seconds, stage=stage)
+        timings = _current_timings.get()
+        if timings is not None:
+            timings.add(stage, seconds)
+
+    def record(self, stage, seconds):
+        """Record a stage timed elsewhere that ended just now"""
+        self._observe(stage, seconds)
+        if self.tracer:
+            self.tracer.add_span(stage, seconds)
+
+    @contextmanager
+    def stage(self, name):
+        started = time.monotonic()
+        span = self.tracer.span(name) if self.tracer else nullcontext()
+        try:
+            with span:
+                yield
+        finally:
+            self._observe(name, time.monotonic() - started)
+
+
+def server_timing(entries):
+    """Server-Timing header value for (stage, seconds) entries"""
+    return ', '.join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in entries)
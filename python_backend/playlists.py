@@ -0,0 +1,109 @@
+import logging
+import re
+from concurrent.futures import FIRST_COMPLETED, wait
+from itertools import islice
+from urllib.parse import urlparse, parse_qs
+
+from pytube import Channel, Playlist, request as pytube_request
+from pytube.exceptions import RegexMatchError
+
+logger = logging.getLogger(__name__)
+
+# Path prefixes of channel URLs that pytube's Channel understands
+CHANNEL_PREFIXES = ('/channel/', '/c/', '/user/')
+
+# Handle URLs (/@name) are channels too, but pytube's Channel cannot parse
+# them; they are resolved to /channel/<id> first
+HANDLE_PREFIX = '/@'
+
+# Where a channel page names its own channel ID: the canonical link, then the page metadata
+CHANNEL_ID_PATTERNS = (
+    re.compile(r'<link rel="canonical" href="https://www\.youtube\.com/channel/(UC[\w-]{22})"'),
+    re.compile(r'"externalId":"(UC[\w-]{22})"'),
+)
+
+
+def collection_kind(url):
+    """'playlist' or 'channel' for a URL that names a list of videos, else None.
+
+    A watch URL with a list= parameter is treated as the video, not the playlist.
+    """
+    parsed = urlparse(url)
+    if 'youtube.com' not in parsed.netloc:
+        return None
+    query = parse_qs(parsed.query)
+    if 'list' in query and 'v' not in query:
+        return 'playlist'
+    if parsed.path.startswith(CHANNEL_PREFIXES + (HANDLE_PREFIX,)):
+        return 'channel'
+    return None
+
+
+def resolve_handle(url):
+    """The /channel/<id> URL of a /@handle channel URL, read from the handle's channel page"""
+    handle = urlparse(url).path.split('/')[1]
+    html = pytube_request.get(f"https://www.youtube.com/{handle}")
+    for pattern in CHANNEL_ID_PATTERNS:
+        match = pattern.search(html)
+        if match:
+            return f"https://www.youtube.com/channel/{match.group(1)}"
+    raise RegexMatchError(caller='resolve_handle', pattern='CHANNEL_ID_PATTERNS')
+
+
+def open_collection(url):
+    """Create the pytube object for a playlist or channel URL.
+
+    Nothing is fetched yet, except the channel page of a /@handle URL to
+    find its channel ID. Raises PytubeError for a URL pytube cannot parse
+    and HTTPError for a handle that does not exist.
+    """
+    if collection_kind(url) == 'channel':
+        if urlparse(url).path.startswith(HANDLE_PREFIX):
+            url = resolve_handle(url)
+        return Channel(url)
+    return Playlist(url)
+
+
+def describe_collection(collection):
+    """Title and owner of a playlist or channel, from its already fetched first page"""
+    try:
+        if isinstance(collection, Channel):
+            return {'kind': 'channel', 'id': collection.channel_id, 'title': collection.channel_name}
+        return {'kind': 'playlist', 'id': collection.playlist_id, 'title': collection.title,
+                'owner': collection.owner}
+    except Exception as e:
+        # Page layouts change; the entries are still usable without a title
+        logger.warning(f"Could not read playlist details: {e}")
+        return {'kind': 'channel' if isinstance(collection, Channel) else 'playlist'}
+
+
+def iter_entries(collection, limit=None):
+    """Yield {'index', 'id', 'url'} for each video, fetching one page of the list at a time"""
+    urls = collection.url_generator()
+    if limit:
+        urls = islice(urls, limit)
+    for index, url in enumerate(urls):
+        yield {'index': index, 'id': parse_qs(urlparse(url).query).get('v', [''])[0], 'url': url}
+
+
+def resolve_windowed(executor, items, resolve, window):
+    """Run resolve(item) on executor with at most window calls in flight.
+
+    Yields (item, future) in completion order. Items are pulled from the
+    iterable only as slots free up, so a long lazy iterable is never held
+    in memory at once.
+    """
+    items = iter(items)
+    pending = {}
+    try:
+        for item in islice(items, window):
+            pending[executor.submit(resolve, item)] = item
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future
+            for item in islice(items, len(done)):
+                pending[executor.submit(resolve, item)] = item
+    finally:
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,138 @@
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+def frame_label(code):
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse(frame, max_depth=128):
+    """A thread's stack as one line of collapsed stack format, outermost frame first"""
+    labels = []
+    while frame is not None and len(labels) < max_depth:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class SamplingProfiler:
+    """Statistical profiler for a sample of requests.
+
+    Threads working on a profiled trace register with begin()/end() (or
+    track()); while any are registered, a background thread takes their
+    stacks every interval seconds and counts them per trace, keeping the
+    last max_traces traces. With nothing registered the sampler sleeps, so
+    profiling costs nothing while sample_rate is 0.
+    """
+
+    def __init__(self, sample_rate=0.0, interval=0.005, max_traces=100):
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_traces = max_traces
+        self._cond = threading.Condition()
+        self._threads = {}  # thread ident -> trace ID
+        self._traces = OrderedDict()  # trace ID -> {'label', 'samples', 'stacks'}
+        self._sampler = None
+        self.profiled = 0
+
+    def should_profile(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def begin(self, trace_id, label=None):
+        """Profile this thread as part of trace_id; returns a token for end()"""
+        ident = threading.get_ident()
+        with self._cond:
+            if trace_id not in self._traces:
+                self._traces[trace_id] = {'label': label, 'started_at': time.time(), 'samples': 0,
+                                          'stacks': Counter()}
+                self.profiled += 1
+                while len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+            previous = self._threads.get(ident)
+            self._threads[ident] = trace_id
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._loop, name='profiler', daemon=True)
+                self._sampler.start()
+            self._cond.notify()
+        return previous
+
+    def end(self, token):
+        """Stop profiling this thread, returning it to the trace it was profiled for before begin()"""
+        ident = threading.get_ident()
+        with self._cond:
+            if token is None:
+                self._threads.pop(ident, None)
+            else:
+                self._threads[ident] = token
+
+    @contextmanager
+    def track(self, context, label=None):
+        """Profile this thread for the duration, if context (a TraceContext) is profiled"""
+        if context is None or not context.profiled:
+            yield
+            return
+        token = self.begin(context.trace_id, label)
+        try:
+            yield
+        finally:
+            self.end(token)
+
+    def _loop(self):
+        me = threading.get_ident()
+        while True:
+            with self._cond:
+                while not self._threads:
+                    self._cond.wait()
+                threads = dict(self._threads)
+            frames = sys._current_frames()
+            stacks = [(trace_id, collapse(frames[ident])) for ident, trace_id in threads.items()
+                      if ident in frames and ident != me]
+            del frames
+            with self._cond:
+                for trace_id, stack in stacks:
+                    trace = self._traces.get(trace_id)
+                    if trace is not None:
+                        trace['samples'] += 1
+                        trace['stacks'][stack] += 1
+            time.sleep(self.interval)
+
+    def traces(self):
+        """Profiled traces, oldest first, without their stacks"""
+        with self._cond:
+            return [{'trace_id': trace_id, 'label': trace['label'], 'started_at': trace['started_at'],
+                     'samples': trace['samples']} for trace_id, trace in self._traces.items()]
+
+    def stacks(self, trace_id=None):
+        """Sample counts per collapsed stack, for one trace or summed over all; None for an unknown trace"""
+        with self._cond:
+            if trace_id is not None:
+                trace = self._traces.get(trace_id)
+                return Counter(trace['stacks']) if trace else None
+            total = Counter()
+            for trace in self._traces.values():
+                total.update(trace['stacks'])
+            return total
+
+    def collapsed(self, trace_id=None):
+        """Stacks in collapsed stack format ("outer;inner count" lines), as flamegraph.pl and speedscope read"""
+        stacks = self.stacks(trace_id)
+        if stacks is None:
+            return None
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def reset(self):
+        with self._cond:
+            self._traces.clear()
+
+    def stats(self):
+        with self._cond:
+            return {'sample_rate': self.sample_rate, 'interval': self.interval, 'profiled_traces': self.profiled,
+                    'kept_traces': len(self._traces), 'active_threads': len(self._threads)}
@@ -0,0 +1,53 @@
+import logging
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Bytes held in memory per proxied connection; the WSGI server writes each
+# chunk to the client before the next one is read from upstream
+PROXY_CHUNK_SIZE = 64 * 1024
+
+# Upstream response headers that are relayed to the client unchanged
+PASSTHROUGH_HEADERS = ('Content-Length', 'Content-Range', 'Accept-Ranges',
+                       'Last-Modified', 'ETag')
+
+
+class UpstreamError(Exception):
+    """Raised when the upstream media server rejects a proxied request"""
+
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def open_upstream(url, headers, range_header=None, timeout=15, session=None):
+    """Open a streaming GET to a media URL, forwarding the client's Range header.
+
+    session is the requests session to use; without one a new connection is made.
+    """
+    request_headers = dict(headers)
+    if range_header:
+        request_headers['Range'] = range_header
+    upstream = (session or requests).get(url, headers=request_headers, stream=True, timeout=timeout)
+    if upstream.status_code >= 400:
+        upstream.close()
+        raise UpstreamError(upstream.status_code,
+                            f"Upstream returned HTTP {upstream.status_code}")
+    return upstream
+
+
+def relay(upstream, chunk_size=PROXY_CHUNK_SIZE):
+    """Yield an upstream body as it arrives, closing the connection when done"""
+    try:
+        for chunk in upstream.iter_content(chunk_size=chunk_size):
+            if chunk:
+                yield chunk
+    finally:
+        upstream.close()
+
+
+def passthrough_headers(upstream):
+    """Headers from the upstream response that the client should see"""
+    return {name: upstream.headers[name] for name in PASSTHROUGH_HEADERS
+            if name in upstream.headers}
@@ -0,0 +1,222 @@
+import contextvars
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """Stops calling a failing dependency for a cool-down period.
+
+    Outcomes are tracked over the last window seconds. Once at least
+    min_calls have been made and the share of failures reaches
+    failure_rate, the breaker opens and allow() refuses calls for cooldown
+    seconds. After that a single trial call is let through (half open):
+    success closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, failure_rate=0.5, min_calls=10, window=60, cooldown=30):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self._outcomes = deque()  # (time, succeeded)
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self._opened_at = None
+        self._trial_running = False
+        self.times_opened = 0
+        self.rejected = 0
+
+    def _prune(self, now):
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            self._outcomes.popleft()
+
+    def allow(self):
+        """Whether a call may be made now"""
+        with self._lock:
+            if self.state == 'open' and time.monotonic() >= self._opened_at + self.cooldown:
+                self.state = 'half_open'
+            if self.state == 'closed':
+                return True
+            if self.state == 'half_open' and not self._trial_running:
+                self._trial_running = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        """Record a call that succeeded"""
+        with self._lock:
+            now = time.monotonic()
+            self._outcomes.append((now, True))
+            self._prune(now)
+            if self.state == 'half_open':
+                logger.info("Circuit breaker closed after a successful trial call")
+                self.state = 'closed'
+                self._trial_running = False
+                self._outcomes.clear()
+
+    def record_failure(self):
+        """Record a call that failed, opening the breaker if too many have"""
+        with self._lock:
+            now = time.monotonic()
+            self._outcomes.append((now, False))
+            self._prune(now)
+            if self.state == 'half_open':
+                self._open(now)
+                return
+            failures = sum(1 for _, succeeded in self._outcomes if not succeeded)
+            if (self.state == 'closed' and len(self._outcomes) >= self.min_calls
+                    and failures >= self.failure_rate * len(self._outcomes)):
+                self._open(now)
+
+    def _open(self, now):
+        logger.warning(f"Circuit breaker opened for {self.cooldown}s")
+        self.state = 'open'
+        self._opened_at = now
+        self._trial_running = False
+        self.times_opened += 1
+
+    def stats(self):
+        """Return the breaker state and the outcomes in the current window"""
+        with self._lock:
+            now = time.monotonic()
+            self._prune(now)
+            calls = len(self._outcomes)
+            failures = sum(1 for _, succeeded in self._outcomes if not succeeded)
+            stats = {
+                'state': self.state,
+                'calls': calls,
+                'failures': failures,
+                'failure_rate': round(failures / calls, 3) if calls else 0.0,
+                'times_opened': self.times_opened,
+                'rejected': self.rejected
+            }
+            if self.state == 'open':
+                stats['retry_in'] = round(max(0.0, self._opened_at + self.cooldown - now), 1)
+            return stats
+
+
+class Hedger:
+    """Runs a call with backups that start when it is slow or fails.
+
+    The primary call gets a head start of the 95th percentile of its recent
+    latencies, kept between min_delay and max_delay (max_delay until enough
+    latencies have been seen). If it has not produced an acceptable result by
+    then, the next call is started alongside it, and so on; the first
+    acceptable result wins.
+    """
+
+    # Primary latencies remembered, and needed before the percentile is used
+    SAMPLES = 200
+    MIN_SAMPLES = 20
+
+    def __init__(self, executor, max_delay=4.0, min_delay=0.25, percentile=95):
+        self.executor = executor
+        self.max_delay = max_delay
+        self.min_delay = min_delay
+        self.percentile = percentile
+        self._latencies = deque(maxlen=self.SAMPLES)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedged = 0
+        self.wins = {}
+
+    def delay(self):
+        """Seconds the primary call runs alone"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.MIN_SAMPLES:
+            return self.max_delay
+        rank = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return max(self.min_delay, min(self.max_delay, latencies[rank]))
+
+    def _observe(self, started):
+        def observe(future):
+            if not future.cancelled():
+                with self._lock:
+                    self._latencies.append(time.monotonic() - started)
+        return observe
+
+    def run(self, calls, accept=None, on_late=None):
+        """Run calls in order of preference, hedging each with the next.
+
+        Returns (index, value) for the first call whose value passes
+        accept(value). If a more preferred call is still running when a
+        backup wins, on_late(index, value) is called should it later
+        succeed. When every call fails, the primary's exception is raised.
+        """
+        delay = self.delay()
+        done = queue.Queue()
+        futures = []
+        errors = {}
+
+        def start():
+            started = time.monotonic()
+            # In a copy of the caller's context, so per-request state such as its trace follows the call
+            future = self.executor.submit(contextvars.copy_context().run, calls[len(futures)])
+            if not futures:
+                future.add_done_callback(self._observe(started))
+            futures.append(future)
+            future.add_done_callback(done.put)
+
+        start()
+        running = 1
+        deadline = time.monotonic() + delay
+        while True:
+            timeout = max(0.0, deadline - time.monotonic()) if len(futures) < len(calls) else None
+            try:
+                future = done.get(timeout=timeout)
+            except queue.Empty:
+                logger.info(f"Call {len(futures) - 1} still running after {delay:.2f}s, starting call {len(futures)}")
+                start()
+                running += 1
+                deadline = time.monotonic() + delay
+                continue
+            running -= 1
+            index = futures.index(future)
+            error = future.exception()
+            if error is None:
+                value = future.result()
+                if accept is None or accept(value):
+                    break
+                error = ValueError(f"Call {index} returned unusable data")
+            errors[index] = error
+            if not running:
+                if len(futures) == len(calls):
+                    raise errors[0]
+                # Everything started so far failed; don't wait for the deadline
+                start()
+                running += 1
+                deadline = time.monotonic() + delay
+
+        with self._lock:
+            self.calls += 1
+            if len(futures) > 1:
+                self.hedged += 1
+            self.wins[index] = self.wins.get(index, 0) + 1
+
+        if on_late:
+            for earlier, pending in enumerate(futures[:index]):
+                if not pending.done():
+                    pending.add_done_callback(self._late(earlier, on_late))
+        return index, value
+
+    @staticmethod
+    def _late(index, on_late):
+        def late(future):
+            if not future.cancelled() and future.exception() is None:
+                on_late(index, future.result())
+        return late
+
+    def stats(self):
+        """Return the current head start and how often each call won"""
+        with self._lock:
+            stats = {'calls': self.calls, 'hedged': self.hedged,
+                     'wins': {str(index): count for index, count in sorted(self.wins.items())}}
+        stats['delay'] = round(self.delay(), 3)
+        return stats
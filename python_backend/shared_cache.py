@@ -0,0 +1,359 @@
+import logging
+import queue
+import socket
+import struct
+import threading
+import time
+import zlib
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# Format version written at the start of every encoded value
+CODEC_VERSION = 1
+
+# Encoded values longer than this are zlib-compressed
+COMPRESS_THRESHOLD = 1024
+
+# Seconds the shared tier is skipped after it fails, so an outage costs one
+# timeout rather than one per lookup
+FAR_RETRY_DELAY = 5
+
+
+class RespError(Exception):
+    """Raised when the server answers a command with an error reply"""
+
+
+def _write_varint(out, number):
+    while True:
+        byte = number & 0x7F
+        number >>= 7
+        if number:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _read_varint(data, pos):
+    number = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        number |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return number, pos
+        shift += 7
+
+
+def _encode(value, out):
+    if value is None:
+        out += b'N'
+    elif value is True:
+        out += b'T'
+    elif value is False:
+        out += b'F'
+    elif isinstance(value, int):
+        # Zigzag so small negative numbers stay short
+        out += b'i'
+        _write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+    elif isinstance(value, float):
+        out += b'd' + struct.pack('>d', value)
+    elif isinstance(value, str):
+        encoded = value.encode('utf-8')
+        out += b's'
+        _write_varint(out, len(encoded))
+        out += encoded
+    elif isinstance(value, bytes):
+        out += b'b'
+        _write_varint(out, len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out += b'l'
+        _write_varint(out, len(value))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out += b'm'
+        _write_varint(out, len(value))
+        for key, item in value.items():
+            _encode(key, out)
+            _encode(item, out)
+    else:
+        raise TypeError(f"Cannot encode {type(value).__name__}")
+
+
+def _decode(data, pos):
+    tag = data[pos:pos + 1]
+    pos += 1
+    if tag == b'N':
+        return None, pos
+    if tag == b'T':
+        return True, pos
+    if tag == b'F':
+        return False, pos
+    if tag == b'i':
+        number, pos = _read_varint(data, pos)
+        return (number >> 1) if not number & 1 else -((number + 1) >> 1), pos
+    if tag == b'd':
+        return struct.unpack('>d', data[pos:pos + 8])[0], pos + 8
+    if tag in (b's', b'b'):
+        length, pos = _read_varint(data, pos)
+        raw = bytes(data[pos:pos + length])
+        return (raw.decode('utf-8') if tag == b's' else raw), pos + length
+    if tag == b'l':
+        count, pos = _read_varint(data, pos)
+        items = []
+        for _ in range(count):
+            item, pos = _decode(data, pos)
+            items.append(item)
+        return items, pos
+    if tag == b'm':
+        count, pos = _read_varint(data, pos)
+        mapping = {}
+        for _ in range(count):
+            key, pos = _decode(data, pos)
+            mapping[key], pos = _decode(data, pos)
+        return mapping, pos
+    raise ValueError(f"Unknown type tag {tag!r}")
+
+
+def encode_value(value):
+    """Serialize a JSON-like value (tuples become lists) to compact bytes"""
+    body = bytearray()
+    _encode(value, body)
+    compressed = len(body) > COMPRESS_THRESHOLD
+    if compressed:
+        body = zlib.compress(bytes(body), 6)
+    return bytes([CODEC_VERSION, int(compressed)]) + bytes(body)
+
+
+def decode_value(data):
+    """Inverse of encode_value"""
+    if data[0] != CODEC_VERSION:
+        raise ValueError(f"Unsupported cache value version {data[0]}")
+    body = zlib.decompress(data[2:]) if data[1] else memoryview(data)[2:]
+    value, _ = _decode(body, 0)
+    return value
+
+
+class RespClient:
+    """Minimal client for servers speaking the Redis protocol (RESP2), with a connection pool"""
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, timeout=1.0, max_connections=8):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=max_connections)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        """Create a client for a redis://[:password@]host[:port][/db] URL"""
+        parsed = urlparse(url)
+        db = parsed.path.strip('/')
+        return cls(host=parsed.hostname or 'localhost', port=parsed.port or 6379,
+                   db=int(db) if db else 0, password=parsed.password, **kwargs)
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = (sock, sock.makefile('rb'))
+        if self.password:
+            self._call(connection, ('AUTH', self.password))
+        if self.db:
+            self._call(connection, ('SELECT', self.db))
+        return connection
+
+    def _call(self, connection, args):
+        sock, reader = connection
+        request = bytearray(b'*%d\r\n' % len(args))
+        for arg in args:
+            if isinstance(arg, str):
+                arg = arg.encode('utf-8')
+            elif isinstance(arg, int):
+                arg = str(arg).encode('ascii')
+            request += b'$%d\r\n%s\r\n' % (len(arg), arg)
+        sock.sendall(request)
+        return self._read_reply(reader)
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("Connection closed by server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf-8')
+        if kind == b'-':
+            raise RespError(rest.decode('utf-8'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError("Connection closed by server")
+            return data[:-2]
+        if kind == b'*':
+            count = int(rest)
+            return None if count < 0 else [self._read_reply(reader) for _ in range(count)]
+        raise ConnectionError(f"Unexpected reply {line!r}")
+
+    def execute(self, *args):
+        """Run one command and return its reply"""
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            connection = self._connect()
+        try:
+            reply = self._call(connection, args)
+        except RespError:
+            self._release(connection)
+            raise
+        except Exception:
+            connection[0].close()
+            raise
+        self._release(connection)
+        return reply
+
+    def _release(self, connection):
+        try:
+            self._idle.put_nowait(connection)
+        except queue.Full:
+            connection[0].close()
+
+
+class RedisCache:
+    """Cache tier shared by every node, stored on a Redis-protocol server.
+
+    Values are stored with encode_value() together with their expiry time,
+    under prefix + key, and expire on the server after their TTL.
+    """
+
+    def __init__(self, client, prefix, ttl=300):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        """Return (value, seconds left) or None if missing"""
+        data = self.client.execute('GET', self.prefix + key)
+        if data is None:
+            return None
+        expires_at, value = decode_value(data)
+        return value, expires_at - time.time()
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        data = encode_value([time.time() + ttl, value])
+        self.client.execute('SET', self.prefix + key, data, 'PX', int(ttl * 1000))
+
+    def delete(self, key):
+        self.client.execute('DEL', self.prefix + key)
+
+
+def tiered(near, client, prefix, near_ttl=30):
+    """near on its own without a client, else near in front of a RedisCache on client"""
+    if client is None:
+        return near
+    return TieredCache(near, RedisCache(client, prefix, near.ttl), near_ttl)
+
+
+class TieredCache:
+    """A near in-process TTLCache in front of a far cache shared between nodes.
+
+    Lookups that miss the near tier go to the far tier, and only a miss
+    there calls the loader; what is loaded is written to both. Near entries
+    live at most near_ttl seconds, so a value deleted or replaced on another
+    node is picked up again within that time. When the far tier fails it is
+    skipped for FAR_RETRY_DELAY seconds and lookups behave as misses.
+    """
+
+    def __init__(self, near, far, near_ttl=30):
+        self.near = near
+        self.far = far
+        self.near_ttl = near_ttl
+        self.ttl = far.ttl
+        self._lock = threading.Lock()
+        self._far_down_until = 0
+        self.far_hits = 0
+        self.far_misses = 0
+        self.far_errors = 0
+
+    def _far(self, operation, *args):
+        """Run an operation on the far tier; returns None if the tier is failing"""
+        if time.monotonic() < self._far_down_until:
+            return None
+        try:
+            return operation(*args)
+        except (OSError, RespError, ValueError, IndexError) as e:
+            logger.warning(f"Shared cache unavailable, using local cache only: {e}")
+            with self._lock:
+                self.far_errors += 1
+                self._far_down_until = time.monotonic() + FAR_RETRY_DELAY
+            return None
+
+    def _far_get(self, key):
+        found = self._far(self.far.get, key)
+        with self._lock:
+            if found is None:
+                self.far_misses += 1
+            else:
+                self.far_hits += 1
+        return found
+
+    def get(self, key):
+        """Get a cached value from the nearest tier that has it, or None"""
+        value = self.near.get(key)
+        if value is not None:
+            return value
+        found = self._far_get(key)
+        if found is None:
+            return None
+        value, remaining = found
+        self.near.set(key, value, min(self.near_ttl, remaining))
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self._far(self.far.set, key, value, ttl)
+        self.near.set(key, value, min(self.near_ttl, ttl))
+
+    def delete(self, key):
+        self._far(self.far.delete, key)
+        self.near.delete(key)
+
+    def get_or_load(self, key, loader):
+        """Like TTLCache.get_or_load(), checking the far tier before calling loader"""
+        def load():
+            found = self._far_get(key)
+            if found is not None:
+                value, remaining = found
+                return value, min(self.near_ttl, remaining)
+            value, ttl = loader()
+            self._far(self.far.set, key, value, ttl)
+            return value, min(self.near_ttl, ttl)
+        return self.near.get_or_load(key, load)
+
+    def stats(self):
+        """Near tier stats plus far tier hits, i.e. values loaded by this or another node"""
+        stats = self.near.stats()
+        with self._lock:
+            far_lookups = self.far_hits + self.far_misses
+            stats['far'] = {
+                'hits': self.far_hits,
+                'misses': self.far_misses,
+                'hit_ratio': round(self.far_hits / far_lookups, 4) if far_lookups else 0.0,
+                'errors': self.far_errors,
+                'available': time.monotonic() >= self._far_down_until
+            }
+        # Lookups answered by either tier
+        lookups = stats['hits'] + stats['misses']
+        answered = stats['hits'] + self.far_hits
+        stats['overall_hit_ratio'] = round(answered / lookups, 4) if lookups else 0.0
+        return stats
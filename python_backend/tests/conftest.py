@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The backend is a set of flat modules run from this directory, not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,155 @@
+import json
+import threading
+
+import pytest
+
+import admission
+import app as backend
+from admission import Admission, TokenBuckets
+from jobs import JobQueue
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission.time, 'monotonic', clock)
+    return clock
+
+
+class Queue:
+    def __init__(self, pending=0):
+        self.pending_jobs = pending
+
+    def pending(self):
+        return self.pending_jobs
+
+    def estimate_wait(self, jobs_ahead=None):
+        return 10.0 * (self.pending_jobs if jobs_ahead is None else jobs_ahead)
+
+
+class Disk:
+    room = True
+
+    def has_room(self, size=0):
+        return self.room
+
+
+def test_bucket_allows_a_burst_then_refills(clock):
+    buckets = TokenBuckets(rate=2.0, burst=3)
+    assert [buckets.take('a') for _ in range(3)] == [0, 0, 0]
+    assert buckets.take('a') == pytest.approx(0.5)
+    # Other clients have buckets of their own
+    assert buckets.take('b') == 0
+    clock.now += 0.5
+    assert buckets.take('a') == 0
+    assert buckets.stats()['limited'] == 1
+
+
+def test_bucket_cost_is_capped_at_burst(clock):
+    buckets = TokenBuckets(rate=1.0, burst=5)
+    assert buckets.take('a', cost=100) == 0
+    assert buckets.take('a', cost=100) == pytest.approx(5.0)
+
+
+def test_least_recently_seen_buckets_are_dropped(clock):
+    buckets = TokenBuckets(rate=1.0, burst=1, max_clients=2)
+    buckets.take('a')
+    buckets.take('b')
+    buckets.take('c')
+    assert buckets.stats()['clients'] == 2
+    # 'a' was dropped, so it starts again with a full bucket
+    assert buckets.take('a') == 0
+    assert buckets.take('c') == pytest.approx(1.0)
+
+
+def test_rate_limit_is_checked_first(clock):
+    check = Admission(Queue(pending=100), TokenBuckets(rate=1.0, burst=1), Disk(), max_pending=4)
+    assert check.check('a').status == 503
+    rejection = check.check('a')
+    assert (rejection.status, rejection.retry_after) == (429, 1)
+    assert check.rejected == {'rate': 1, 'pending': 1, 'disk': 0}
+
+
+def test_requests_are_admitted_while_their_jobs_fit(clock):
+    queue = Queue(pending=2)
+    check = Admission(queue, TokenBuckets(burst=100), Disk(), max_pending=4)
+    assert check.check('a') is None
+    assert check.check('a', jobs=2) is None
+    rejection = check.check('a', jobs=3)
+    assert rejection.status == 503
+    # Waits for the one job over the limit to finish
+    assert rejection.retry_after == 10
+    queue.pending_jobs = 4
+    assert check.check('a').status == 503
+    # Streams do not queue jobs
+    assert check.check('a', queued=False) is None
+
+
+def test_disk_floor_rejects_queued_requests(clock):
+    disk = Disk()
+    disk.room = False
+    check = Admission(Queue(), TokenBuckets(), disk)
+    assert check.check('a').message == 'Not enough free disk space'
+    assert check.check('a', queued=False) is None
+
+
+class Collection:
+    def url_generator(self):
+        for i in range(10):
+            yield f"https://www.youtube.com/watch?v=vid{i}"
+
+
+def test_playlist_jobs_stop_when_the_queue_is_full(tmp_path, monkeypatch):
+    gate = threading.Event()
+    queue = JobQueue(str(tmp_path / 'jobs.db'), lambda job, publish: gate.wait(5) or {}, workers=1).start()
+    queue.submit('url', 'other', 'mp4', '720p')
+    monkeypatch.setattr(backend, 'job_queue', queue)
+    monkeypatch.setattr(backend, 'ADMISSION_MAX_PENDING', 4)
+    monkeypatch.setattr(backend, 'admit', lambda cost=1, queued=True, jobs=1: None)
+    monkeypatch.setattr(backend, 'open_collection_or_error', lambda url: (Collection(), None))
+    monkeypatch.setattr(backend, 'describe_collection', lambda collection: {'title': 'list'})
+    client = backend.app.test_client()
+
+    def post():
+        response = client.post('/api/playlist/jobs',
+                               json={'url': 'https://www.youtube.com/playlist?list=PL123'})
+        return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    events = post()
+    assert [event['id'] for event in events if event['type'] == 'entry'] == ['vid0', 'vid1', 'vid2']
+    end = events[-1]
+    assert end['type'] == 'end' and end['count'] == 3
+    assert end['truncated'] and end['retry_after'] >= 1
+    assert queue.pending() == 4
+
+    # Once there is room, posting again queues the rest
+    monkeypatch.setattr(backend, 'ADMISSION_MAX_PENDING', 100)
+    events = post()
+    created = [event['id'] for event in events if event['type'] == 'entry' and event['created']]
+    assert created == [f"vid{i}" for i in range(3, 10)]
+    assert 'truncated' not in events[-1]
+    gate.set()
+
+
+def test_archive_needs_room_for_its_prefetched_jobs(monkeypatch):
+    admitted = []
+
+    def admit(cost=1, queued=True, jobs=1):
+        admitted.append((cost, jobs))
+        return backend.jsonify({'error': 'Server is busy'}), 503
+
+    monkeypatch.setattr(backend, 'admit', admit)
+    monkeypatch.setattr(backend, 'ARCHIVE_PREFETCH', 2)
+    client = backend.app.test_client()
+    items = [{'url': f"https://www.youtube.com/watch?v=vid{i}"} for i in range(10)]
+    assert client.post('/api/archive', json={'items': items}).status_code == 503
+    assert client.post('/api/archive', json={'items': items[:2]}).status_code == 503
+    assert admitted == [(10, 3), (2, 2)]
@@ -0,0 +1,154 @@
+import asyncio
+
+import pytest
+
+import asgi_bridge
+from asgi_bridge import WsgiBridge, requested_workers
+from download_cache import IDLE_CHUNK
+
+
+class Body:
+    """A response body that records whether it was closed"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def serve():
+    bridges = []
+
+    def serve(wsgi_app, body=b'', disconnect=False):
+        bridge = WsgiBridge(wsgi_app, workers=2, body_threads=2)
+        bridges.append(bridge)
+        scope = {'type': 'http', 'method': 'POST', 'path': '/api/x', 'query_string': b'a=1',
+                 'headers': [(b'content-type', b'text/plain')]}
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        if disconnect:
+            messages.append({'type': 'http.disconnect'})
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await asyncio.sleep(3600)
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(bridge(scope, receive, send))
+        return bridge, sent
+
+    yield serve
+    for bridge in bridges:
+        bridge.view_pool.shutdown()
+        bridge.body_pool.shutdown()
+
+
+def status(sent):
+    return sent[0]['status']
+
+
+def body(sent):
+    return b''.join(message.get('body', b'') for message in sent[1:])
+
+
+def test_response_is_sent(serve):
+    environs = []
+
+    def wsgi_app(environ, start_response):
+        environs.append(environ)
+        start_response('201 Created', [('Content-Type', 'text/plain')])
+        return Body([environ['wsgi.input'].read(), b'', b' done'])
+
+    bridge, sent = serve(wsgi_app, body=b'hello')
+    assert status(sent) == 201
+    assert sent[0]['headers'] == [(b'content-type', b'text/plain')]
+    assert body(sent) == b'hello done'
+    assert sent[-1] == {'type': 'http.response.body', 'body': b''}
+    environ = environs[0]
+    assert (environ['PATH_INFO'], environ['QUERY_STRING'], environ['CONTENT_TYPE']) == ('/api/x', 'a=1', 'text/plain')
+    assert bridge.served == 1 and bridge.active == 0
+
+
+def test_written_bytes_go_before_the_body(serve):
+    def wsgi_app(environ, start_response):
+        write = start_response('200 OK', [])
+        write(b'first ')
+        return Body([b'then'])
+
+    _, sent = serve(wsgi_app)
+    assert body(sent) == b'first then'
+
+
+def test_body_failing_before_its_first_chunk_is_closed(serve):
+    bodies = []
+
+    def wsgi_app(environ, start_response):
+        start_response('200 OK', [])
+        bodies.append(Body([RuntimeError('boom')]))
+        return bodies[0]
+
+    _, sent = serve(wsgi_app)
+    assert status(sent) == 500
+    assert bodies[0].closed
+
+
+def test_idle_chunks_wait_on_the_event_loop(serve, monkeypatch):
+    monkeypatch.setattr(asgi_bridge, 'TAIL_POLL_INTERVAL', 0)
+
+    def wsgi_app(environ, start_response):
+        assert environ[asgi_bridge.IDLE_CHUNKS_ENVIRON]
+        start_response('200 OK', [])
+        return Body([IDLE_CHUNK, IDLE_CHUNK, b'data'])
+
+    bridge, sent = serve(wsgi_app)
+    assert body(sent) == b'data'
+    assert bridge.idle_waits == 2
+
+
+def test_disconnected_client_stops_the_body(serve):
+    bodies = []
+
+    def endless():
+        while True:
+            yield b'x'
+
+    def wsgi_app(environ, start_response):
+        start_response('200 OK', [])
+        bodies.append(Body(endless()))
+        return bodies[0]
+
+    bridge, sent = serve(wsgi_app, disconnect=True)
+    assert bodies[0].closed
+    assert bridge.disconnects == 1 and bridge.served == 0
+    assert sent[-1].get('more_body')
+
+
+def test_large_request_body_is_refused(serve, monkeypatch):
+    monkeypatch.setattr(asgi_bridge, 'MAX_REQUEST_BODY', 4)
+    views = []
+    _, sent = serve(lambda environ, start_response: views.append(environ), body=b'too large')
+    assert status(sent) == 413
+    assert views == []
+
+
+@pytest.mark.parametrize('argv, environ, workers', [
+    (['asgi.py'], {}, 1),
+    (['asgi.py'], {'WEB_CONCURRENCY': '4'}, 4),
+    (['uvicorn', 'asgi:application', '--workers', '2'], {}, 2),
+    (['uvicorn', 'asgi:application', '--workers=3'], {'WEB_CONCURRENCY': '1'}, 3),
+    (['gunicorn', '-w', '4', '-k', 'uvicorn.workers.UvicornWorker', 'asgi:application'], {}, 4),
+])
+def test_requested_workers(argv, environ, workers):
+    assert requested_workers(argv, environ) == workers
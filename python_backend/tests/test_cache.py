@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+
+from cache import TTLCache
+
+
+def test_expired_entries_are_misses():
+    cache = TTLCache(ttl=0.05)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    time.sleep(0.06)
+    assert cache.get('a') is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_non_positive_ttl_is_not_stored():
+    cache = TTLCache()
+    cache.set('a', 1, ttl=0)
+    assert cache.get('a') is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+
+def test_concurrent_misses_share_one_load():
+    cache = TTLCache()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'value', 60
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(cache.get_or_load('k', loader)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(cache.get_or_load('k', loader)))
+                 for _ in range(4)]
+    for thread in followers:
+        thread.start()
+    while cache.stats()['coalesced'] < 4:
+        time.sleep(0.01)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert calls == [1]
+    assert results == ['value'] * 5
+    assert cache.get('k') == 'value'
+
+
+def test_load_error_reaches_waiters_and_is_not_cached():
+    cache = TTLCache()
+    started = threading.Event()
+    release = threading.Event()
+
+    def loader():
+        started.set()
+        release.wait(5)
+        raise RuntimeError('upstream down')
+
+    errors = []
+
+    def call():
+        try:
+            cache.get_or_load('k', loader)
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=call)
+    follower.start()
+    while cache.stats()['coalesced'] < 1:
+        time.sleep(0.01)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert errors == ['upstream down'] * 2
+    assert cache.stats()['in_flight'] == 0
+
+    def failing_again():
+        raise ValueError('again')
+
+    with pytest.raises(ValueError):
+        cache.get_or_load('k', failing_again)
@@ -0,0 +1,155 @@
+import struct
+
+import pytest
+
+import app as backend
+from clips import (MAX_HEAD_BYTES, ClipError, clip_source, keyframe_before, parse_mp4_index, parse_time,
+                   parse_webm_index, read_index)
+
+
+def box(box_type, body):
+    return struct.pack('>I4s', 8 + len(body), box_type) + body
+
+
+def sidx(timescale, earliest, first_offset, references):
+    """A version 0 sidx box listing (size, duration) references"""
+    body = struct.pack('>B3xIIIIHH', 0, 1, timescale, earliest, first_offset, 0, len(references))
+    for size, duration in references:
+        body += struct.pack('>III', size, duration, 0x90000000)
+    return box(b'sidx', body)
+
+
+def element(element_id, body):
+    """An EBML element with a one-byte (up to 126 bytes) or eight-byte size"""
+    id_bytes = element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big')
+    size = bytes([0x80 | len(body)]) if len(body) < 127 else b'\x01' + len(body).to_bytes(7, 'big')
+    return id_bytes + size + body
+
+
+def uint(element_id, value):
+    return element(element_id, value.to_bytes(4, 'big'))
+
+
+def webm(cues, timecode_scale=1000000):
+    """A WebM head with Info and Cues for (time, cluster position) pairs, then the first cluster"""
+    info = element(0x1549A966, uint(0x2AD7B1, timecode_scale))
+    points = b''.join(element(0xBB, uint(0xB3, time) + element(0xB7, uint(0xF7, 1) + uint(0xF1, position)))
+                      for time, position in cues)
+    segment_body = info + element(0x1C53BB6B, points)
+    return element(0x1A45DFA3, b'\x42\x86\x81\x01') + b'\x18\x53\x80\x67\x01\xff\xff\xff\xff\xff\xff\xff' + \
+        segment_body + b'\x1f\x43\xb6\x75\x01\xff\xff\xff\xff\xff\xff\xff'
+
+
+@pytest.mark.parametrize('value, seconds', [('90', 90), ('90.5', 90.5), ('1:30', 90), ('1:02:03.5', 3723.5),
+                                            (' 7 ', 7)])
+def test_parse_time(value, seconds):
+    assert parse_time(value) == seconds
+
+
+@pytest.mark.parametrize('value', ['inf', 'nan', '-1', '1:-30', 'abc', '1::2'])
+def test_parse_time_rejects(value):
+    with pytest.raises(ValueError):
+        parse_time(value)
+
+
+@pytest.mark.parametrize('args, error', [
+    ({'start': '5'}, 'end is required'),
+    ({'start': '10', 'end': '5'}, 'end must be after start'),
+    ({'start': '0', 'end': '1e400'}, 'finite'),
+    # Each part is finite, but hours and minutes overflow once multiplied out
+    ({'start': '0', 'end': '1e306:0:0'}, 'Times are too large'),
+    ({'start': '0', 'end': '301', 'accurate': '1'}, 'at most 300 seconds'),
+])
+def test_clip_options_rejects(monkeypatch, args, error):
+    monkeypatch.setattr(backend, 'CLIP_ACCURATE_MAX_SECONDS', 300)
+    with pytest.raises(ValueError, match=error):
+        backend.clip_options(args)
+
+
+def test_clip_options(monkeypatch):
+    monkeypatch.setattr(backend, 'CLIP_ACCURATE_MAX_SECONDS', 300)
+    assert backend.clip_options({}) is None
+    assert backend.clip_options({'start': '1:00', 'end': '1:30', 'accurate': 'true'}) == \
+        {'clip': {'start': 60, 'end': 90, 'accurate': True}}
+    # Only accurate clips are limited in length
+    assert backend.clip_options({'end': '3600'})['clip']['accurate'] is False
+
+
+def test_parse_mp4_index():
+    head = box(b'ftyp', b'isom') + box(b'moov', b'\0' * 16)
+    index_box = sidx(1000, 500, 0, [(100, 2000), (200, 3000), (300, 1000)])
+    index = parse_mp4_index(head + index_box + box(b'moof', b''))
+    box_end = len(head) + len(index_box)
+    assert index['init_end'] == len(head)
+    assert index['segments'] == [(0.5, box_end), (2.5, box_end + 100), (5.5, box_end + 300)]
+
+
+def test_parse_mp4_index_without_sidx():
+    with pytest.raises(ClipError):
+        parse_mp4_index(box(b'ftyp', b'isom') + box(b'moof', b''))
+
+
+def test_parse_webm_index():
+    head = webm([(4000, 900), (0, 500), (2000, 700)], timecode_scale=1000000)
+    segment_start = head.index(b'\x18\x53\x80\x67') + 12
+    index = parse_webm_index(head)
+    assert index['init_end'] == len(head) - 12
+    assert index['segments'] == [(0.0, segment_start + 500), (2.0, segment_start + 700),
+                                 (4.0, segment_start + 900)]
+
+
+def test_parse_webm_index_without_cues():
+    head = element(0x1A45DFA3, b'') + b'\x18\x53\x80\x67\x01\xff\xff\xff\xff\xff\xff\xff' + \
+        b'\x1f\x43\xb6\x75\x81\x00'
+    with pytest.raises(ClipError):
+        parse_webm_index(head)
+
+
+class Upstream:
+    """open_range() over a bytes object, recording the ranges asked for"""
+
+    def __init__(self, data):
+        self.data = data
+        self.ranges = []
+
+    def __call__(self, range_header):
+        self.ranges.append(range_header)
+        first, _, last = range_header[len('bytes='):].partition('-')
+        return self.data[int(first):int(last) + 1 if last else None]
+
+
+@pytest.fixture
+def relay_bytes(monkeypatch):
+    import clips
+    monkeypatch.setattr(clips, 'relay', lambda body: [body])
+
+
+def test_read_index_grows_the_head_until_the_index_fits(relay_bytes):
+    head = box(b'ftyp', b'isom') + box(b'moov', b'\0' * 100000)
+    data = head + sidx(1000, 0, 0, [(10, 1000)]) + box(b'moof', b'') + b'\0' * 10
+    upstream = Upstream(data)
+    index = read_index(upstream, 'mp4')
+    assert upstream.ranges == ['bytes=0-65535', 'bytes=0-131071']
+    assert index['init_end'] == len(head)
+    assert index['head'] == data[:131072]
+
+
+def test_read_index_gives_up_past_the_limit(relay_bytes):
+    upstream = Upstream(box(b'ftyp', b'isom') + box(b'moov', b'\0' * MAX_HEAD_BYTES))
+    with pytest.raises(ClipError):
+        read_index(upstream, 'mp4')
+
+
+def test_clip_source_fetches_only_the_covering_segments(relay_bytes):
+    data = bytes(range(256)) * 4
+    index = {'init_end': 10, 'head': data[:64],
+             'segments': [(0.0, 100), (2.0, 200), (4.0, 300), (6.0, 400)]}
+    upstream = Upstream(data)
+    assert keyframe_before(index, 3.5) == 2.0
+    assert keyframe_before(index, 0.0) == 0.0
+    chunks = list(clip_source(upstream, index, 2.5, 4.5))
+    assert upstream.ranges == ['bytes=200-399']
+    assert chunks == [data[:10], data[200:400]]
+    # A clip running into the last segment reads to the end of the stream
+    list(clip_source(upstream, index, 6.5, 8.0))
+    assert upstream.ranges[-1] == 'bytes=400-'
@@ -0,0 +1,156 @@
+import threading
+
+import pytest
+
+from download_cache import IDLE_CHUNK, DownloadCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DownloadCache(str(tmp_path / 'cache'), max_bytes=1 << 20).load()
+
+
+class Producer:
+    """A fill producer the test steps through by hand"""
+
+    def __init__(self):
+        self.path = None
+        self.advance = None
+        self.started = threading.Event()
+        self.finish = threading.Event()
+        self.error = None
+
+    def __call__(self, path, advance):
+        self.path = path
+        self.advance = advance
+        self.started.set()
+        assert self.finish.wait(5)
+        if self.error:
+            raise self.error
+
+    def write(self, data):
+        with open(self.path, 'ab') as f:
+            f.write(data)
+
+
+def read_all(cached_file):
+    return b''.join(cached_file.iter_chunks(chunk_size=4))
+
+
+def wait_until(condition):
+    for _ in range(500):
+        if condition():
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError("condition not met")
+
+
+def test_miss_fills_and_later_requests_hit(cache):
+    first = cache.get_or_fill(('v', 18, 'mp4'), 'mp4', lambda path, advance: open(path, 'wb').write(b'video'))
+    assert read_all(first) == b'video'
+    second = cache.get_or_fill(('v', 18, 'mp4'), 'mp4', None)
+    assert second.complete
+    assert read_all(second) == b'video'
+    assert cache.stats()['misses'] == 1
+    assert cache.stats()['hits'] == 1
+
+
+def test_readers_tail_an_in_progress_fill(cache):
+    producer = Producer()
+    first = cache.get_or_fill(('v',), 'mp4', producer)
+    producer.started.wait(5)
+    joined = cache.get(('v',))
+    assert joined is not None and not joined.complete
+    producer.write(b'abcd')
+    chunks = first.iter_chunks(chunk_size=4)
+    assert next(chunks) == b'abcd'
+    producer.write(b'efgh')
+    producer.finish.set()
+    assert b''.join(chunks) == b'efgh'
+    assert read_all(joined) == b'abcdefgh'
+    assert cache.stats()['joined_in_progress'] == 1
+
+
+def test_idle_readers_get_idle_chunks_instead_of_waiting(cache):
+    producer = Producer()
+    chunks = cache.get_or_fill(('v',), 'mp4', producer).iter_chunks(idle=True)
+    producer.started.wait(5)
+    assert next(chunks) is IDLE_CHUNK
+    producer.write(b'data')
+    producer.finish.set()
+    assert b''.join(chunks) == b'data'
+
+
+def test_reads_stop_at_the_watermark(cache):
+    producer = Producer()
+    reader = cache.get_or_fill(('v',), 'mp4', producer, resumable=True)
+    producer.started.wait(5)
+    # Written out of order: only the first 4 bytes are final
+    producer.write(b'abcd' + b'\0' * 8)
+    producer.advance(4)
+    chunks = reader.iter_chunks(chunk_size=64, idle=True)
+    assert next(chunks) == b'abcd'
+    assert next(chunks) is IDLE_CHUNK
+    with open(producer.path, 'r+b') as f:
+        f.write(b'abcdefghijkl')
+    producer.finish.set()
+    assert b''.join(chunks) == b'efghijkl'
+
+
+def test_failed_fill_is_raised_without_unconfirmed_bytes(cache):
+    producer = Producer()
+    producer.error = OSError('connection reset')
+    reader = cache.get_or_fill(('v',), 'mp4', producer, resumable=True)
+    producer.started.wait(5)
+    # Preallocated, but only the first 4 bytes were ever confirmed
+    producer.write(b'abcd' + b'\0' * 100)
+    producer.advance(4)
+    producer.finish.set()
+    received = []
+    with pytest.raises(OSError, match='connection reset'):
+        for chunk in reader.iter_chunks(chunk_size=64):
+            received.append(chunk)
+    assert b''.join(received) == b'abcd'
+    assert not cache.contains(('v',))
+
+
+def test_open_readers_keep_entries_from_eviction(tmp_path):
+    cache = DownloadCache(str(tmp_path), max_bytes=10).load()
+    reader = cache.get_or_fill(('a',), 'bin', lambda path, advance: open(path, 'wb').write(b'a' * 8))
+    reader.wait_complete()
+    read_all(cache.get_or_fill(('b',), 'bin', lambda path, advance: open(path, 'wb').write(b'b' * 8)))
+    # 'a' is least recently used, but is still being read, so the idle 'b' goes instead
+    assert cache.contains(('a',))
+    assert not cache.contains(('b',))
+    assert cache.stats()['evictions'] == 1
+    assert read_all(reader) == b'a' * 8
+
+
+def test_reader_of_a_failed_fill_does_not_release_a_later_fill(tmp_path):
+    cache = DownloadCache(str(tmp_path), max_bytes=10).load()
+    failing = Producer()
+    failing.error = OSError('gone')
+    stale = cache.get_or_fill(('a',), 'bin', failing)
+    failing.started.wait(5)
+    failing.finish.set()
+    wait_until(lambda: not cache.contains(('a',)))
+
+    refill = Producer()
+    reader = cache.get_or_fill(('a',), 'bin', refill)
+    refill.started.wait(5)
+    # Closing the failed fill's reader must not count against the new fill
+    stale.close()
+    refill.write(b'a' * 8)
+    refill.finish.set()
+    reader.wait_complete()
+    read_all(cache.get_or_fill(('b',), 'bin', lambda path, advance: open(path, 'wb').write(b'b' * 8)))
+    assert cache.contains(('a',))
+    assert read_all(reader) == b'a' * 8
+
+
+def test_load_indexes_files_from_an_earlier_run(tmp_path):
+    first = DownloadCache(str(tmp_path), max_bytes=1 << 20).load()
+    read_all(first.get_or_fill(('v',), 'mp4', lambda path, advance: open(path, 'wb').write(b'video')))
+    second = DownloadCache(str(tmp_path), max_bytes=1 << 20).load()
+    assert second.stats()['files'] == 1
+    assert read_all(second.get(('v',))) == b'video'
@@ -0,0 +1,144 @@
+import os
+import threading
+
+import pytest
+
+import downloader
+from downloader import PROGRESS_SUFFIX, SegmentedDownloader
+from proxy import UpstreamError
+
+DATA = bytes(range(256)) * 40  # 10240 bytes
+
+
+class Response:
+    def __init__(self, status_code, body=b''):
+        self.status_code = status_code
+        self.headers = {}
+        self.body = body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def iter_content(self, chunk_size):
+        for offset in range(0, len(self.body), 1000):
+            yield self.body[offset:offset + 1000]
+
+
+class Upstream:
+    """Serves DATA by Range; fail(url, start) overrides the response to a range starting at start"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []
+        self.failures = {}
+
+    def fail(self, url, start, response):
+        self.failures[url, start] = response
+
+    def get(self, url, headers, stream, timeout):
+        start, end = (int(part) for part in headers['Range'][len('bytes='):].split('-'))
+        with self.lock:
+            self.requests.append((url, start, end))
+            failure = self.failures.pop((url, start), None)
+        if failure is not None:
+            return failure(start, end) if callable(failure) else failure
+        return Response(206, DATA[start:end + 1])
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(downloader, 'backoff_delay', lambda attempt: 0)
+
+
+@pytest.fixture
+def upstream():
+    return Upstream()
+
+
+def make(upstream, **kwargs):
+    return SegmentedDownloader(connections=2, segment_size=4096, session=upstream, **kwargs)
+
+
+def test_segments_are_written_in_place(upstream, tmp_path):
+    path = str(tmp_path / 'file')
+    progress = []
+    result = make(upstream).download('u', path, len(DATA), on_progress=progress.append)
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    assert sorted((start, end) for _, start, end in upstream.requests) == [(0, 4095), (4096, 8191), (8192, 10239)]
+    assert progress[0] == 0 and progress[-1] == len(DATA)
+    assert progress == sorted(progress)
+    assert result['fetched_bytes'] == len(DATA) and result['segments'] == 3
+    assert not os.path.exists(path + PROGRESS_SUFFIX)
+
+
+def test_cut_off_segment_continues_from_its_last_byte(upstream, tmp_path):
+    path = str(tmp_path / 'file')
+    upstream.fail('u', 4096, lambda start, end: Response(206, DATA[start:start + 1500]))
+    result = make(upstream).download('u', path, len(DATA))
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    assert ('u', 4096 + 1500, 8191) in upstream.requests
+    assert result['retries'] == 1
+
+
+def test_later_call_reuses_completed_segments(upstream, tmp_path):
+    path = str(tmp_path / 'file')
+    upstream.fail('u', 8192, Response(404))
+    with pytest.raises(UpstreamError):
+        make(upstream).download('u', path, len(DATA))
+    assert os.path.exists(path + PROGRESS_SUFFIX)
+
+    upstream.requests.clear()
+    fetcher = make(upstream)
+    result = fetcher.download('u', path, len(DATA))
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    assert upstream.requests == [('u', 8192, 10239)]
+    assert result['fetched_bytes'] == len(DATA) - 8192
+    assert fetcher.stats()['resumed_bytes'] == 8192
+
+
+def test_progress_of_a_different_file_is_ignored(upstream, tmp_path):
+    path = str(tmp_path / 'file')
+    upstream.fail('u', 8192, Response(404))
+    with pytest.raises(UpstreamError):
+        make(upstream).download('u', path, len(DATA))
+
+    upstream.requests.clear()
+    # A different segment size makes the recorded segments meaningless
+    result = SegmentedDownloader(connections=2, segment_size=2048, session=upstream).download('u', path, len(DATA))
+    assert result['fetched_bytes'] == len(DATA)
+    assert len(upstream.requests) == 5
+
+
+def test_expired_url_is_re_resolved_once_for_all_segments(upstream, tmp_path):
+    path = str(tmp_path / 'file')
+    for start in (0, 4096, 8192):
+        upstream.fail('old', start, Response(403))
+    refreshed = []
+    result = make(upstream).download('old', path, len(DATA),
+                                     refresh_url=lambda: refreshed.append(1) or 'new')
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    assert refreshed == [1]
+    assert result['url_refreshes'] == 1
+    assert {url for url, _, _ in upstream.requests if url != 'old'} == {'new'}
+
+
+def test_retry_budget_is_shared_by_the_download(tmp_path):
+    class Unavailable(Upstream):
+        def get(self, url, headers, stream, timeout):
+            super().get(url, headers, stream, timeout)
+            return Response(503)
+
+    upstream = Unavailable()
+    fetcher = make(upstream, max_retries=10, retry_budget=3)
+    with pytest.raises(UpstreamError):
+        fetcher.download('u', str(tmp_path / 'file'), len(DATA))
+    # Each segment tries once; after that they share three retries between them
+    assert len(upstream.requests) <= 3 + 3
+    assert fetcher.stats()['segment_retries'] == 3
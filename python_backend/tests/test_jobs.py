@@ -0,0 +1,122 @@
+import threading
+
+import pytest
+
+from jobs import JobError, JobQueue
+
+
+def wait_for(queue, job_id, state):
+    for _ in range(500):
+        job = queue.get(job_id)
+        if job['state'] == state:
+            return job
+        threading.Event().wait(0.01)
+    raise AssertionError(f"job {job_id} is {job['state']}, not {state}")
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'jobs.db')
+
+
+def test_identical_jobs_are_deduplicated(db_path):
+    queue = JobQueue(db_path, runner=None, workers=0).start()
+    job, created = queue.submit('url', 'vid', 'mp4', '720p')
+    again, created_again = queue.submit('url', 'vid', 'mp4', '720p')
+    other, created_other = queue.submit('url', 'vid', 'mp4', '720p', options={'clip': [0, 5]})
+    assert created and not created_again
+    assert again['id'] == job['id']
+    assert created_other and other['id'] != job['id']
+
+
+def test_cancelled_jobs_are_not_pending(db_path):
+    queue = JobQueue(db_path, runner=None, workers=0).start()
+    jobs = [queue.submit('url', f"vid{i}", 'mp4', '720p')[0] for i in range(4)]
+    assert queue.pending() == 4
+    for job in jobs[:3]:
+        assert queue.cancel(job['id'])['state'] == 'cancelled'
+    # Cancelling twice does not uncount the job again
+    queue.cancel(jobs[0]['id'])
+    assert queue.pending() == 1
+    assert queue.stats()['queue_depth'] == 1
+
+
+def test_higher_priority_runs_first(db_path):
+    order = []
+    gate = threading.Event()
+
+    def runner(job, publish):
+        gate.wait(5)
+        order.append(job['video_id'])
+        return {}
+
+    queue = JobQueue(db_path, runner, workers=1).start()
+    first = queue.submit('url', 'first', 'mp4', '720p')[0]
+    wait_for(queue, first['id'], 'running')
+    low = queue.submit('url', 'low', 'mp4', '720p')[0]
+    high = queue.submit('url', 'high', 'mp4', '720p', priority=5)[0]
+    gate.set()
+    wait_for(queue, low['id'], 'completed')
+    wait_for(queue, high['id'], 'completed')
+    assert order == ['first', 'high', 'low']
+    assert queue.pending() == 0
+
+
+def test_failures_keep_their_status(db_path):
+    def runner(job, publish):
+        raise JobError('Video is unavailable', 404)
+
+    queue = JobQueue(db_path, runner, workers=1).start()
+    job = wait_for(queue, queue.submit('url', 'vid', 'mp4', '720p')[0]['id'], 'failed')
+    assert job['error'] == 'Video is unavailable'
+    assert job['error_status'] == 404
+
+
+def test_published_results_are_visible_before_completion(db_path):
+    finish = threading.Event()
+
+    def runner(job, publish):
+        publish({'cache_key': ['vid']})
+        finish.wait(5)
+        return {'cache_key': ['vid'], 'size': 1}
+
+    queue = JobQueue(db_path, runner, workers=1).start()
+    job_id = queue.submit('url', 'vid', 'mp4', '720p')[0]['id']
+    job = queue.wait_ready(job_id, timeout=5)
+    assert job['state'] == 'running'
+    assert job['result'] == {'cache_key': ['vid']}
+    finish.set()
+    assert wait_for(queue, job_id, 'completed')['result'] == {'cache_key': ['vid'], 'size': 1}
+
+
+def test_group_limit_leaves_workers_for_others(db_path):
+    running = []
+    release = threading.Event()
+
+    def runner(job, publish):
+        running.append(job['video_id'])
+        release.wait(5)
+        return {}
+
+    queue = JobQueue(db_path, runner, workers=3).start()
+    playlist = [queue.submit('url', f"p{i}", 'mp4', '720p', group_id='list', group_limit=1)[0] for i in range(3)]
+    other = queue.submit('url', 'other', 'mp4', '720p')[0]
+    wait_for(queue, other['id'], 'running')
+    assert sorted(running) == ['other', 'p0']
+    release.set()
+    for job in playlist:
+        wait_for(queue, job['id'], 'completed')
+
+
+def test_unfinished_jobs_survive_a_restart(db_path):
+    gate = threading.Event()
+    queue = JobQueue(db_path, lambda job, publish: gate.wait(5) and {}, workers=1).start()
+    running = queue.submit('url', 'running', 'mp4', '720p')[0]
+    wait_for(queue, running['id'], 'running')
+    queued = queue.submit('url', 'queued', 'mp4', '720p')[0]
+
+    restarted = JobQueue(db_path, runner=None, workers=0).start()
+    assert restarted.get(running['id'])['state'] == 'queued'
+    assert restarted.get(queued['id'])['state'] == 'queued'
+    assert restarted.pending() == 2
+    gate.set()
@@ -0,0 +1,65 @@
+import threading
+from urllib.parse import parse_qs, urlparse
+
+from pytube import extract
+
+from manifest import CipherCache
+
+# The smallest player the pytube cipher parser accepts: the signature is
+# reversed and then loses its first character, and n is reversed
+PLAYER_JS = '''var DE={AJ:function(a){a.reverse()}, VR:function(a,b){a.splice(0,b)}};
+Xy=function(a){a=a.split("");DE.AJ(a,15);DE.VR(a,1);return a.join("")};
+c&&d.set(b,encodeURIComponent(Xy(e)));
+a.C&&(b=a.get("n"))&&(b=Npa[0](b),a.set("n",b));
+var Npa=[iha];
+iha=function(a){var b=a.split(""),c=[function(d){d.reverse()},b,null];try{c[0](c[1])}catch(e){return"_w8_"+a}return b.join("")};
+'''
+
+
+def deciphered(n, signature):
+    """Query parameters of a stream URL after pytube deciphered it"""
+    streams = [{'itag': 18, 's': signature, 'url': f"https://r1.googlevideo.com/videoplayback?n={n}"}]
+    extract.apply_signature(streams, {}, PLAYER_JS)
+    return {key: values[0] for key, values in parse_qs(urlparse(streams[0]['url']).query).items()}
+
+
+def test_each_video_gets_its_own_n(monkeypatch):
+    cache = CipherCache()
+    # install() patches pytube; put its Cipher back after the test
+    monkeypatch.setattr(extract, 'Cipher', extract.Cipher)
+    cache.install()
+
+    first = deciphered('abcdef', '0123456789')
+    second = deciphered('uvwxyz', 'abcdefgh')
+
+    assert first == {'n': 'fedcba', 'sig': '876543210'}
+    assert second == {'n': 'zyxwvu', 'sig': 'gfedcba'}
+    assert cache.stats()['misses'] == 1
+    assert cache.stats()['hits'] == 1
+
+
+def test_cached_ciphers_are_not_shared():
+    cache = CipherCache()
+    first = cache.get(PLAYER_JS)
+    second = cache.get(PLAYER_JS)
+    assert first is not second
+    assert first.calculate_n(list('abc')) == 'cba'
+    assert second.calculate_n(list('xyz')) == 'zyx'
+    assert cache.get(PLAYER_JS).calculate_n(list('123')) == '321'
+
+
+def test_concurrent_videos_on_one_player():
+    cache = CipherCache()
+    cache.get(PLAYER_JS)
+    results = {}
+
+    def decipher(n):
+        results[n] = cache.get(PLAYER_JS).calculate_n(list(n))
+
+    threads = [threading.Thread(target=decipher, args=(f"n{i:03d}",)) for i in range(32)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert results == {n: n[::-1] for n in results}
+    assert len(results) == 32
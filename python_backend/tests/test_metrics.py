@@ -0,0 +1,99 @@
+import pytest
+
+import app as backend
+from admission import DiskBudget
+from cache import TTLCache
+from download_cache import DownloadCache
+from janitor import Janitor
+from jobs import JobQueue
+from metrics import Registry, render_family
+from shared_cache import TieredCache
+
+
+class FarCache:
+    """The shared tier: values set by any node, returned with their remaining TTL"""
+
+    ttl = 300
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return (self.values[key], self.ttl) if key in self.values else None
+
+    def set(self, key, value, ttl=None):
+        self.values[key] = value
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+
+def sample(text, name, **labels):
+    """Value of one sample in Prometheus text"""
+    wanted = name + ('{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}' if labels else '')
+    for line in text.splitlines():
+        if line.startswith(wanted + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    raise AssertionError(f"{wanted} not in metrics")
+
+
+@pytest.fixture
+def components(monkeypatch, tmp_path):
+    monkeypatch.setattr(backend, 'job_queue', JobQueue(str(tmp_path / 'jobs.db'), None, workers=0).start())
+    monkeypatch.setattr(backend, 'download_cache', DownloadCache(str(tmp_path / 'cache'), 1 << 20).load())
+    monkeypatch.setattr(backend, 'thumbnail_cache', DownloadCache(str(tmp_path / 'thumbs'), 1 << 20).load())
+    monkeypatch.setattr(backend, 'disk_budget', DiskBudget(str(tmp_path)))
+    monkeypatch.setattr(backend, 'janitor', Janitor(str(tmp_path)))
+    far = FarCache()
+    monkeypatch.setattr(backend, 'metadata_cache', TieredCache(TTLCache(), far, near_ttl=30))
+    monkeypatch.setattr(backend, 'manifest_cache', TTLCache())
+    return far
+
+
+def test_cache_lookups_are_exported_by_tier(components):
+    far = components
+    # Loaded by another node, then read twice here: one shared hit, then a local hit
+    far.set('abc', {'title': 'other node'})
+    assert backend.metadata_cache.get_or_load('abc', None) == {'title': 'other node'}
+    assert backend.metadata_cache.get('abc') == {'title': 'other node'}
+    # Loaded by nobody yet: a miss in both tiers
+    backend.metadata_cache.get_or_load('new', lambda: ({'title': 'new'}, 60))
+    backend.manifest_cache.get('missing')
+
+    text = backend.component_metrics()
+    assert sample(text, 'ytdl_cache_hits_total', cache='metadata', tier='local') == 1
+    assert sample(text, 'ytdl_cache_misses_total', cache='metadata', tier='local') == 2
+    assert sample(text, 'ytdl_cache_hits_total', cache='metadata', tier='shared') == 1
+    assert sample(text, 'ytdl_cache_misses_total', cache='metadata', tier='shared') == 1
+    assert sample(text, 'ytdl_cache_misses_total', cache='manifest', tier='local') == 1
+    # Caches with no shared tier have no shared samples
+    assert 'cache="manifest",tier="shared"' not in text
+    assert '# TYPE ytdl_cache_hits_total counter' in text
+
+
+def test_registry_renders_counters_and_histograms():
+    registry = Registry()
+    counter = registry.counter('requests_total', 'Requests', ('status',))
+    histogram = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+    registry.add_collector(lambda: render_family('up', 'gauge', 'Up', [('', [], 1)]))
+    counter.inc(status=200)
+    counter.inc(2, status=200)
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    text = registry.render()
+    assert sample(text, 'requests_total', status=200) == 3
+    assert sample(text, 'latency_seconds_bucket', le='0.1') == 1
+    assert sample(text, 'latency_seconds_bucket', le='1') == 2
+    assert sample(text, 'latency_seconds_bucket', le='+Inf') == 3
+    assert sample(text, 'latency_seconds_count') == 3
+    assert sample(text, 'latency_seconds_sum') == 5.55
+    assert sample(text, 'up') == 1
+    with pytest.raises(ValueError):
+        counter.inc(method='GET')
+
+
+def test_label_values_are_escaped():
+    text = render_family('m', 'gauge', 'M', [('', [('path', 'a"b\\c\nd')], 1)])
+    assert 'm{path="a\\"b\\\\c\\nd"} 1' in text
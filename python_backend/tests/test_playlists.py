@@ -0,0 +1,101 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+
+import pytest
+from pytube import Channel, Playlist
+from pytube.exceptions import RegexMatchError
+
+import app as backend
+import playlists
+from playlists import collection_kind, open_collection, resolve_windowed
+
+CHANNEL_ID = 'UC' + 'a' * 22
+CHANNEL_PAGE = f'<html><link rel="canonical" href="https://www.youtube.com/channel/{CHANNEL_ID}"></html>'
+
+
+@pytest.mark.parametrize('url, kind', [
+    ('https://www.youtube.com/playlist?list=PL123', 'playlist'),
+    ('https://www.youtube.com/watch?v=abc&list=PL123', None),
+    ('https://www.youtube.com/channel/UC123', 'channel'),
+    ('https://www.youtube.com/c/name/videos', 'channel'),
+    ('https://www.youtube.com/user/name', 'channel'),
+    ('https://www.youtube.com/@name', 'channel'),
+    ('https://www.youtube.com/watch?v=abc', None),
+    ('https://example.com/playlist?list=PL123', None),
+])
+def test_collection_kind(url, kind):
+    assert collection_kind(url) == kind
+
+
+def test_handles_are_resolved_to_channel_ids(monkeypatch):
+    fetched = []
+    monkeypatch.setattr(playlists.pytube_request, 'get', lambda url: fetched.append(url) or CHANNEL_PAGE)
+    channel = open_collection('https://www.youtube.com/@name/videos')
+    assert isinstance(channel, Channel)
+    assert channel.channel_uri == f"/channel/{CHANNEL_ID}"
+    assert fetched == ['https://www.youtube.com/@name']
+
+
+def test_handle_id_is_read_from_page_metadata(monkeypatch):
+    monkeypatch.setattr(playlists.pytube_request, 'get', lambda url: f'{{"externalId":"{CHANNEL_ID}"}}')
+    assert open_collection('https://www.youtube.com/@name').channel_uri == f"/channel/{CHANNEL_ID}"
+
+
+def test_handle_page_without_an_id(monkeypatch):
+    monkeypatch.setattr(playlists.pytube_request, 'get', lambda url: '<html></html>')
+    with pytest.raises(RegexMatchError):
+        open_collection('https://www.youtube.com/@name')
+
+
+def test_other_collections_are_not_fetched(monkeypatch):
+    monkeypatch.setattr(playlists.pytube_request, 'get', None)
+    assert isinstance(open_collection('https://www.youtube.com/playlist?list=PL123'), Playlist)
+    assert open_collection('https://www.youtube.com/c/name').channel_uri == '/c/name'
+
+
+def unknown_handle(url):
+    raise HTTPError(url, 404, 'Not Found', {}, None)
+
+
+@pytest.mark.parametrize('page', [lambda url: '<html></html>', unknown_handle])
+def test_unlistable_urls_get_400(monkeypatch, page):
+    monkeypatch.setattr(playlists.pytube_request, 'get', page)
+    charged = []
+    monkeypatch.setattr(backend, 'admit', lambda cost=1, queued=True: charged.append(cost))
+    client = backend.app.test_client()
+
+    response = client.get('/api/playlist', query_string={'url': 'https://www.youtube.com/@name'})
+    assert response.status_code == 400
+    assert 'Could not open playlist or channel' in response.get_json()['error']
+
+    response = client.post('/api/playlist/jobs', json={'url': 'https://www.youtube.com/@name'})
+    assert response.status_code == 400
+    assert charged == []
+
+
+def test_resolve_windowed_keeps_at_most_window_in_flight():
+    lock = threading.Lock()
+    in_flight = []
+    peak = []
+    pulled = []
+
+    def items():
+        for i in range(20):
+            pulled.append(i)
+            yield i
+
+    def resolve(item):
+        with lock:
+            in_flight.append(item)
+            peak.append(len(in_flight))
+        threading.Event().wait(0.005)
+        with lock:
+            in_flight.remove(item)
+        return item * 2
+
+    with ThreadPoolExecutor(8) as executor:
+        results = {item: future.result() for item, future in resolve_windowed(executor, items(), resolve, 3)}
+    assert results == {i: i * 2 for i in range(20)}
+    assert max(peak) <= 3
+    assert pulled == list(range(20))
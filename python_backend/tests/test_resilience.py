@@ -0,0 +1,145 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import resilience
+from resilience import CircuitBreaker, Hedger
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(resilience.time, 'monotonic', clock)
+    return clock
+
+
+def test_breaker_opens_once_enough_calls_fail(clock):
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=4, window=60, cooldown=30)
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert breaker.stats()['retry_in'] == 30
+    assert not breaker.allow()
+    assert breaker.stats()['rejected'] == 1
+
+
+def test_breaker_forgets_outcomes_outside_the_window(clock):
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=4, window=60, cooldown=30)
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 61
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+    assert breaker.stats()['calls'] == 1
+
+
+def test_half_open_breaker_lets_one_trial_through(clock):
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=2, window=60, cooldown=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+
+def test_failed_trial_opens_the_breaker_again(clock):
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=2, window=60, cooldown=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert breaker.times_opened == 2
+    assert not breaker.allow()
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(4) as executor:
+        yield executor
+
+
+def test_fast_primary_is_not_hedged(executor):
+    hedger = Hedger(executor, max_delay=1.0)
+    backup = []
+    assert hedger.run([lambda: 'primary', lambda: backup.append(1)]) == (0, 'primary')
+    assert backup == []
+    assert hedger.stats()['hedged'] == 0
+
+
+def test_slow_primary_is_hedged_and_reported_late(executor):
+    hedger = Hedger(executor, max_delay=0.05)
+    release = threading.Event()
+    late = []
+    done = threading.Event()
+
+    def primary():
+        release.wait(5)
+        return 'full'
+
+    def on_late(index, value):
+        late.append((index, value))
+        done.set()
+
+    assert hedger.run([primary, lambda: 'fallback'], on_late=on_late) == (1, 'fallback')
+    release.set()
+    done.wait(5)
+    assert late == [(0, 'full')]
+    assert hedger.stats()['wins'] == {'1': 1}
+
+
+def test_failed_primary_starts_the_backup_at_once(executor):
+    hedger = Hedger(executor, max_delay=5.0)
+
+    def primary():
+        raise OSError('down')
+
+    assert hedger.run([primary, lambda: 'fallback']) == (1, 'fallback')
+
+
+def test_unacceptable_results_count_as_failures(executor):
+    hedger = Hedger(executor, max_delay=5.0)
+    assert hedger.run([lambda: {}, lambda: {'title': 't'}], accept=lambda value: 'title' in value) == \
+        (1, {'title': 't'})
+
+
+def test_primary_error_is_raised_when_every_call_fails(executor):
+    hedger = Hedger(executor, max_delay=0.01)
+
+    def primary():
+        raise OSError('primary')
+
+    def backup():
+        raise ValueError('backup')
+
+    with pytest.raises(OSError, match='primary'):
+        hedger.run([primary, backup])
+
+
+def test_delay_follows_the_primary_latency_percentile():
+    hedger = Hedger(None, max_delay=4.0, min_delay=0.25)
+    assert hedger.delay() == 4.0
+    hedger._latencies.extend([1.0] * 19)
+    assert hedger.delay() == 4.0
+    hedger._latencies.extend([0.5] * 80 + [3.0] * 1)
+    assert hedger.delay() == 1.0
+    hedger._latencies.clear()
+    hedger._latencies.extend([0.01] * 100)
+    assert hedger.delay() == 0.25
@@ -0,0 +1,71 @@
+import pytest
+from flask import Flask
+
+import app as backend
+from download_cache import DownloadCache
+
+BODY = b'0123456789' * 10
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = DownloadCache(str(tmp_path), max_bytes=1 << 20).load()
+    filled = cache.get_or_fill(('v',), 'mp4', lambda path, advance: open(path, 'wb').write(BODY))
+    filled.wait_complete()
+    filled.close()
+    return cache
+
+
+@pytest.fixture
+def client(cache):
+    server = Flask(__name__)
+    server.add_url_rule('/file', 'file', lambda: backend.send_cached_file(cache.get(('v',)), 'video/mp4', 'video.mp4'))
+    return server.test_client()
+
+
+def respond(client, headers=None):
+    response = client.get('/file', headers=headers or {})
+    body = response.get_data()
+    response.close()
+    return response.status_code, response.headers, body
+
+
+def test_complete_file_has_length_and_etag(client):
+    status, headers, body = respond(client)
+    assert status == 200
+    assert body == BODY
+    assert headers['Content-Length'] == str(len(BODY))
+    assert headers['ETag']
+    assert headers['Content-Disposition'] == 'attachment; filename="video.mp4"'
+
+
+def test_range_request_gets_partial_content(client):
+    status, headers, body = respond(client, {'Range': 'bytes=10-19'})
+    assert status == 206
+    assert body == BODY[10:20]
+    assert headers['Content-Range'] == f"bytes 10-19/{len(BODY)}"
+
+
+def test_unsatisfiable_range(client):
+    status, headers, _ = respond(client, {'Range': f"bytes={len(BODY)}-"})
+    assert status == 416
+    assert headers['Content-Range'] == f"bytes */{len(BODY)}"
+
+
+def test_if_range_with_a_stale_etag_gets_the_whole_file(client):
+    status, _, body = respond(client, {'Range': 'bytes=10-19', 'If-Range': '"stale"'})
+    assert status == 200
+    assert body == BODY
+
+
+def test_if_none_match_gets_not_modified(client):
+    _, headers, _ = respond(client)
+    status, _, body = respond(client, {'If-None-Match': headers['ETag']})
+    assert status == 304
+    assert body == b''
+
+
+def test_responses_release_the_cache_entry(client, cache):
+    respond(client, {'Range': 'bytes=0-0'})
+    entry = next(iter(cache._entries.values()))
+    assert entry.readers == 0
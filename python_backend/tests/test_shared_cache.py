@@ -0,0 +1,141 @@
+import socketserver
+import threading
+
+import pytest
+
+import shared_cache
+from cache import TTLCache
+from shared_cache import RedisCache, RespClient, RespError, TieredCache, decode_value, encode_value
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            command = args[0].upper()
+            server.commands.append([command] + args[1:])
+            if command == b'GET':
+                value = server.values.get(args[1])
+                self.wfile.write(b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value))
+            elif command == b'SET':
+                server.values[args[1]] = args[2]
+                self.wfile.write(b'+OK\r\n')
+            elif command == b'DEL':
+                self.wfile.write(b':%d\r\n' % int(server.values.pop(args[1], None) is not None))
+            elif command in (b'AUTH', b'SELECT'):
+                self.wfile.write(b'+OK\r\n')
+            elif command == b'KEYS':
+                keys = sorted(server.values)
+                self.wfile.write(b'*%d\r\n' % len(keys) + b''.join(b'$%d\r\n%s\r\n' % (len(k), k) for k in keys))
+            else:
+                self.wfile.write(b'-ERR unknown command\r\n')
+
+
+@pytest.fixture
+def server():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _Handler)
+    server.daemon_threads = True
+    server.values = {}
+    server.commands = []
+    server.connections = 0
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('value', [
+    None, True, False, 0, -1, 300, -(2 ** 70), 1.5, '', 'héllo', b'\x00\xff',
+    [1, 'a', [None]], {'title': 'x', 'streams': [{'itag': 18, 'url': 'u'}]},
+])
+def test_values_round_trip(value):
+    assert decode_value(encode_value(value)) == value
+
+
+def test_large_values_are_compressed():
+    value = {'streams': [{'url': 'https://r1.googlevideo.com/videoplayback?' + 'x' * 100}] * 50}
+    encoded = encode_value(value)
+    assert encoded[1] == 1
+    assert len(encoded) < 1000
+    assert decode_value(encoded) == value
+
+
+def test_tuples_become_lists_and_unknown_types_fail():
+    assert decode_value(encode_value((1, 2))) == [1, 2]
+    with pytest.raises(TypeError):
+        encode_value(object())
+
+
+def test_client_reuses_connections_and_authenticates(server):
+    client = RespClient.from_url(f"redis://:secret@127.0.0.1:{server.server_address[1]}/2")
+    assert client.execute('SET', 'k', b'v', 'PX', 1000) == 'OK'
+    assert client.execute('GET', 'k') == b'v'
+    assert client.execute('GET', 'missing') is None
+    assert client.execute('DEL', 'k') == 1
+    assert client.execute('KEYS', '*') == []
+    assert server.connections == 1
+    assert server.commands[:2] == [[b'AUTH', b'secret'], [b'SELECT', b'2']]
+    assert server.commands[2] == [b'SET', b'k', b'v', b'PX', b'1000']
+
+
+def test_error_replies_raise_and_keep_the_connection(server):
+    client = RespClient(port=server.server_address[1], host='127.0.0.1')
+    with pytest.raises(RespError, match='unknown command'):
+        client.execute('NOPE')
+    assert client.execute('GET', 'k') is None
+    assert server.connections == 1
+
+
+def test_redis_cache_stores_values_with_their_expiry(server):
+    cache = RedisCache(RespClient(host='127.0.0.1', port=server.server_address[1]), 'ytdl:metadata:', ttl=60)
+    cache.set('abc', {'title': 't'})
+    value, remaining = cache.get('abc')
+    assert value == {'title': 't'}
+    assert 59 < remaining <= 60
+    assert b'ytdl:metadata:abc' in server.values
+    assert server.commands[-2][3:] == [b'PX', b'60000']
+    cache.set('zero', 1, ttl=0)
+    assert cache.get('zero') is None
+
+
+class _DownCache:
+    ttl = 300
+
+    def __init__(self):
+        self.calls = 0
+
+    def get(self, key):
+        self.calls += 1
+        raise ConnectionRefusedError('down')
+
+    set = delete = get
+
+
+def test_tiered_cache_falls_back_to_the_local_tier(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(shared_cache.time, 'monotonic', lambda: clock[0])
+    far = _DownCache()
+    cache = TieredCache(TTLCache(), far, near_ttl=30)
+    assert cache.get_or_load('k', lambda: ('value', 60)) == 'value'
+    assert cache.get('k') == 'value'
+    # The failing tier was tried once, then skipped until FAR_RETRY_DELAY passed
+    assert far.calls == 1
+    assert cache.stats()['far']['errors'] == 1
+    assert not cache.stats()['far']['available']
+    clock[0] += shared_cache.FAR_RETRY_DELAY
+    assert cache.get('missing') is None
+    assert far.calls == 2
@@ -0,0 +1,32 @@
+import contextvars
+import io
+import logging
+
+import app as backend
+from tracing import parse_traceparent
+
+
+def test_handlers_added_later_can_log_the_trace_id():
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('[%(trace_id)s] %(message)s'))
+    logger = logging.getLogger('test_tracing')
+    logger.addHandler(handler)
+    try:
+        # Empty contexts, so a trace started by an earlier test does not leak in
+        contextvars.Context().run(logger.warning, 'outside')
+        context = contextvars.Context()
+        trace = context.run(backend.tracer.start)
+        context.run(logger.warning, 'inside')
+    finally:
+        logger.removeHandler(handler)
+    assert stream.getvalue().splitlines() == ['[-] outside', f"[{trace.trace_id}] inside"]
+
+
+def test_parse_traceparent():
+    trace_id, span_id = 'a' * 32, 'b' * 16
+    assert parse_traceparent(f"00-{trace_id}-{span_id}-01") == (trace_id, span_id, True)
+    assert parse_traceparent(f"00-{trace_id}-{span_id}-00") == (trace_id, span_id, False)
+    assert parse_traceparent(f"00-{'0' * 32}-{span_id}-01") is None
+    assert parse_traceparent('garbage') is None
+    assert parse_traceparent(None) is None
@@ -0,0 +1,48 @@
+import hashlib
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# Thumbnails YouTube may have for a video, best first. maxresdefault and
+# sddefault are missing for many older videos; hqdefault always exists.
+THUMBNAIL_NAMES = ('maxresdefault', 'sddefault', 'hqdefault')
+THUMBNAIL_URL = 'https://i.ytimg.com/vi/{video_id}/{name}.jpg'
+
+# Widths a thumbnail can be resized to; anything else would let clients
+# fill the cache with arbitrary variants
+VARIANT_WIDTHS = (120, 240, 320, 480, 640)
+
+VIDEO_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+
+class ThumbnailNotFound(Exception):
+    """Raised when none of a video's thumbnails exist"""
+
+
+def is_video_id(value):
+    return bool(VIDEO_ID_PATTERN.match(value or ''))
+
+
+def fetch_thumbnail(session, video_id, output_file, headers=None):
+    """Write the best thumbnail that exists for a video to output_file and return its name"""
+    for name in THUMBNAIL_NAMES:
+        response = session.get(THUMBNAIL_URL.format(video_id=video_id, name=name), headers=headers)
+        if response.status_code == 404:
+            continue
+        response.raise_for_status()
+        with open(output_file, 'wb') as f:
+            f.write(response.content)
+        return name
+    raise ThumbnailNotFound(f"No thumbnail found for {video_id}")
+
+
+def resize_args(width):
+    """ffmpeg output options that scale a JPEG down to width (never up), keeping its aspect ratio"""
+    return ['-vf', f"scale='min(iw,{width})':-2", '-frames:v', '1', '-c:v', 'mjpeg', '-q:v', '3',
+            '-f', 'image2pipe']
+
+
+def content_etag(data):
+    """Strong ETag for a thumbnail's bytes"""
+    return hashlib.sha1(data).hexdigest()
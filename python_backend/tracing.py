@@ -0,0 +1,310 @@
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# W3C trace context header, read from requests and sent on outbound calls
+TRACEPARENT_HEADER = 'traceparent'
+
+TRACEPARENT_PATTERN = re.compile(r'^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+# OTLP span kinds
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+
+
+def new_id(size):
+    """Random non-zero hex ID of size bytes, as trace (16) and span (8) IDs are"""
+    while True:
+        value = os.urandom(size).hex()
+        if value.strip('0'):
+            return value
+
+
+def parse_traceparent(value):
+    """Return (trace_id, parent span_id, sampled) from a traceparent header, or None if it is invalid"""
+    match = TRACEPARENT_PATTERN.match((value or '').strip().lower())
+    if not match or not match.group(1).strip('0') or not match.group(2).strip('0'):
+        return None
+    return match.group(1), match.group(2), bool(int(match.group(3), 16) & 1)
+
+
+def otlp_attributes(attributes):
+    """Attributes as OTLP JSON key/value pairs"""
+    pairs = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            pairs.append({'key': key, 'value': {'boolValue': value}})
+        elif isinstance(value, int):
+            pairs.append({'key': key, 'value': {'intValue': str(value)}})
+        elif isinstance(value, float):
+            pairs.append({'key': key, 'value': {'doubleValue': value}})
+        else:
+            pairs.append({'key': key, 'value': {'stringValue': str(value)}})
+    return pairs
+
+
+class TraceContext:
+    """Where work is in a trace: its trace ID, the span it runs in and whether it is recorded or profiled"""
+
+    __slots__ = ('trace_id', 'span_id', 'sampled', 'profiled')
+
+    def __init__(self, trace_id, span_id, sampled, profiled=False):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+        self.profiled = profiled
+
+    def traceparent(self):
+        # Outside any span (an unsampled trace started here) calls get a parent ID of their own
+        return f"00-{self.trace_id}-{self.span_id or new_id(8)}-{'01' if self.sampled else '00'}"
+
+
+class Span:
+    """A timed operation in a trace, in the shape of an OpenTelemetry span"""
+
+    __slots__ = ('name', 'kind', 'context', 'parent', 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, name, kind, context, parent, attributes=None, start_ns=None):
+        self.name = name
+        self.kind = kind
+        self.context = context
+        self.parent = parent
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def to_otlp(self):
+        """The span in the OTLP JSON encoding"""
+        span = {
+            'traceId': self.context.trace_id,
+            'spanId': self.context.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': otlp_attributes(self.attributes)
+        }
+        if self.parent.span_id:
+            span['parentSpanId'] = self.parent.span_id
+        if self.error is not None:
+            span['status'] = {'code': 2, 'message': self.error}
+        return span
+
+
+_current_context = ContextVar('trace_context', default=None)
+
+
+class Tracer:
+    """Trace IDs for every request, and spans for the sampled ones.
+
+    start() begins a request's trace, continuing the caller's when it sent a
+    traceparent header. The trace ID is always there for logs and outbound
+    calls; spans are only recorded when the trace is sampled (by the caller,
+    by sample_rate, or because it is profiled), so unsampled requests pay for
+    little more than a context lookup per span. Recorded spans are kept in a
+    buffer of the last max_spans and handed to exporter, if there is one.
+    Threads that work on behalf of a request join its trace with attach().
+    """
+
+    def __init__(self, sample_rate=0.0, max_spans=2048, exporter=None):
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+        self._lock = threading.Lock()
+        self._spans = deque(maxlen=max_spans)
+        self.traces = 0
+        self.sampled = 0
+        self.recorded = 0
+
+    def start(self, traceparent=None, profiled=False):
+        """Begin the current context's trace and return its TraceContext"""
+        parent = parse_traceparent(traceparent)
+        if parent:
+            trace_id, span_id, sampled = parent
+        else:
+            trace_id, span_id, sampled = new_id(16), None, False
+        sampled = sampled or profiled or (self.sample_rate > 0 and random.random() < self.sample_rate)
+        context = TraceContext(trace_id, span_id, sampled, profiled)
+        _current_context.set(context)
+        with self._lock:
+            self.traces += 1
+            self.sampled += sampled
+        return context
+
+    def current(self):
+        return _current_context.get()
+
+    def attach(self, context):
+        """Continue context's trace in this thread; None leaves any trace"""
+        _current_context.set(context)
+
+    def trace_id(self):
+        context = _current_context.get()
+        return context.trace_id if context else None
+
+    def outbound_headers(self):
+        """Headers that carry the current trace to an outbound call"""
+        context = _current_context.get()
+        return {TRACEPARENT_HEADER: context.traceparent()} if context else {}
+
+    def start_span(self, name, kind=KIND_INTERNAL, attributes=None):
+        """Open a span in the current context, or return None if the trace is not sampled"""
+        parent = _current_context.get()
+        if parent is None or not parent.sampled:
+            return None
+        span = Span(name, kind, TraceContext(parent.trace_id, new_id(8), True, parent.profiled), parent, attributes)
+        _current_context.set(span.context)
+        return span
+
+    def end_span(self, span):
+        """Close a span from start_span() and return to its parent"""
+        if span is None:
+            return
+        span.end_ns = time.time_ns()
+        _current_context.set(span.parent)
+        self._record(span)
+
+    @contextmanager
+    def span(self, name, kind=KIND_INTERNAL, **attributes):
+        span = self.start_span(name, kind, attributes)
+        if span is None:
+            yield None
+            return
+        try:
+            yield span
+        except BaseException as e:
+            span.error = str(e) or type(e).__name__
+            raise
+        finally:
+            self.end_span(span)
+
+    def add_span(self, name, seconds, **attributes):
+        """Record a span timed elsewhere that ended just now"""
+        parent = _current_context.get()
+        if parent is None or not parent.sampled:
+            return
+        end_ns = time.time_ns()
+        span = Span(name, KIND_INTERNAL, TraceContext(parent.trace_id, new_id(8), True, parent.profiled), parent,
+                    attributes, start_ns=end_ns - int(seconds * 1e9))
+        span.end_ns = end_ns
+        self._record(span)
+
+    def _record(self, span):
+        with self._lock:
+            self._spans.append(span)
+            self.recorded += 1
+        if self.exporter:
+            self.exporter.export(span)
+
+    def spans(self, trace_id):
+        """Recorded spans of a trace still in the buffer, in the OTLP JSON encoding"""
+        with self._lock:
+            spans = [span for span in self._spans if span.context.trace_id == trace_id]
+        return [span.to_otlp() for span in spans]
+
+    def stats(self):
+        with self._lock:
+            stats = {'sample_rate': self.sample_rate, 'traces': self.traces, 'sampled': self.sampled,
+                     'recorded_spans': self.recorded, 'buffered_spans': len(self._spans)}
+        if self.exporter:
+            stats['exporter'] = self.exporter.stats()
+        return stats
+
+
+def install_log_record_factory(tracer):
+    """Add the current trace ID (or '-') to every log record as trace_id.
+
+    Done in the record factory rather than a handler filter, so handlers
+    added later (by uvicorn, gunicorn or a test harness) can format it too.
+    """
+    make_record = logging.getLogRecordFactory()
+
+    def factory(*args, **kwargs):
+        record = make_record(*args, **kwargs)
+        record.trace_id = tracer.trace_id() or '-'
+        return record
+
+    logging.setLogRecordFactory(factory)
+
+
+class OtlpExporter:
+    """Sends recorded spans to an OpenTelemetry collector over OTLP/HTTP (JSON encoding).
+
+    Spans are queued and posted in batches of up to batch_size every interval
+    seconds from a background thread; when the collector falls behind, spans
+    beyond max_queue are dropped rather than held in memory.
+    """
+
+    def __init__(self, endpoint, service_name, interval=5, batch_size=512, max_queue=8192, timeout=10):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        threading.Thread(target=self._loop, name='otlp-exporter', daemon=True).start()
+        return self
+
+    def export(self, span):
+        with self._lock:
+            if len(self._queue) >= self.max_queue:
+                self.dropped += 1
+                return
+            self._queue.append(span)
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Span export failed")
+
+    def flush(self):
+        """Post every queued span"""
+        while True:
+            with self._lock:
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            if not batch:
+                return
+            payload = {'resourceSpans': [{
+                'resource': {'attributes': otlp_attributes({'service.name': self.service_name})},
+                'scopeSpans': [{'scope': {'name': 'ytdl'}, 'spans': [span.to_otlp() for span in batch]}]
+            }]}
+            try:
+                # Deliberately not the pooled session, whose calls are traced themselves
+                response = requests.post(self.endpoint, json=payload, timeout=self.timeout)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                logger.warning(f"Could not export {len(batch)} spans to {self.endpoint}: {e}")
+                with self._lock:
+                    self.failed += len(batch)
+                return
+            with self._lock:
+                self.exported += len(batch)
+
+    def stats(self):
+        with self._lock:
+            return {'endpoint': self.endpoint, 'queued': len(self._queue), 'exported': self.exported,
+                    'dropped': self.dropped, 'failed': self.failed}
@@ -0,0 +1,228 @@
+import logging
+import os
+import subprocess
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from ffmpeg's stdout at a time
+OUTPUT_CHUNK_SIZE = 64 * 1024
+
+# Inputs after the first are passed to ffmpeg as extra inherited pipe
+# descriptors, which only POSIX platforms support
+MULTI_INPUT = os.name == 'posix'
+
+
+class TranscodeError(Exception):
+    """Raised when ffmpeg is missing or exits unsuccessfully"""
+
+
+# Audio containers a download can be delivered in. 'source' is the stream
+# subtype that can be copied into the container without re-encoding; other
+# sources are transcoded to 'codec' with 'encoder'. mp3 always needs a transcode.
+AUDIO_CONTAINERS = {
+    'mp3': {'source': None, 'codec': 'mp3', 'encoder': 'libmp3lame', 'mimetype': 'audio/mpeg',
+            'muxer': ['-f', 'mp3']},
+    'm4a': {'source': 'mp4', 'codec': 'aac', 'encoder': 'aac', 'mimetype': 'audio/mp4',
+            # The mp4 muxer needs a seekable output unless it writes fragments
+            'muxer': ['-f', 'mp4', '-movflags', '+empty_moov+default_base_moof',
+                      '-frag_duration', '2000000']},
+    'webm': {'source': 'webm', 'codec': 'opus', 'encoder': 'libopus', 'mimetype': 'audio/webm',
+             'muxer': ['-f', 'webm']}
+}
+
+
+def audio_args(container, bitrate=None):
+    """ffmpeg output options for an audio container; without a bitrate the source codec is copied"""
+    spec = AUDIO_CONTAINERS[container]
+    if bitrate is None:
+        codec_args = ['-c:a', 'copy']
+    else:
+        # libopus does not accept 44.1 kHz
+        sample_rate = '48000' if container == 'webm' else '44100'
+        codec_args = ['-c:a', spec['encoder'], '-b:a', f'{bitrate}k', '-ar', sample_rate, '-ac', '2']
+    return ['-vn'] + codec_args + spec['muxer']
+
+
+def mux_args(reencode=False):
+    """ffmpeg output options that put video from input 0 and audio from input 1 into fragmented MP4.
+
+    Both tracks are copied unless reencode is set, in which case they are
+    encoded to H.264/AAC (needed to cut between keyframes). Fragments start
+    at each keyframe, so the file can be streamed while it is being written
+    and played before it is complete.
+    """
+    if reencode:
+        codec_args = ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '20', '-c:a', 'aac', '-b:a', '160k']
+    else:
+        codec_args = ['-c', 'copy']
+    return (['-map', '0:v:0', '-map', '1:a:0'] + codec_args +
+            ['-f', 'mp4', '-movflags', '+frag_keyframe+empty_moov+default_base_moof'])
+
+
+class TranscodePool:
+    """Runs ffmpeg as a pipe filter, with at most max_processes running at once.
+
+    Input is written to ffmpeg's stdin from an iterable of byte chunks while
+    its stdout is copied to an output file as it is produced, so the first
+    output bytes are available long before the input has been fully read.
+    CPU time used by each ffmpeg process is measured with wait4() where the
+    platform provides it.
+    """
+
+    def __init__(self, max_processes=None, ffmpeg='ffmpeg'):
+        self.max_processes = max_processes or os.cpu_count() or 1
+        self.ffmpeg = ffmpeg
+        self._slots = threading.BoundedSemaphore(self.max_processes)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.runs = 0
+        self.failures = 0
+        self.cpu_seconds = 0.0
+        self._by_kind = {}
+
+    def run(self, inputs, output_args, output, kind='transcode'):
+        """Run ffmpeg over inputs, writing its output to the binary file object output.
+
+        inputs is a list of iterables of byte chunks, fed to ffmpeg as inputs
+        0, 1, ... in parallel. kind labels the run in stats(), e.g. 'remux' or 'transcode'. Returns a
+        dict with the process's CPU and wall time and byte counts; raises
+        TranscodeError with ffmpeg's last error lines on failure, or the
+        exception raised while reading an input.
+        """
+        with self._slots:
+            with self._lock:
+                self.active += 1
+            try:
+                stats = self._run(inputs, output_args, output)
+            except Exception:
+                with self._lock:
+                    self.failures += 1
+                raise
+            finally:
+                with self._lock:
+                    self.active -= 1
+        with self._lock:
+            self.runs += 1
+            self.cpu_seconds += stats['cpu_seconds'] or 0.0
+            totals = self._by_kind.setdefault(kind, {'runs': 0, 'cpu_seconds': 0.0})
+            totals['runs'] += 1
+            totals['cpu_seconds'] += stats['cpu_seconds'] or 0.0
+        logger.info(f"ffmpeg {kind} read {stats['bytes_in']} bytes, wrote {stats['bytes_out']} bytes "
+                    f"using {stats['cpu_seconds']}s CPU in {stats['wall_seconds']}s")
+        return stats
+
+    def _run(self, inputs, output_args, output):
+        if len(inputs) > 1 and not MULTI_INPUT:
+            raise TranscodeError("ffmpeg with several piped inputs is not supported on this platform")
+        # Input 0 is stdin; the rest get a pipe each, inherited under the same descriptor number
+        pipes = [os.pipe() for _ in inputs[1:]]
+        input_args = ['-i', 'pipe:0']
+        for read_fd, _ in pipes:
+            input_args += ['-i', f'pipe:{read_fd}']
+        command = [self.ffmpeg, '-hide_banner', '-loglevel', 'error'] + input_args + output_args + ['pipe:1']
+        started = time.monotonic()
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, pass_fds=[r for r, _ in pipes])
+        except FileNotFoundError:
+            for _, write_fd in pipes:
+                os.close(write_fd)
+            raise TranscodeError("ffmpeg is not installed")
+        finally:
+            # The child holds its own copies of the read ends
+            for read_fd, _ in pipes:
+                os.close(read_fd)
+        sinks = [process.stdin] + [os.fdopen(write_fd, 'wb') for _, write_fd in pipes]
+
+        errors = deque(maxlen=20)
+        counts = {'in': 0, 'feed_error': None}
+        counts_lock = threading.Lock()
+
+        def feed(chunks, sink):
+            try:
+                for chunk in chunks:
+                    sink.write(chunk)
+                    with counts_lock:
+                        counts['in'] += len(chunk)
+            except BrokenPipeError:
+                # ffmpeg exited early; its exit status explains why
+                pass
+            except Exception as e:
+                counts['feed_error'] = e
+                # Don't leave ffmpeg waiting on the other inputs
+                process.kill()
+            finally:
+                try:
+                    sink.close()
+                except OSError:
+                    pass
+                close = getattr(chunks, 'close', None)
+                if close:
+                    close()
+
+        def drain_errors():
+            for line in process.stderr:
+                errors.append(line.decode('utf-8', 'replace').rstrip())
+
+        feeders = [threading.Thread(target=feed, args=(chunks, sink), daemon=True)
+                   for chunks, sink in zip(inputs, sinks)]
+        error_reader = threading.Thread(target=drain_errors, daemon=True)
+        for feeder in feeders:
+            feeder.start()
+        error_reader.start()
+
+        bytes_out = 0
+        try:
+            while True:
+                chunk = process.stdout.read1(OUTPUT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                output.write(chunk)
+                output.flush()
+                bytes_out += len(chunk)
+        except Exception:
+            process.kill()
+            raise
+        finally:
+            for feeder in feeders:
+                feeder.join()
+            cpu_seconds = self._reap(process)
+            error_reader.join()
+
+        if counts['feed_error'] is not None:
+            raise counts['feed_error']
+        if process.returncode != 0:
+            detail = '; '.join(errors) or 'no error output'
+            raise TranscodeError(f"ffmpeg exited with status {process.returncode}: {detail}")
+
+        return {
+            'bytes_in': counts['in'],
+            'bytes_out': bytes_out,
+            'cpu_seconds': cpu_seconds,
+            'wall_seconds': round(time.monotonic() - started, 3)
+        }
+
+    def _reap(self, process):
+        """Wait for ffmpeg to exit and return the CPU seconds it used, if measurable"""
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return round(usage.ru_utime + usage.ru_stime, 3)
+        process.wait()
+        return None
+
+    def stats(self):
+        """Return process counts and CPU time, in total and per kind of run"""
+        with self._lock:
+            return {
+                'max_processes': self.max_processes,
+                'active': self.active,
+                'runs': self.runs,
+                'failures': self.failures,
+                'cpu_seconds': round(self.cpu_seconds, 3),
+                'by_kind': {kind: {'runs': totals['runs'], 'cpu_seconds': round(totals['cpu_seconds'], 3)}
+                            for kind, totals in self._by_kind.items()}
+            }
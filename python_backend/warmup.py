@@ -0,0 +1,62 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Warmup:
+    """Runs start-up work in the background and reports when it has finished.
+
+    steps is a list of (name, function) pairs run in order on one thread. A
+    step that raises is logged and recorded and the next one still runs, so
+    an unreachable upstream holds readiness back for its timeouts rather
+    than for good; whatever a failed step would have loaded is loaded by the
+    first request that needs it instead. With no steps, warm-up is done as
+    soon as it starts.
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+        self._results = {}  # step name -> {'seconds', 'error'}
+        self.seconds = None
+
+    def start(self):
+        if not self.steps:
+            self.seconds = 0.0
+            self.done.set()
+            return self
+        threading.Thread(target=self._run, name='warmup', daemon=True).start()
+        return self
+
+    def _run(self):
+        started = time.monotonic()
+        for name, step in self.steps:
+            step_started = time.monotonic()
+            error = None
+            try:
+                step()
+            except Exception as e:
+                logger.warning(f"Warm-up step {name} failed: {e}")
+                error = str(e) or type(e).__name__
+            with self._lock:
+                self._results[name] = {'seconds': round(time.monotonic() - step_started, 3), 'error': error}
+        self.seconds = round(time.monotonic() - started, 3)
+        self.done.set()
+        failed = [name for name, result in self._results.items() if result['error']]
+        logger.info(f"Warm-up finished in {self.seconds}s" + (f" ({', '.join(failed)} failed)" if failed else ''))
+
+    def stats(self):
+        with self._lock:
+            steps = {name: dict(result) for name, result in self._results.items()}
+        if not self.steps:
+            state = 'disabled'
+        elif not self.done.is_set():
+            state = 'warming'
+        elif any(result['error'] for result in steps.values()):
+            state = 'partial'
+        else:
+            state = 'warm'
+        return {'state': state, 'seconds': self.seconds, 'steps': steps}
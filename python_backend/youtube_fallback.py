@@ -8,13 +8,16 @@ from urllib.parse import parse_qs, urlparse
 class YouTubeFallback:
     """A fallback implementation for getting YouTube information when pytube fails"""
     
-    def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    def __init__(self, session=None):
+        self.headers = {
             'Accept-Language': 'en-US,en;q=0.9',
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8'
-        })
+        }
+        if session is None:
+            # A private session; a shared one supplies its own User-Agent
+            session = requests.Session()
+            session.headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+        self.session = session
     
     def extract_video_id(self, url):
         """Extract video ID from YouTube URL"""
@@ -33,7 +36,7 @@ class YouTubeFallback:
         
         # Use YouTube's oEmbed API (public and rarely blocked)
         oembed_url = f"https://www.youtube.com/oembed?url=https://www.youtube.com/watch?v={video_id}&format=json"
-        response = self.session.get(oembed_url, timeout=10)
+        response = self.session.get(oembed_url, headers=self.headers, timeout=10)
         response.raise_for_status()
         
         # Basic info from oEmbed
@@ -0,0 +1,317 @@
+import argparse
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+PLAYER_JS_PATH = '/s/player/bench0001/player_ias.vflset/en_US/base.js'
+
+# Just enough of a player for pytube's Cipher to parse: a signature
+# function with its transform object, and an "n" throttling function.
+# Stream URLs are served pre-signed, so neither is ever run.
+PLAYER_JS = r'''var Xy={Ab:function(a){a.reverse()}, Cd:function(a,b){a.splice(0,b)}};
+Sg=function(a){a=a.split("");Xy.Ab(a,1);Xy.Cd(a,2);return a.join("")};
+var Wq=[Nf];
+g.k.update=function(a){a.D&&(b=a.get("n"))&&(b=Wq[0](b),a.set("n",b))};
+Nf=function(a){var b=a.split(""),c=[function(d){d.reverse()},b,null];try{c[0](c[1])}catch(e){return"enhanced_except_"+a}return b.join("")};
+'''
+
+# itag -> how its synthetic media is made and described
+MEDIA_FORMATS = {
+    18: {
+        'file': 'progressive.mp4',
+        'mime_type': 'video/mp4; codecs="avc1.42001E, mp4a.40.2"',
+        'ffmpeg_args': ['-f', 'lavfi', '-i', 'testsrc=size=640x360:rate=30', '-f', 'lavfi', '-i', 'sine=frequency=440',
+                        '-c:v', 'libx264', '-preset', 'veryfast', '-b:v', '500k', '-c:a', 'aac', '-b:a', '96k',
+                        '-movflags', '+faststart'],
+        'fields': {'width': 640, 'height': 360, 'quality': 'medium', 'qualityLabel': '360p', 'fps': 30,
+                   'audioQuality': 'AUDIO_QUALITY_LOW', 'audioSampleRate': '44100', 'audioChannels': 2}
+    },
+    140: {
+        'file': 'audio.m4a',
+        'mime_type': 'audio/mp4; codecs="mp4a.40.2"',
+        'ffmpeg_args': ['-f', 'lavfi', '-i', 'sine=frequency=440', '-c:a', 'aac', '-b:a', '128k',
+                        '-movflags', '+faststart'],
+        'fields': {'quality': 'tiny', 'audioQuality': 'AUDIO_QUALITY_MEDIUM', 'audioSampleRate': '44100',
+                   'audioChannels': 2}
+    }
+}
+
+VIDEO_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{11}')
+
+
+def video_ids(count):
+    """IDs of the synthetic videos used by benchmark scenarios"""
+    return [f"bench{n:06d}" for n in range(count)]
+
+
+def generate_media(directory, seconds=60, ffmpeg='ffmpeg'):
+    """Make the synthetic media files that are missing from directory; returns {itag: path}"""
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for itag, media in MEDIA_FORMATS.items():
+        path = os.path.join(directory, f"{seconds}s-{media['file']}")
+        if not os.path.exists(path):
+            logger.info(f"Generating {seconds}s of media for itag {itag}")
+            partial = path + '.partial'
+            subprocess.run([ffmpeg, '-hide_banner', '-loglevel', 'error', '-y'] + media['ffmpeg_args'] +
+                           ['-t', str(seconds), '-f', 'mp4', partial], check=True)
+            os.replace(partial, path)
+        paths[itag] = path
+    return paths
+
+
+class YouTubeStandIn:
+    """A threaded HTTP server playing the parts of YouTube the backend talks to, for benchmarks.
+
+    Serves watch pages, the innertube player API, a player JS that pytube can
+    parse, oEmbed JSON and googlevideo media (with Range support) for any
+    video ID. The backend reaches it through UPSTREAM_OVERRIDE, which sends
+    every request here with the intended host in X-Forwarded-Host.
+
+    Media is synthetic: a progressive MP4 (itag 18) and an M4A audio track
+    (itag 140) made by generate_media and served for every video. Recorded
+    pages can be dropped into fixtures as <video_id>/watch.html,
+    <video_id>/player.json and <video_id>/oembed.json (and base.js at the
+    top); their stream URLs are pointed at the synthetic media.
+
+    latency is slept before every response; bandwidth (bytes per second)
+    paces each response body.
+    """
+
+    def __init__(self, media_paths, seconds, latency=0.0, bandwidth=None, fixtures=None, host='127.0.0.1', port=0):
+        self.media = {}
+        for itag, path in media_paths.items():
+            with open(path, 'rb') as f:
+                self.media[itag] = f.read()
+        self.seconds = seconds
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fixtures = fixtures
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.bytes_sent = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='youtube-standin', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return {'requests': dict(self.requests), 'bytes_sent': self.bytes_sent}
+
+    def _count(self, route, size):
+        with self._lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+            self.bytes_sent += size
+
+    def _fixture(self, *parts):
+        if not self.fixtures:
+            return None
+        path = os.path.join(self.fixtures, *parts)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _media_url(self, video_id, itag):
+        expire = int(time.time()) + 6 * 3600
+        return (f"https://rr1---sn-bench.googlevideo.com/videoplayback?id={video_id}&itag={itag}"
+                f"&expire={expire}&sig=bench")
+
+    def _formats(self, video_id):
+        formats = {'formats': [], 'adaptiveFormats': []}
+        for itag, media in MEDIA_FORMATS.items():
+            if itag not in self.media:
+                continue
+            size = len(self.media[itag])
+            entry = dict(media['fields'], itag=itag, url=self._media_url(video_id, itag), mimeType=media['mime_type'],
+                         bitrate=int(size * 8 / self.seconds), averageBitrate=int(size * 8 / self.seconds),
+                         contentLength=str(size), approxDurationMs=str(self.seconds * 1000))
+            formats['formats' if itag == 18 else 'adaptiveFormats'].append(entry)
+        return formats
+
+    def player_response(self, video_id):
+        recorded = self._fixture(video_id, 'player.json')
+        if recorded is not None:
+            response = json.loads(recorded)
+        else:
+            response = {
+                'playabilityStatus': {'status': 'OK', 'playableInEmbed': True},
+                'videoDetails': {
+                    'videoId': video_id,
+                    'title': f"Benchmark video {video_id}",
+                    'lengthSeconds': str(self.seconds),
+                    'author': 'Benchmark channel',
+                    'channelId': 'UCbenchmark000000000000',
+                    'viewCount': '123456',
+                    'shortDescription': 'Synthetic video served by the benchmark stand-in',
+                    'thumbnail': {'thumbnails': [
+                        {'url': f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg", 'width': 480, 'height': 360}
+                    ]}
+                }
+            }
+        # Recorded or not, streams point at the synthetic media
+        response['streamingData'] = dict(self._formats(video_id), expiresInSeconds='21540')
+        return response
+
+    def watch_page(self, video_id):
+        recorded = self._fixture(video_id, 'watch.html')
+        if recorded is not None:
+            return recorded
+        player = json.dumps(self.player_response(video_id))
+        return (f'<!DOCTYPE html><html><head><title>Benchmark video {video_id} - YouTube</title>'
+                f'<script src="{PLAYER_JS_PATH}"></script></head><body>'
+                f'<script>var ytInitialPlayerResponse = {player};</script>'
+                f'<script>ytcfg.set({{"PLAYER_JS_URL": "{PLAYER_JS_PATH}"}});</script>'
+                f'</body></html>').encode('utf-8')
+
+    def oembed(self, video_id):
+        recorded = self._fixture(video_id, 'oembed.json')
+        if recorded is not None:
+            return recorded
+        return json.dumps({
+            'title': f"Benchmark video {video_id}",
+            'author_name': 'Benchmark channel',
+            'thumbnail_url': f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg",
+            'type': 'video',
+            'version': '1.0'
+        }).encode('utf-8')
+
+    def player_js(self):
+        return self._fixture('base.js') or PLAYER_JS.encode('utf-8')
+
+    def _handler_class(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def do_GET(self):
+                self._dispatch()
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                self._dispatch()
+
+            def do_HEAD(self):
+                self._dispatch(head=True)
+
+            def _dispatch(self, head=False):
+                host = self.headers.get('X-Forwarded-Host') or 'www.youtube.com'
+                parsed = urlparse(self.path)
+                query = parse_qs(parsed.query)
+                if standin.latency:
+                    time.sleep(standin.latency)
+
+                if host.endswith('googlevideo.com') and parsed.path == '/videoplayback':
+                    return self._media(query, head)
+                if parsed.path == '/youtubei/v1/player':
+                    video_id = query.get('videoId', [''])[0]
+                    return self._send('player', 200, 'application/json',
+                                      json.dumps(standin.player_response(video_id)).encode('utf-8'), head)
+                if parsed.path == '/watch':
+                    video_id = query.get('v', [''])[0]
+                    return self._send('watch', 200, 'text/html; charset=utf-8', standin.watch_page(video_id), head)
+                if parsed.path.startswith('/s/player/'):
+                    return self._send('player_js', 200, 'text/javascript', standin.player_js(), head)
+                if parsed.path == '/oembed':
+                    match = VIDEO_ID_PATTERN.search(query.get('url', [''])[0].rpartition('v=')[2])
+                    if not match:
+                        return self._send('oembed', 404, 'text/plain', b'Not Found', head)
+                    return self._send('oembed', 200, 'application/json', standin.oembed(match.group(0)), head)
+                return self._send('other', 404, 'text/plain', b'Not Found', head)
+
+            def _media(self, query, head):
+                try:
+                    data = standin.media[int(query.get('itag', ['0'])[0])]
+                except (KeyError, ValueError):
+                    return self._send('media', 404, 'text/plain', b'Not Found', head)
+                match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+                if not match:
+                    return self._send('media', 200, 'video/mp4', data, head)
+                start = int(match.group(1))
+                end = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+                if start >= len(data):
+                    return self._send('media', 416, 'text/plain', b'', head,
+                                      {'Content-Range': f"bytes */{len(data)}"})
+                return self._send('media', 206, 'video/mp4', data[start:end + 1], head,
+                                  {'Content-Range': f"bytes {start}-{end}/{len(data)}", 'Accept-Ranges': 'bytes'})
+
+            def _send(self, route, status, content_type, body, head, headers=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if not head:
+                    self._write(body)
+                standin._count(route, 0 if head else len(body))
+
+            def _write(self, body):
+                """Write a body, paced to the bandwidth limit"""
+                if not standin.bandwidth:
+                    self.wfile.write(body)
+                    return
+                chunk_size = max(1024, standin.bandwidth // 50)
+                started = time.monotonic()
+                for offset in range(0, len(body), chunk_size):
+                    self.wfile.write(body[offset:offset + chunk_size])
+                    ahead = (offset + chunk_size) / standin.bandwidth - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for YouTube, for benchmarks')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added before every response')
+    parser.add_argument('--bandwidth', type=int, default=None, help='bytes per second per connection')
+    parser.add_argument('--media-seconds', type=int, default=60, help='length of the synthetic media')
+    parser.add_argument('--media-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            'downloads', 'bench-media'))
+    parser.add_argument('--fixtures', help='directory of recorded pages')
+    parser.add_argument('--ffmpeg', default='ffmpeg')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    media = generate_media(args.media_dir, args.media_seconds, args.ffmpeg)
+    standin = YouTubeStandIn(media, args.media_seconds, args.latency, args.bandwidth, args.fixtures,
+                             port=args.port).start()
+    logger.info(f"Serving a YouTube stand-in at {standin.base_url}; start the backend with "
+                f"UPSTREAM_OVERRIDE={standin.base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        standin.stop()
+
+
+if __name__ == '__main__':
+    main()